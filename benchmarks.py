@@ -0,0 +1,563 @@
+#!/usr/bin/python
+# This file is part of tcollector.
+# Copyright (C) 2013  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+"""Micro-benchmarks for the hot paths of tcollector, and an end-to-end
+benchmark of a whole tcollector.
+
+Usage: ./benchmarks.py [options] [benchmark ...]
+Runs all the benchmarks if none is given.  The options are those of the
+end_to_end benchmark, which prints its results as JSON, one line per run.
+"""
+
+import json
+import optparse
+import os
+import random
+import re
+import signal
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import mocks
+import tcollector
+
+# The command line options, for the benchmarks that have some.
+OPTIONS = None
+
+
+def timed(func, *args):
+    """Returns how many seconds it took to call func(*args)."""
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def report(name, count, unit, seconds):
+    print '%-40s %12.0f %s/sec (%d %s in %.3fs)' % (name, count / seconds,
+                                                    unit, count, unit, seconds)
+
+
+def make_burst(nlines, chunk_size=65536):
+    """Returns a burst of nlines datapoints, cut in pipe-sized chunks."""
+    data = ''.join('proc.stat.cpu %d %d type=user cpu=%d\n'
+                   % (1400000000 + i, i, i % 64) for i in xrange(nlines))
+    return [data[i:i + chunk_size] for i in xrange(0, len(data), chunk_size)]
+
+
+def bench_line_framing():
+    """Splitting big bursts of collector output into lines."""
+
+    def legacy(chunks):
+        # What Collector.read() used to do.
+        buf = ''
+        lines = []
+        for chunk in chunks:
+            buf += chunk
+            while buf:
+                idx = buf.find('\n')
+                if idx == -1:
+                    break
+                lines.append(buf[0:idx].strip())
+                buf = buf[idx+1:]
+        return lines
+
+    def framer(chunks):
+        framer = tcollector.LineFramer()
+        lines = []
+        for chunk in chunks:
+            lines.extend(framer.feed(chunk))
+        return lines
+
+    for nlines in (10000, 100000):
+        for chunk_size in (4096, 1 << 20):
+            chunks = make_burst(nlines, chunk_size)
+            for name, func in (('legacy', legacy), ('framer', framer)):
+                report('framing %s %dk lines/%dk reads'
+                       % (name, nlines / 1000, chunk_size / 1024),
+                       nlines, 'lines', timed(func, chunks))
+
+
+class FakeProc(object):
+    """Stands in for the subprocess of a collector."""
+
+    class Pipe(object):
+
+        def __init__(self, chunks):
+            self.chunks = list(chunks)
+
+        def read(self):
+            if self.chunks:
+                return self.chunks.pop(0)
+            return ''
+
+    def __init__(self, chunks):
+        self.stdout = self.Pipe(chunks)
+        self.stderr = self.Pipe([])
+
+
+def bench_collect():
+    """Draining 100k lines per collector per read cycle through collect()."""
+
+    class LegacyCollector(tcollector.Collector):
+        # What Collector.collect() used to do.
+
+        def __init__(self, *args):
+            super(LegacyCollector, self).__init__(*args)
+            self.datalines = []
+
+        def collect(self):
+            while self.proc is not None:
+                self.read()
+                if not len(self.datalines):
+                    return
+                while len(self.datalines):
+                    yield self.datalines.pop(0)
+
+    nlines = 100000
+    data = ''.join(make_burst(nlines))
+    for name, cls in (('legacy', LegacyCollector),
+                      ('deque', tcollector.Collector)):
+        col = cls('bench', 0, '<bench>')
+        col.proc = FakeProc([data])
+        def drain():
+            for line in col.collect():
+                pass
+        report('collect %s %dk lines' % (name, nlines / 1000),
+               nlines, 'lines', timed(drain))
+
+
+def bench_parse_line():
+    """Parsing datapoint lines in ReaderThread.process_line()."""
+
+    def legacy(lines):
+        # What process_line() used to do.
+        for line in lines:
+            parsed = re.match('^([-_./a-zA-Z0-9]+)\s+'
+                              '(\d+)\s+'
+                              '(\S+?)'
+                              '((?:\s+[-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*)$',
+                              line)
+            metric, timestamp, value, tags = parsed.groups()
+            timestamp = int(timestamp)
+
+    def parse_line(lines):
+        parse = tcollector.parse_line
+        for line in lines:
+            metric, timestamp, value, tags = parse(line)
+
+    nlines = 200000
+    for ntags in (0, 2, 5):
+        tags = ''.join(' tag%d=value%d' % (i, i) for i in xrange(ntags))
+        lines = ['proc.stat.cpu %d %d%s' % (1400000000 + i, i, tags)
+                 for i in xrange(nlines)]
+        for name, func in (('legacy', legacy), ('parse_line', parse_line)):
+            report('parsing %s %d tags' % (name, ntags),
+                   nlines, 'lines', timed(func, lines))
+
+
+def bench_global_tags():
+    """Adding the global tags given with -t to every datapoint."""
+
+    tags = {'host': 'web42', 'dc': 'ams1', 'cluster': 'frontend'}
+
+    def legacy(lines):
+        # What SenderThread.add_tags_to_line() used to do.
+        sorted_tags = sorted(tags.items())
+        for line in lines:
+            for tag, value in sorted_tags:
+                if ' %s=' % tag not in line:
+                    line += ' %s=%s' % (tag, value)
+
+    def injector(parsed):
+        # What ReaderThread.process_line() does with what parse_line()
+        # gives it.
+        missing = tcollector.TagInjector(tags).missing
+        for line, line_tags in parsed:
+            extra = missing(line_tags)
+            if extra:
+                line += extra
+
+    nlines = 200000
+    for ntags in (0, 2):
+        line_tags = ''.join(' tag%d=value%d' % (i, i) for i in xrange(ntags))
+        lines = ['proc.stat.cpu %d %d%s' % (1400000000 + i, i, line_tags)
+                 for i in xrange(nlines)]
+        parsed = [(line, line_tags) for line in lines]
+        report('global tags legacy %d tags' % ntags,
+               nlines, 'lines', timed(legacy, lines))
+        report('global tags injector %d tags' % ntags,
+               nlines, 'lines', timed(injector, parsed))
+
+
+# An interval collector like the ones we ship: it imports the common code of
+# the collectors and reads a few files in /proc.
+SAMPLE_COLLECTOR = """#!%s
+import os
+import sys
+import time
+
+from collectors.lib import utils
+
+def collect():
+    ts = int(time.time())
+    for line in open('/proc/loadavg').read().split()[:3]:
+        print 'proc.loadavg %%d %%s' %% (ts, line)
+    for line in open('/proc/stat'):
+        fields = line.split()
+        if fields[0].startswith('cpu'):
+            print 'proc.stat.cpu %%d %%s type=user cpu=%%s' %% (ts, fields[1],
+                                                          fields[0])
+    sys.stdout.flush()
+
+if __name__ == '__main__':
+    collect()
+"""
+
+
+def bench_python_collectors():
+    """CPU used to run an interval collector, exec'ed anew each time or
+       called in a CollectorWorker (--python-collectors=worker)."""
+    tmpdir = tempfile.mkdtemp()
+    os.environ['PYTHONPATH'] = os.path.dirname(os.path.abspath(__file__))
+    try:
+        filename = os.path.join(tmpdir, 'sample.py')
+        f = open(filename, 'w')
+        f.write(SAMPLE_COLLECTOR % sys.executable)
+        f.close()
+        os.chmod(filename, 0755)
+        col = tcollector.Collector('sample.py', 15, filename,
+                                   os.path.getmtime(filename))
+
+        def run_exec(nruns):
+            for i in xrange(nruns):
+                proc = subprocess.Popen(filename, stdout=subprocess.PIPE,
+                                        close_fds=True)
+                proc.stdout.read()
+                proc.wait()
+
+        def run_worker(nruns):
+            pool = tcollector.CollectorWorkerPool()
+            for i in xrange(nruns):
+                proc = pool.run(col)
+                while proc.poll() is None:
+                    time.sleep(0.001)
+                tcollector.set_nonblocking(proc.stdout.fileno())
+                proc.stdout.read()
+            # Only children that exited count in os.times().
+            pool.remove(col.name)
+            proc.wait()
+
+        nruns = 100
+        for name, func in (('exec', run_exec), ('worker', run_worker)):
+            before = os.times()
+            seconds = timed(func, nruns)
+            after = os.times()
+            cpu = sum(after[i] - before[i] for i in xrange(4))
+            print ('python collector %-6s %6.1f ms CPU/run, %6.1f s CPU/hour'
+                   ' at a 15s interval (%d runs in %.3fs)'
+                   % (name, cpu * 1000 / nruns, cpu / nruns * 3600 / 15,
+                      nruns, seconds))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_spawn():
+    """Spawning a Python collector with Popen or with the Zygote (--zygote),
+       until it exited."""
+    tmpdir = tempfile.mkdtemp()
+    os.environ['PYTHONPATH'] = os.path.dirname(os.path.abspath(__file__))
+    zygote = tcollector.Zygote()
+    try:
+        filename = os.path.join(tmpdir, 'sample.py')
+        f = open(filename, 'w')
+        f.write(SAMPLE_COLLECTOR % sys.executable)
+        f.close()
+        os.chmod(filename, 0755)
+
+        def run_popen(nruns):
+            for i in xrange(nruns):
+                proc = subprocess.Popen(filename, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        close_fds=True, preexec_fn=os.setsid)
+                proc.stdout.read()
+                proc.wait()
+
+        def run_zygote(nruns):
+            for i in xrange(nruns):
+                proc = zygote.spawn(filename)
+                proc.stdout.read()
+                proc.wait()
+            # Only children that exited count in os.times().
+            zygote.control.close()
+            zygote.proc.wait()
+
+        nruns = 100
+        for name, func in (('popen', run_popen), ('zygote', run_zygote)):
+            before = os.times()
+            seconds = timed(func, nruns)
+            after = os.times()
+            cpu = sum(after[i] - before[i] for i in xrange(4))
+            print ('spawn %-6s %6.2f ms/spawn, %6.2f ms CPU/spawn (%d spawns)'
+                   % (name, seconds * 1000 / nruns, cpu * 1000 / nruns, nruns))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+# A long-running collector sending `series' series, `rate' times a second,
+# with a value that changes with a probability of `change_rate'.  Values
+# are the time they were made at in microseconds, so that the TSD can tell
+# how long they took to get there.  Timestamps go up by at least one every
+# time, no matter how often that is, so that tcollector takes them all.
+SYNTHETIC_COLLECTOR = """#!%(python)s
+import os
+import random
+import signal
+import sys
+import time
+
+counts = [0, 0]  # How many lines we sent, and how many had a new value.
+
+def done(signum, frame):
+    f = open(%(counts)r + '.tmp', 'w')
+    f.write('%%d %%d\\n' %% tuple(counts))
+    f.close()
+    os.rename(%(counts)r + '.tmp', %(counts)r)
+    os._exit(0)
+
+signal.signal(signal.SIGTERM, done)
+values = [None] * %(series)d
+ts = 0
+next_round = time.time()
+while True:
+    now = time.time()
+    if now < next_round:
+        time.sleep(next_round - now)
+    next_round += 1.0 / %(rate)f
+    ts = max(ts + 1, int(time.time()))
+    value = int(time.time() * 1000000)
+    lines = []
+    for i in xrange(%(series)d):
+        if values[i] is None or random.random() < %(change_rate)f:
+            values[i] = value
+            counts[1] += 1
+        lines.append('bench.e2e %%d %%d col=%(index)d series=%%d%(pad)s\\n'
+                     %% (ts, values[i], i))
+    counts[0] += %(series)d
+    sys.stdout.write(''.join(lines))
+    sys.stdout.flush()
+"""
+
+
+class CountingTSD(mocks.FakeTSD):
+    """A FakeTSD that only counts the datapoints it gets, checks that they
+       are valid and tagged, and measures how long the ones with a new value
+       took to get to it."""
+
+    def __init__(self):
+        mocks.FakeTSD.__init__(self)
+        self.datapoints = 0
+        self.invalid = 0
+        self.measuring = False
+        self.latencies = []  # In ms, of new values while we're measuring.
+        self.last_values = {}  # Series -> last value, to spot replays.
+
+    def receive(self, line):
+        now = time.time()
+        parsed = line.startswith('put ') and tcollector.parse_line(line[4:])
+        if not parsed or ' host=bench' not in parsed[3]:
+            self.invalid += 1
+            return
+        self.datapoints += 1
+        metric, timestamp, value, tags = parsed
+        series = metric + tags
+        if self.last_values.get(series) == value:
+            return  # tcollector replayed a value it deduped.
+        self.last_values[series] = value
+        if self.measuring:
+            self.latencies.append(now * 1000 - int(value) / 1000.0)
+
+
+def process_usage(pid):
+    """Returns the CPU seconds used by the given process, and its peak RSS
+       in kB."""
+    stat = open('/proc/%d/stat' % pid).read()
+    fields = stat[stat.rindex(')') + 2:].split()
+    cpu = (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+    peak_rss = 0
+    for line in open('/proc/%d/status' % pid):
+        if line.startswith('VmHWM:'):
+            peak_rss = int(line.split()[1])
+    return cpu, peak_rss
+
+
+def percentile(values, q):
+    """Returns the q-th percentile of the given sorted values."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * q / 100.0))]
+
+
+def end_to_end(collectors, series, rate, change_rate, line_length, duration,
+               warmup, runtime, tcollector_args=()):
+    """Runs a tcollector with synthetic collectors against a CountingTSD.
+
+    Returns: A dict of what we measured, for `duration' seconds after
+      `warmup' seconds.
+    """
+    tmpdir = tempfile.mkdtemp()
+    tsd = CountingTSD()
+    tsd.start()
+    try:
+        os.makedirs(os.path.join(tmpdir, 'collectors', '0'))
+        # What every line has: `bench.e2e <ts> <value> col=N series=N'.
+        pad = line_length - len('bench.e2e 1500000000 1500000000000000'
+                                ' col=0 series=%d host=bench' % series)
+        pad = pad > 5 and ' pad=' + 'x' * (pad - 5) or ''
+        for index in xrange(collectors):
+            filename = os.path.join(tmpdir, 'collectors', '0',
+                                    'synthetic%d.py' % index)
+            f = open(filename, 'w')
+            f.write(SYNTHETIC_COLLECTOR % {
+                'python': sys.executable, 'series': series, 'rate': rate,
+                'change_rate': change_rate, 'index': index, 'pad': pad,
+                'counts': os.path.join(tmpdir, 'counts%d' % index)})
+            f.close()
+            os.chmod(filename, 0755)
+        proc = subprocess.Popen(
+            [sys.executable, tcollector.TCOLLECTOR_PATH,
+             '-c', os.path.join(tmpdir, 'collectors'), '-H', '127.0.0.1',
+             '-p', str(tsd.port), '-t', 'host=bench', '-P', '',
+             '--logfile', os.path.join(tmpdir, 'tcollector.log'),
+             '--runtime', runtime, '--no-tcollector-stats']
+            + list(tcollector_args), close_fds=True)
+        try:
+            time.sleep(warmup)
+            cpu_before = process_usage(proc.pid)[0]
+            datapoints_before = tsd.datapoints
+            start = time.time()
+            tsd.measuring = True
+            time.sleep(duration)
+            tsd.measuring = False
+            elapsed = time.time() - start
+            datapoints = tsd.datapoints - datapoints_before
+            cpu, peak_rss = process_usage(proc.pid)
+        finally:
+            os.kill(proc.pid, signal.SIGTERM)
+            proc.wait()
+        # tcollector doesn't wait for all the collectors to exit.
+        lines = changed = 0
+        deadline = time.time() + 10
+        for index in xrange(collectors):
+            path = os.path.join(tmpdir, 'counts%d' % index)
+            while not os.path.exists(path) and time.time() < deadline:
+                time.sleep(0.01)
+            if os.path.exists(path):
+                counts = open(path).read().split()
+                lines += int(counts[0])
+                changed += int(counts[1])
+        latencies = sorted(tsd.latencies)
+        return {
+            'benchmark': 'end_to_end',
+            'config': {'collectors': collectors, 'series': series,
+                       'rate': rate, 'change_rate': change_rate,
+                       'line_length': line_length, 'duration': duration,
+                       'runtime': runtime,
+                       'tcollector_args': list(tcollector_args)},
+            'lines_emitted': lines,
+            'lines_changed': changed,
+            'datapoints_received': tsd.datapoints,
+            'datapoints_invalid': tsd.invalid,
+            'throughput': datapoints / elapsed,
+            'latency_ms': dict(('p%d' % q, percentile(latencies, q))
+                               for q in (50, 90, 99)),
+            'latency_ms_max': latencies and latencies[-1] or None,
+            'cpu_seconds': cpu - cpu_before,
+            'cpu_percent': (cpu - cpu_before) * 100 / elapsed,
+            'peak_rss_kb': peak_rss,
+        }
+    finally:
+        tsd.close()
+        shutil.rmtree(tmpdir)
+
+
+def bench_end_to_end():
+    """Datapoints per second through a whole tcollector, from synthetic
+       collectors to a fake TSD, with the latency of new values, and the
+       CPU and memory tcollector used."""
+    for runtime in OPTIONS.runtimes.split(','):
+        print json.dumps(end_to_end(
+            OPTIONS.collectors, OPTIONS.series, OPTIONS.rate,
+            OPTIONS.change_rate, OPTIONS.line_length, OPTIONS.duration,
+            OPTIONS.warmup, runtime, OPTIONS.tcollector_args),
+            sort_keys=True)
+        sys.stdout.flush()
+
+
+def parse_cmdline(argv):
+    parser = optparse.OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('--collectors', type='int', default=4,
+                      help='How many synthetic collectors to run. '
+                           'default=%default')
+    parser.add_option('--series', type='int', default=1000,
+                      help='How many series each collector sends. '
+                           'default=%default')
+    parser.add_option('--rate', type='float', default=1,
+                      help='How many times a second each collector sends '
+                           'all its series. default=%default')
+    parser.add_option('--change-rate', dest='change_rate', type='float',
+                      default=1,
+                      help='The probability that a value changed since the '
+                           'last time, the others are deduped by '
+                           'tcollector. default=%default')
+    parser.add_option('--line-length', dest='line_length', type='int',
+                      default=80,
+                      help='How long the datapoints are, with the host tag. '
+                           'default=%default')
+    parser.add_option('--duration', type='float', default=10,
+                      help='How many seconds to measure for. '
+                           'default=%default')
+    parser.add_option('--warmup', type='float', default=2,
+                      help='How many seconds to wait before measuring. '
+                           'default=%default')
+    parser.add_option('--runtimes', default='threads,loop',
+                      help='The --runtime of tcollector to measure, '
+                           'separated by commas. default=%default')
+    parser.add_option('--tcollector-arg', dest='tcollector_args',
+                      action='append', default=[], metavar='ARG',
+                      help='An argument to give tcollector, can be repeated.')
+    options, args = parser.parse_args(args=argv[1:])
+    if options.rate <= 0:
+        parser.error('--rate must be greater than 0')
+    if not 0 <= options.change_rate <= 1:
+        parser.error('--change-rate must be between 0 and 1')
+    return options, args
+
+
+def main(argv):
+    global OPTIONS
+    OPTIONS, args = parse_cmdline(argv)
+    benchmarks = sorted(name[6:] for name in globals()
+                        if name.startswith('bench_'))
+    for name in args or benchmarks:
+        if name not in benchmarks:
+            print >>sys.stderr, ('Unknown benchmark %r, pick one of: %s'
+                                 % (name, ', '.join(benchmarks)))
+            return 1
+        globals()['bench_' + name]()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
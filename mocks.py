@@ -11,8 +11,15 @@
 # of the GNU Lesser General Public License along with this program.  If not,
 # see <http://www.gnu.org/licenses/>.
 
+import BaseHTTPServer
+import json
+import SocketServer
+import socket
 import sys
+import threading
+import time
 import traceback
+import zlib
 
 # for debugging
 real_stderr = sys.stderr
@@ -79,3 +86,174 @@ class Utils():
 
     def err(self, msg):
         sys.stderr.write("%s\n" % msg)
+
+
+class FakeTSD(threading.Thread):
+    """A TSD listening on a local port, that answers `version' commands and
+       records the lines it receives.  It complains about the `put' commands
+       for metrics starting with `bad', like OpenTSDB does for metrics that
+       it doesn't know."""
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+        self.lines = []
+        self.received = threading.Condition()
+
+    def run(self):
+        while True:
+            try:
+                conn, addr = self.server.accept()
+            except socket.error:
+                return
+            handler = threading.Thread(target=self.serve, args=(conn,))
+            handler.daemon = True
+            handler.start()
+
+    def serve(self, conn):
+        buf = ''
+        while True:
+            try:
+                data = conn.recv(4096)
+            except socket.error:
+                return
+            if not data:
+                return
+            buf += data
+            lines = buf.split('\n')
+            buf = lines.pop()
+            for line in lines:
+                if line == 'version':
+                    conn.sendall('net.opentsdb.tools BuildData built at'
+                                 ' revision fake (MINT)\n'
+                                 'Built on 2013/01/01 00:00:00 +0000 by'
+                                 ' fake@localhost:/tmp/opentsdb\n')
+                    continue
+                if line.startswith('put bad'):
+                    conn.sendall("put: unknown metric: No such name for"
+                                 " 'metrics': '%s'\n" % line.split()[1])
+                self.receive(line)
+
+    def receive(self, line):
+        """Records a line other than `version'."""
+        self.received.acquire()
+        self.lines.append(line)
+        self.received.notifyAll()
+        self.received.release()
+
+    def wait_for(self, count, timeout=10):
+        """Waits until we received at least `count' lines."""
+        deadline = time.time() + timeout
+        self.received.acquire()
+        try:
+            while len(self.lines) < count and time.time() < deadline:
+                self.received.wait(deadline - time.time())
+            return list(self.lines)
+        finally:
+            self.received.release()
+
+    def close(self):
+        self.server.close()
+
+
+class FakeHttpTSD(threading.Thread):
+    """A TSD serving /api/version and /api/put on a local port.  It records
+       the datapoints it receives and refuses those whose metric starts with
+       `bad', the way OpenTSDB does with `?details'.  Set `status' to make it
+       fail all the requests to /api/put with that HTTP status."""
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.datapoints = []
+        self.encodings = []  # The Content-Encoding of each request.
+        self.transfer_encodings = []  # Their Transfer-Encoding.
+        self.connections = 0
+        self.status = None
+        self.received = threading.Condition()
+        tsd = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # So that connections are kept.
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                tsd.connections += 1
+
+            def do_GET(self):
+                self.reply(200, '{"version": "fake"}')
+
+            def do_POST(self):
+                body = self.read_body()
+                if tsd.status:
+                    self.reply(tsd.status, 'Failing on purpose')
+                    return
+                encoding = self.headers.get('Content-Encoding')
+                if encoding == 'gzip':
+                    body = zlib.decompress(body, 31)
+                datapoints = json.loads(body)
+                errors = [{'datapoint': dp, 'error': 'Unknown metric'}
+                          for dp in datapoints
+                          if dp['metric'].startswith('bad')]
+                tsd.received.acquire()
+                tsd.encodings.append(encoding)
+                tsd.datapoints.extend(dp for dp in datapoints
+                                      if not dp['metric'].startswith('bad'))
+                tsd.received.notifyAll()
+                tsd.received.release()
+                self.reply(errors and 400 or 200, json.dumps({
+                    'success': len(datapoints) - len(errors),
+                    'failed': len(errors), 'errors': errors}))
+
+            def read_body(self):
+                transfer_encoding = self.headers.get('Transfer-Encoding')
+                tsd.transfer_encodings.append(transfer_encoding)
+                if transfer_encoding != 'chunked':
+                    return self.rfile.read(int(self.headers['Content-Length']))
+                chunks = []
+                while True:
+                    size = int(self.rfile.readline().split(';')[0], 16)
+                    chunks.append(self.rfile.read(size))
+                    self.rfile.readline()  # The CRLF after the chunk.
+                    if not size:
+                        return ''.join(chunks)
+
+            def reply(self, status, body):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+
+    def run(self):
+        self.server.serve_forever(poll_interval=0.05)
+
+    def wait_for(self, count, timeout=10):
+        """Waits until we received at least `count' datapoints."""
+        deadline = time.time() + timeout
+        self.received.acquire()
+        try:
+            while len(self.datapoints) < count and time.time() < deadline:
+                self.received.wait(deadline - time.time())
+            return list(self.datapoints)
+        finally:
+            self.received.release()
+
+    def close(self):
+        if self.is_alive():
+            self.server.shutdown()
+        self.server.server_close()
@@ -21,23 +21,47 @@
 #
 
 import atexit
+import BaseHTTPServer
+import bisect
 import errno
 import fcntl
+import hashlib
+import heapq
+import httplib
+import imp
+import json
 import logging
+import math
+import mmap
 import os
 import random
 import re
+import runpy
+import select
 import signal
 import socket
+import struct
 import subprocess
 import sys
 import threading
 import time
+import traceback
+import zlib
+from collections import deque
 from logging.handlers import RotatingFileHandler
 from Queue import Queue
 from Queue import Empty
 from Queue import Full
 from optparse import OptionParser
+try:
+    import _multiprocessing  # For passing file descriptors to the Zygote.
+except ImportError:
+    _multiprocessing = None
+try:
+    import ctypes  # For inotify.
+    import ctypes.util
+except ImportError:
+    ctypes = None
 
 
 # global variables.
@@ -51,12 +75,147 @@ ALIVE = True
 # Hopefully some kind of supervising daemon will then restart it.
 MAX_UNCAUGHT_EXCEPTIONS = 100
 DEFAULT_PORT = 4242
-MAX_REASONABLE_TIMESTAMP = 1600000000  # Good until September 2020 :)
+MAX_REASONABLE_TIMESTAMP = 2209212000  # Good until January 2040 :)
 # How long to wait for datapoints before assuming
 # a collector is dead and restarting it
 ALLOWED_INACTIVITY_TIME = 600  # seconds
 MAX_SENDQ_SIZE = 10000
 MAX_READQ_SIZE = 100000
+# With --backpressure, how many lines can be waiting in the reader queue
+# before we stop reading from the noisiest collectors.
+DEFAULT_QUEUE_HIGH_WATER = MAX_READQ_SIZE * 8 // 10
+# How often we log about the lines we dropped, at most, in seconds.
+DROP_LOG_INTERVAL = 10
+# With --priority-lanes, the lanes of the reader queue, most important
+# first: their name, their weight, i.e. how many of their lines the senders
+# take in a row when the other lanes have lines waiting too, and the share
+# of the queue they can fill.
+LANES = (('system', 8, 0.2), ('application', 4, 0.4), ('bridge', 1, 0.4))
+LANE_NAMES = tuple(name for name, weight, share in LANES)
+# The collectors that report on the health of the host itself.  The others
+# are in the application lane, unless their name ends in _bridge.
+SYSTEM_COLLECTORS = frozenset(('dfstat', 'ifstat', 'iostat', 'netstat',
+                               'nfsstat', 'procnettcp', 'procstats',
+                               'zfsiostats', 'zfskernstats'))
+# Default limits of the batches of datapoints sent to the TSD.  A batch is
+# sent as soon as it reaches either size, or when its first datapoint has
+# been waiting for the linger time.
+DEFAULT_BATCH_LINES = MAX_SENDQ_SIZE
+DEFAULT_BATCH_BYTES = 1024 * 1024
+DEFAULT_BATCH_LINGER_MS = 1000
+# How many datapoints we give the kernel at once, so that we never need a
+# copy of a whole batch in memory.  Datapoints are < 1KB, usually ~100B.
+SEND_CHUNK_LINES = 512
+# How often we report our own stats, in seconds.
+DEFAULT_STATS_INTERVAL = 60
+# The buckets of the histograms of our own stats.
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+                      10000)
+BATCH_BUCKETS_LINES = (1, 10, 50, 100, 500, 1000, 5000, 10000)
+PARSE_TIME_BUCKETS_US = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# We time the parsing of one line in this many, timing them all would
+# cost as much as the parsing.
+PARSE_TIME_SAMPLING = 64
+# How often the profiler started with SIGUSR1 looks at the stacks, in seconds.
+PROFILE_INTERVAL = 0.01
+# Datapoints per /api/put request.  Unless tsd.http.request.enable_chunked is
+# set, OpenTSDB refuses request bodies larger than a few kilobytes.
+DEFAULT_HTTP_BATCH_SIZE = 50
+# Defaults for the spool where datapoints go when no TSD can be reached.
+DEFAULT_SPOOL_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_SPOOL_REPLAY_RATE = 5000  # lines per second
+# How many (metric, tags) combinations each collector remembers for the
+# purpose of de-duplicating values.  Zero means no limit.
+MAX_DEDUP_ENTRIES = 1000000
+# Each collector's number of distinct series is estimated with a
+# HyperLogLog of 2**HLL_PRECISION one-byte registers, for a standard
+# error of 1.04 / sqrt(2**HLL_PRECISION), i.e. 1.6%.
+HLL_PRECISION = 12
+# How many of the series a collector sent beyond its limit we remember, so
+# that we only count them in its HyperLogLog the first time.
+MAX_REJECTED_SERIES = 100000
+# Width in seconds of the time buckets in which dedup entries are filed for
+# eviction.  Entries are evicted up to this many seconds late.
+DEDUP_BUCKET_WIDTH = 60
+# How many old dedup entries the ReaderThread evicts at most per second,
+# so that evicting a lot of them doesn't stall the reading of collectors.
+MAX_EVICTIONS_PER_SECOND = 10000
+# How many metrics we report TSD errors for; the others are added up.
+MAX_ERROR_METRICS = 100
+# How many metrics we remember the collector of, to count the datapoints
+# the TSD refused per collector.  We start over when there are more.
+MAX_METRIC_OWNERS = 100000
+# How the TSD tells us a `put' was for a metric it doesn't know.
+UNKNOWN_METRIC_RE = re.compile("No such name for 'metrics': '([^']*)'")
+# The first line of the TSD's answer to `version'.  The second one says when
+# and where it was built.
+VERSION_REPLY_RE = re.compile(r'^net\.opentsdb\S* .*built at revision ')
+# The CollectorPoller used by the ReaderThread, if running in epoll mode.
+POLLER = None
+# The CollectorWorkerPool, if Python collectors run in workers.
+WORKERS = None
+# The CollectorDirWatcher telling us what changed in the collector directory,
+# if we don't look at everything every time.
+WATCHER = None
+# The inotify events that may change which collectors we have.
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x80000
+IN_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+                 | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+                 | IN_MOVE_SELF)
+# The StackSampler started with SIGUSR1, while it runs.
+PROFILER = None
+# Maps the signals whose handling is deferred to the main loop to what to
+# call for them, and the ones we got that are waiting for it.
+SIGNAL_HANDLERS = {}
+PENDING_SIGNALS = []
+# The CollectorScheduler that decides when interval collectors run.
+SCHEDULER = None
+# The Zygote that forks Python collectors, if we use one.
+ZYGOTE = None
+# What the Zygote imports before forking collectors.
+ZYGOTE_PRELOAD = ('errno', 'httplib', 'json', 'pwd', 're', 'signal', 'socket',
+                  'stat', 'subprocess', 'time', 'urllib2',
+                  'collectors.lib.utils')
+# How a Python collector says that it can run in a CollectorWorker.
+COLLECT_FUNCTION_RE = re.compile(r'^def collect\(\s*\):', re.MULTILINE)
+# Where we are, so that CollectorWorkers can run us.
+TCOLLECTOR_PATH = os.path.abspath(__file__)
+if TCOLLECTOR_PATH.endswith(('.pyc', '.pyo')):
+    TCOLLECTOR_PATH = TCOLLECTOR_PATH[:-1]
+# What a datapoint sent by a collector must look like.  The value is matched
+# greedily: it can't contain whitespace anyway, and a lazy match makes the
+# regexp engine retry the tags after every single character of the value.
+LINE_RE = re.compile('([-_./a-zA-Z0-9]+)\s+'  # Metric name.
+                     '(\d+)\s+'              # Timestamp.
+                     '(\S+)'                 # Value (int or float).
+                     '((?:\s+[-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*)$')  # Tags
+
+
+def parse_line(line):
+    """Parses a datapoint line sent by a collector.
+
+    Returns: a (metric, timestamp, value, tags) tuple, where timestamp is
+      an int and tags is the string of all the tags (each of them preceded
+      by whitespace, so it's empty if there are none), or None if the line
+      is invalid.
+    """
+    parsed = LINE_RE.match(line)
+    if parsed is None:
+        return None
+    metric, timestamp, value, tags = parsed.groups()
+    return metric, int(timestamp), value, tags
 
 
 def register_collector(collector):
@@ -75,19 +234,506 @@ def register_collector(collector):
     COLLECTORS[collector.name] = collector
 
 
+class Counter(object):
+    """A value that only goes up."""
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def datapoints(self, name, tags):
+        yield name, tags, self.value
+
+
+class Gauge(object):
+    """A value we only look at when we report it."""
+
+    def __init__(self, func):
+        self.func = func
+
+    def datapoints(self, name, tags):
+        yield name, tags, self.func()
+
+
+class Histogram(object):
+    """Counts values in fixed buckets.  Like in Prometheus, a bucket is
+       reported with the count of all the values less than or equal to its
+       upper bound (its `le' tag), so the counts are cumulative."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)  # The upper bounds, in order.
+        # The last count is for the values above the last bound.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def datapoints(self, name, tags):
+        yield name + '.count', tags, self.count
+        yield name + '.sum', tags, self.sum
+        if tags:
+            tags += ' '
+        total = 0
+        for bound, count in zip(self.buckets + ('inf',), self.counts):
+            total += count
+            yield name + '.bucket', '%sle=%s' % (tags, bound), total
+
+
+class MetricsRegistry(object):
+    """Where the parts of tcollector keep their own metrics, to be reported
+       with the other tcollector.* stats.  Metrics are identified by their
+       name and tags, and asking for one that exists returns it, so that
+       several instances of the same thing share their metrics.
+
+       Updates are not locked: a metric should only be updated by one
+       thread."""
+
+    def __init__(self):
+        self.metrics = {}  # Maps (name, tags) to a metric.
+
+    def _get(self, name, tags, make):
+        metric = self.metrics.get((name, tags))
+        if metric is None:
+            metric = self.metrics[(name, tags)] = make()
+        return metric
+
+    def counter(self, name, tags=''):
+        return self._get(name, tags, Counter)
+
+    def histogram(self, name, buckets, tags=''):
+        return self._get(name, tags, lambda: Histogram(buckets))
+
+    def gauge(self, name, func, tags=''):
+        """Registers a gauge whose value is what func() returns."""
+        self.metrics[(name, tags)] = Gauge(func)
+
+    def datapoints(self):
+        """Returns the (metric, tags, value) of all our metrics."""
+        points = []
+        for (name, tags), metric in sorted(self.metrics.items()):
+            points.extend(metric.datapoints(name, tags))
+        return points
+
+
+# Our own metrics.
+METRICS = MetricsRegistry()
+
+
 class ReaderQueue(Queue):
     """A Queue for the reader thread"""
 
-    def nput(self, value):
-        """A nonblocking put, that simply logs and discards the value when the
-           queue is full, and returns false if we dropped."""
+    def nput(self, value, lane=0):
+        """A nonblocking put, that simply discards the value when the queue
+           is full, and returns false if we dropped.  There's only one lane."""
         try:
             self.put(value, False)
         except Full:
-            LOG.error("DROPPED LINE: %s", value)
             return False
         return True
 
+    def fills(self):
+        """Returns the (lane, number of lines waiting, capacity) of each
+           lane, for the backpressure."""
+        return [(0, self.qsize(), self.maxsize)]
+
+
+class LaneQueue(object):
+    """A replacement for the ReaderQueue that keeps the datapoints of the
+       collectors of each priority lane apart, so that a collector flooding
+       its lane can neither fill the queue for the others nor make them
+       wait behind it.
+
+       Each lane can hold its share of the queue.  get() takes lines from
+       the lanes in turn, up to the weight of the lane in a row when the
+       next lanes have lines waiting too (weighted round robin), so that
+       the most important lanes are drained first under contention while
+       the others still make progress."""
+
+    def __init__(self, maxsize, lanes=LANES):
+        self.names = [name for name, weight, share in lanes]
+        self.weights = [weight for name, weight, share in lanes]
+        self.capacities = [max(1, int(maxsize * share))
+                           for name, weight, share in lanes]
+        self.lanes = [deque() for lane in lanes]
+        self.size = 0
+        self.current = 0  # The lane whose turn it is.
+        self.credit = self.weights[0]  # How many more lines it can give.
+        self.not_empty = threading.Condition(threading.Lock())
+
+    def nput(self, value, lane=0):
+        """Appends the value to the given lane, unless it's full.
+
+        Returns: False if we dropped the value.
+        """
+        with self.not_empty:
+            queue = self.lanes[lane]
+            if len(queue) >= self.capacities[lane]:
+                return False
+            queue.append(value)
+            self.size += 1
+            self.not_empty.notify()
+        return True
+
+    def get(self, block=True, timeout=None):
+        """Same as Queue.get()."""
+        with self.not_empty:
+            if not block:
+                if not self.size:
+                    raise Empty
+            elif timeout is None:
+                while not self.size:
+                    self.not_empty.wait()
+            else:
+                deadline = time.time() + timeout
+                while not self.size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Empty
+                    self.not_empty.wait(remaining)
+            while True:
+                queue = self.lanes[self.current]
+                if queue and self.credit > 0:
+                    self.credit -= 1
+                    self.size -= 1
+                    return queue.popleft()
+                self.current = (self.current + 1) % len(self.lanes)
+                self.credit = self.weights[self.current]
+
+    def qsize(self):
+        return self.size
+
+    def depths(self):
+        """Returns the (name, number of lines waiting) of each lane."""
+        return [(name, len(queue))
+                for name, queue in zip(self.names, self.lanes)]
+
+    def fills(self):
+        return [(lane, len(queue), self.capacities[lane])
+                for lane, queue in enumerate(self.lanes)]
+
+
+def default_lane(colname):
+    """Returns the index of the priority lane of the given collector when
+       it wasn't given one on the command line."""
+    name = os.path.splitext(colname)[0]
+    if name in SYSTEM_COLLECTORS:
+        return LANE_NAMES.index('system')
+    if name.endswith('_bridge'):
+        return LANE_NAMES.index('bridge')
+    return LANE_NAMES.index('application')
+
+
+class TagInjector(object):
+    """Adds the global tags (given with -t) that a datapoint doesn't have
+       yet.  What to append is computed once, so for the usual datapoint
+       that has none of them this is just a string concatenation."""
+
+    def __init__(self, tags):
+        self.tags = sorted(tags.items())
+        # What to append to a datapoint that has none of our tags.
+        self.suffix = ''.join(' %s=%s' % tag for tag in self.tags)
+        # For each tag, how to tell a datapoint has it and what to append
+        # if it doesn't.
+        self.suffixes = [(' %s=' % name, ' %s=%s' % (name, value))
+                         for name, value in self.tags]
+
+    def missing(self, tags):
+        """Returns what to append to a datapoint to add our tags.
+
+        Args:
+          tags: The tags of the datapoint, as parse_line() returns them.
+        """
+        if not tags:
+            return self.suffix
+        return ''.join([suffix for needle, suffix in self.suffixes
+                        if needle not in tags])
+
+    def add(self, line):
+        """Returns the given datapoint line with our tags added."""
+        fields = line.split(None, 3)
+        if len(fields) < 4:
+            return line + self.suffix
+        return line + self.missing(' ' + fields[3])
+
+
+class LineFramer(object):
+    """Splits the output of a collector into lines.
+
+       Every chunk fed in is split in a single pass, and only the trailing
+       partial line is kept around, as a list of pending chunks that is
+       joined once its newline shows up.  This keeps the cost linear in
+       the number of bytes read, no matter how big the bursts are."""
+
+    def __init__(self):
+        self.pending = []  # Chunks of the partial line at the end.
+
+    def feed(self, data):
+        """Adds the given chunk and returns the list of complete lines."""
+        if '\n' not in data:
+            if data:
+                self.pending.append(data)
+            return []
+        if self.pending:
+            self.pending.append(data)
+            data = ''.join(self.pending)
+            del self.pending[:]
+        lines = data.split('\n')
+        tail = lines.pop()
+        if tail:
+            self.pending.append(tail)
+        return lines
+
+
+class HyperLogLog(object):
+    """Estimates how many distinct strings were added to it, in a fixed
+       amount of memory (Flajolet et al., with the linear counting of
+       Heule et al. for small cardinalities).  Strings are hashed with
+       MD5, so adding costs about a microsecond: only add what is new."""
+
+    # 2 ** -rank, for each possible rank.
+    POWERS = [2.0 ** -rank for rank in xrange(65)]
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.bits = 64 - precision  # The bits of the hash left for the rank.
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        x = struct.unpack_from('<Q', hashlib.md5(value).digest())[0]
+        index = x >> self.bits
+        # The position of the first 1 bit in what's left of the hash.
+        rank = self.bits - (x & ((1 << self.bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def estimate(self):
+        """Returns the estimated number of distinct strings added.  Safe to
+           call while another thread adds to it."""
+        registers = self.registers[:]
+        m = len(registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(self.POWERS[rank]
+                                       for rank in registers)
+        if estimate <= 2.5 * m:
+            zeros = registers.count('\0')
+            if zeros:
+                estimate = m * math.log(m / float(zeros))
+        return int(round(estimate))
+
+
+class DedupEntry(object):
+    """The last value seen for one (metric, tags) combination."""
+
+    __slots__ = ('value', 'repeated', 'timestamp', 'last_timestamp',
+                 'referenced', 'bucket', 'slot')
+
+    def __init__(self, value, timestamp):
+        self.value = value          # Last value seen.
+        self.repeated = False       # Whether it was seen more than once.
+        self.timestamp = timestamp  # When we saw this value the first time.
+        self.last_timestamp = timestamp  # When we saw it the last time.
+        self.referenced = False     # Whether it was used since the clock
+                                    # hand went by.
+        self.bucket = None          # The time bucket we're filed in.
+        self.slot = None            # Our index in the clock.
+
+
+class DedupCache(object):
+    """Keeps track of the last value of each (metric, tags) combination of
+       a collector, in order to remove duplicate values.
+
+       Only what's needed to rebuild the last line of a series is stored,
+       metric names are interned since they're shared by many series, and
+       the number of entries can be capped.  When the cache is full, we
+       evict one of the least recently used entries using the CLOCK
+       algorithm: a hand sweeps over the entries, clearing their
+       `referenced' bit, and evicts the first one that didn't get used
+       since the last time the hand went by.
+
+       Entries are also filed in a time wheel, by buckets of `bucket_width'
+       seconds of the timestamp of their value, so that evicting old values
+       only costs as much as the number of entries evicted."""
+
+    def __init__(self, max_entries=0, bucket_width=60):
+        """Constructor.
+
+        Args:
+          max_entries: How many entries the cache can hold.  0 means no limit.
+          bucket_width: The width of the buckets of the time wheel, in seconds.
+        """
+        self.max_entries = max_entries
+        self.bucket_width = bucket_width
+        self.entries = {}  # Maps (metric, tags) to a DedupEntry.
+        self.wheel = {}    # Maps a bucket number to the set of its keys.
+        # A heap of the bucket numbers of the wheel.  Buckets that emptied
+        # stay here until they get to the top or the heap is compacted.
+        self.buckets = []
+        # Keys in the order the clock hand visits them, each in a single
+        # slot.  The slots of the entries evicted from the time wheel hold
+        # None until the clock is compacted.
+        self.clock = []
+        self.hand = 0  # Index in self.clock where the hand is.
+        self.evictions = 0  # How many entries we evicted to make room.
+        # The bytes used by the entries and the buckets of the wheel, kept
+        # up to date as they come and go since other threads read it.
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Returns the DedupEntry of the given key, or None."""
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry.referenced = True
+        return entry
+
+    def add(self, metric, tags, value, timestamp):
+        """Adds a new entry, evicting an old one if the cache is full."""
+        key = (intern(metric), tags)
+        if self.max_entries and len(self.entries) >= self.max_entries:
+            slot = self._evict_one()
+            self.clock[slot] = key
+            self.hand += 1
+        else:
+            if len(self.clock) > 2 * len(self.entries) + 1024:
+                self._compact()
+            slot = len(self.clock)
+            self.clock.append(key)
+        entry = self.entries[key] = DedupEntry(value, timestamp)
+        entry.slot = slot
+        self.size += self._entry_size(key, entry)
+        self._file(key, entry)
+        return entry
+
+    def update(self, key, entry, value, timestamp):
+        """Records a new value for the given entry."""
+        self.size += sys.getsizeof(value) - sys.getsizeof(entry.value)
+        entry.value = value
+        entry.repeated = False
+        entry.timestamp = entry.last_timestamp = timestamp
+        if timestamp // self.bucket_width != entry.bucket:
+            self._unfile(key, entry)
+            self._file(key, entry)
+
+    def _file(self, key, entry):
+        """Files the given entry in the bucket of the time wheel that
+           corresponds to the timestamp of its value."""
+        entry.bucket = bucket = entry.timestamp // self.bucket_width
+        keys = self.wheel.get(bucket)
+        if keys is None:
+            keys = self.wheel[bucket] = set()
+            self.size += sys.getsizeof(keys)
+            if len(self.buckets) > 2 * len(self.wheel) + 64:
+                self.buckets = self.wheel.keys()
+                heapq.heapify(self.buckets)
+            else:
+                heapq.heappush(self.buckets, bucket)
+        size = sys.getsizeof(keys)
+        keys.add(key)
+        self.size += sys.getsizeof(keys) - size
+
+    def _unfile(self, key, entry):
+        """Removes the given entry from the time wheel."""
+        keys = self.wheel[entry.bucket]
+        keys.discard(key)
+        if not keys:
+            del self.wheel[entry.bucket]
+            self.size -= sys.getsizeof(keys)
+
+    def oldest(self):
+        """Returns the oldest bucket number in the time wheel, or None."""
+        buckets = self.buckets
+        while buckets and buckets[0] not in self.wheel:
+            heapq.heappop(buckets)
+        if buckets:
+            return buckets[0]
+        return None
+
+    def line(self, key):
+        """Returns the last line we saw for the given key."""
+        entry = self.entries[key]
+        return '%s %d %s%s' % (key[0], entry.last_timestamp, entry.value,
+                               key[1])
+
+    @staticmethod
+    def _entry_size(key, entry):
+        """Returns how many bytes an entry uses, not counting its metric
+           name, which is shared."""
+        return (sys.getsizeof(key) + sys.getsizeof(key[1])
+                + sys.getsizeof(entry) + sys.getsizeof(entry.value))
+
+    def _evict_one(self):
+        """Evicts an entry and returns the index of its slot in the clock."""
+        clock = self.clock
+        entries = self.entries
+        while True:
+            if self.hand >= len(clock):
+                self.hand = 0
+            key = clock[self.hand]
+            entry = entries.get(key)
+            if entry is not None:
+                if not entry.referenced:
+                    del entries[key]
+                    self.size -= self._entry_size(key, entry)
+                    self._unfile(key, entry)
+                    self.evictions += 1
+                    return self.hand
+                entry.referenced = False
+            self.hand += 1
+
+    def _compact(self):
+        """Removes the slots of the entries that are gone from the clock."""
+        self.clock = self.entries.keys()
+        for slot, key in enumerate(self.clock):
+            self.entries[key].slot = slot
+        self.hand = 0
+
+    def evict_older_than(self, cut_off, limit=None):
+        """Removes the entries whose value is older than the given time.
+
+        Only whole buckets of the time wheel are evicted, so entries in the
+        bucket of `cut_off' are kept until the cut off moves past it.
+
+        Args:
+          cut_off: A UNIX timestamp.
+          limit: If not None, the maximum number of entries to evict.
+        Returns: The number of entries evicted.
+        """
+        evicted = 0
+        last = cut_off // self.bucket_width
+        oldest = self.oldest()
+        while oldest is not None and oldest < last:
+            keys = self.wheel[oldest]
+            while keys:
+                if limit is not None and evicted >= limit:
+                    return evicted
+                key = keys.pop()
+                entry = self.entries.pop(key)
+                self.clock[entry.slot] = None
+                self.size -= self._entry_size(key, entry)
+                evicted += 1
+            del self.wheel[oldest]
+            self.size -= sys.getsizeof(keys)
+            oldest = self.oldest()
+        return evicted
+
+    def memory_footprint(self):
+        """Returns an estimate of how many bytes of memory we're using.
+
+        Metric names are not accounted for, they are shared.  This doesn't
+        look at the entries, so it's safe to call from any thread.
+        """
+        return (self.size + sys.getsizeof(self.entries)
+                + sys.getsizeof(self.clock) + sys.getsizeof(self.wheel)
+                + sys.getsizeof(self.buckets))
+
 
 class Collector(object):
     """A Collector is a script that is run that gathers some data
@@ -108,31 +754,35 @@ class Collector(object):
         self.dead = False
         self.mtime = mtime
         self.generation = GENERATION
-        self.buffer = ""
-        self.datalines = []
-        # Maps (metric, tags) to (value, repeated, line, timestamp) where:
-        #  value: Last value seen.
-        #  repeated: boolean, whether the last value was seen more than once.
-        #  line: The last line that was read from that collector.
-        #  timestamp: Time at which we saw the value for the first time.
-        # This dict is used to keep track of and remove duplicate values.
-        # Since it might grow unbounded (in case we see many different
+        self.framer = LineFramer()
+        self.datalines = deque()
+        # This cache is used to keep track of and remove duplicate values.
+        # Since it might grow large (in case we see many different
         # combinations of metrics and tags) someone needs to regularly call
         # evict_old_keys() to remove old entries.
-        self.values = {}
+        self.values = DedupCache(MAX_DEDUP_ENTRIES, DEDUP_BUCKET_WIDTH)
         self.lines_sent = 0
         self.lines_received = 0
         self.lines_invalid = 0
+        self.lines_dropped = 0
+        self.paused = False  # Whether we stopped reading from it for now.
+        self.adopted = False  # Whether the reader set it up, see adopt().
+        self.lane = None  # Its priority lane in the reader queue, if any.
+        # Estimates how many series it sent, if we look at them anyway.
+        self.cardinality = None
+        # When its number of series is limited, the ones we let through.
+        self.series = None
+        self.series_limit = 0
+        self.series_rejected = 0  # Lines of the series beyond the limit.
+        self.rejected = None  # The hashes of the series beyond the limit.
+        self.bytes_read = 0
+        self.reads = 0  # How many times we read from the collector.
         self.last_datapoint = int(time.time())
 
     def read(self):
         """Read bytes from our subprocess and store them in our temporary
            line storage buffer.  This needs to be non-blocking."""
 
-        # we have to use a buffer because sometimes the collectors
-        # will write out a bunch of data points at one time and we
-        # get some weird sized chunk.  This read call is non-blocking.
-
         # now read stderr for log messages, we could buffer here but since
         # we're just logging the messages, I don't care to
         try:
@@ -148,47 +798,64 @@ class Collector(object):
         except:
             LOG.exception('uncaught exception in stderr read')
 
-        # we have to use a buffer because sometimes the collectors will write
+        # we have to use a framer because sometimes the collectors will write
         # out a bunch of data points at one time and we get some weird sized
         # chunk.  This read call is non-blocking.
         try:
-            self.buffer += self.proc.stdout.read()
-            if len(self.buffer):
-                LOG.debug('reading %s, buffer now %d bytes',
-                          self.name, len(self.buffer))
+            self.reads += 1
+            out = self.proc.stdout.read()
+            if out:
+                LOG.debug('reading %s got %d bytes on stdout',
+                          self.name, len(out))
+                self.bytes_read += len(out)
         except IOError, (err, msg):
             if err != errno.EAGAIN:
                 raise
+            return
         except:
             # sometimes the process goes away in another thread and we don't
             # have it anymore, so log an error and bail
             LOG.exception('uncaught exception in stdout read')
             return
 
-        # iterate for each line we have
-        while self.buffer:
-            idx = self.buffer.find('\n')
-            if idx == -1:
-                break
-
-            # one full line is now found and we can pull it out of the buffer
-            line = self.buffer[0:idx].strip()
+        got_data = False
+        for line in self.framer.feed(out):
+            line = line.strip()
             if line:
                 self.datalines.append(line)
-                self.last_datapoint = int(time.time())
-            self.buffer = self.buffer[idx+1:]
+                got_data = True
+        if got_data:
+            self.last_datapoint = int(time.time())
 
     def collect(self):
         """Reads input from the collector and returns the lines up to whomever
            is calling us.  This is a generator that returns a line as it
            becomes available."""
 
+        datalines = self.datalines
         while self.proc is not None:
             self.read()
-            if not len(self.datalines):
+            if not datalines:
                 return
-            while len(self.datalines):
-                yield self.datalines.pop(0)
+            while datalines:
+                yield datalines.popleft()
+
+    def successor(self):
+        """Returns a new Collector to run this one again.  It keeps the
+           series this one sent, so that the limit on their number holds
+           across the runs of an interval collector, and so does their
+           count."""
+        col = Collector(self.name, self.interval, self.filename, self.mtime,
+                        self.lastspawn)
+        if self.adopted:
+            col.adopted = True
+            col.lane = self.lane
+            col.cardinality = self.cardinality
+            col.series = self.series
+            col.series_limit = self.series_limit
+            col.series_rejected = self.series_rejected
+            col.rejected = self.rejected
+        return col
 
     def shutdown(self):
         """Cleanly shut down the collector"""
@@ -210,17 +877,16 @@ class Collector(object):
             # we really don't want to die as we're trying to exit gracefully
             LOG.exception('ignoring uncaught exception while shutting down')
 
-    def evict_old_keys(self, cut_off):
+    def evict_old_keys(self, cut_off, limit=None):
         """Remove old entries from the cache used to detect duplicate values.
 
         Args:
           cut_off: A UNIX timestamp.  Any value that's older than this will be
             removed from the cache.
+          limit: If not None, the maximum number of entries to remove.
+        Returns: The number of entries removed.
         """
-        for key in self.values.keys():
-            time = self.values[key][3]
-            if time < cut_off:
-                del self.values[key]
+        return self.values.evict_older_than(cut_off, limit)
 
 
 class StdinCollector(Collector):
@@ -255,13 +921,687 @@ class StdinCollector(Collector):
         pass
 
 
+class CollectorWorker(object):
+    """A Python process that loads an interval collector once, then calls
+       its collect() function each time the collector is due, which saves
+       starting an interpreter and importing everything every time.
+
+       run() returns the worker itself, which then stands in for the Popen
+       object of that run of the collector: its output comes on `stdout'
+       and `stderr', poll() tells when collect() returned, and killing the
+       process group of `pid' kills the worker.  We talk to the worker
+       through a socket that is its stdin."""
+
+    def __init__(self, col):
+        self.filename = col.filename
+        self.mtime = col.mtime
+        self.control, child = socket.socketpair()
+        try:
+            self.proc = subprocess.Popen([sys.executable, TCOLLECTOR_PATH,
+                                          '--collector-worker', col.filename],
+                                         stdin=child.fileno(),
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE,
+                                         close_fds=True,
+                                         preexec_fn=os.setsid)
+        finally:
+            child.close()
+        self.control.setblocking(0)
+        self.pid = self.proc.pid
+        self.stdout = self.proc.stdout
+        self.stderr = self.proc.stderr
+        self.returncode = None
+
+    def run(self):
+        """Asks the worker to call collect() once."""
+        self.returncode = None
+        try:
+            self.control.sendall('collect\n')
+        except socket.error:
+            pass  # The worker is gone, poll() will tell.
+        return self
+
+    def poll(self):
+        """Returns the exit status of collect(), or None if it's running."""
+        if self.returncode is None:
+            try:
+                data = self.control.recv(4096)
+            except socket.error, (err, msg):
+                data = None
+                if err != errno.EAGAIN:
+                    data = ''  # The worker is gone.
+            if data:
+                self.returncode = int(data.split('\n', 1)[0])
+            elif data == '' or self.proc.poll() is not None:
+                # The worker died, e.g. because it got killed for taking
+                # too long.
+                self.returncode = self.proc.wait()
+        return self.returncode
+
+    def wait(self):
+        self.returncode = self.proc.wait()
+        return self.returncode
+
+    def stop(self):
+        """Makes the worker exit once it's done with what it's doing."""
+        self.control.close()
+
+
+class CollectorWorkerPool(object):
+    """Runs the interval collectors written in Python that have a collect()
+       function in CollectorWorkers, one per collector."""
+
+    def __init__(self):
+        self.workers = {}  # Maps a collector's name to its CollectorWorker.
+        self.collectable = {}  # Maps a filename to (mtime, has collect()).
+
+    def handles(self, col):
+        """Returns whether the given collector can run in a worker."""
+        if col.interval == 0 or not col.filename.endswith('.py'):
+            return False
+        cached = self.collectable.get(col.filename)
+        if cached is None or cached[0] != col.mtime:
+            try:
+                source = open(col.filename).read()
+            except IOError, e:
+                LOG.warning('Failed to read %s: %s', col.filename, e)
+                return False
+            cached = (col.mtime, COLLECT_FUNCTION_RE.search(source) is not None)
+            self.collectable[col.filename] = cached
+        return cached[1]
+
+    def run(self, col):
+        """Runs the given collector in its worker, starting the worker if
+           needed.
+
+        Returns: the CollectorWorker, to be used as the collector's `proc'.
+        """
+        worker = self.workers.get(col.name)
+        if worker is not None and (worker.mtime != col.mtime
+                                   or worker.proc.poll() is not None):
+            worker.stop()
+            worker = None
+        if worker is None:
+            worker = CollectorWorker(col)
+            self.workers[col.name] = worker
+            LOG.info('started a worker for %s (pid=%d)', col.name, worker.pid)
+        return worker.run()
+
+    def remove(self, name):
+        """Stops the worker of the given collector, if it has one."""
+        worker = self.workers.pop(name, None)
+        if worker is not None:
+            worker.stop()
+
+
+def collector_worker(filename):
+    """What a CollectorWorker runs: loads the collector in `filename' and
+       calls its collect() function each time tcollector asks for it on
+       stdin, then answers with the exit status of the collector."""
+    control = socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM)
+    # Collectors expect the directory they're in to be in sys.path.
+    sys.path.insert(0, os.path.dirname(filename))
+    name = re.sub(r'\W', '_', os.path.basename(filename)[:-3])
+    module = imp.load_source('collector_' + name, filename)
+    while control.recv(4096):
+        status = 0
+        try:
+            module.collect()
+        except SystemExit, e:
+            status = e.code or 0
+            if not isinstance(status, int):
+                print >>sys.stderr, status
+                status = 1
+        except:
+            traceback.print_exc()
+            status = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        control.sendall('%d\n' % status)
+        if status != 0:
+            return status
+    return 0
+
+
+class CollectorDirWatcher(object):
+    """Watches the collector directory, its interval directories and its
+       etc directory with inotify, so that we only look at the collectors
+       that changed, as soon as they change, instead of listing and
+       stat'ing everything every 15 seconds."""
+
+    def __init__(self, coldir):
+        """Constructor.
+
+        Raises: OSError if inotify is not available.
+        """
+        if ctypes is None:
+            raise OSError(errno.ENOSYS, 'ctypes is not available')
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.coldir = coldir
+        self.watches = {}  # Maps a watch descriptor to the interval it's
+                           # for, `etc', or None for the collector dir.
+        self.rescan = True  # Whether we have to look at everything.
+        self.buf = ''
+        self.closed = False
+        try:
+            self.watch(coldir, None)
+        except OSError:
+            self.close()
+            raise
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            os.close(self.fd)
+
+    def watch(self, path, what):
+        wd = self.libc.inotify_add_watch(self.fd, path, IN_WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, '%s: %s' % (path, os.strerror(err)))
+        self.watches[wd] = what
+
+    def watch_all(self):
+        """(Re)starts watching the subdirectories of the collector dir."""
+        for name in os.listdir(self.coldir):
+            if name.isdigit() or name == 'etc':
+                what = name.isdigit() and int(name) or name
+                path = os.path.join(self.coldir, name)
+                if os.path.isdir(path) and what not in self.watches.values():
+                    self.watch(path, what)
+
+    def read(self):
+        """Returns what changed since the last call.
+
+        Returns: a (collectors, etc) tuple, where `collectors' is a set of
+          (interval, name) of the collectors that may have changed, or None
+          if all of them must be looked at, and `etc' is whether the config
+          modules may have changed.
+        Raises: OSError if we can't watch a directory, e.g. EACCES, or
+          ENOSPC when we reached fs.inotify.max_user_watches.
+        """
+        try:
+            while True:
+                self.buf += os.read(self.fd, 65536)
+        except OSError, (err, msg):
+            if err != errno.EAGAIN:
+                raise
+        collectors = set()
+        etc = False
+        while len(self.buf) >= 16:
+            wd, mask, cookie, length = struct.unpack('iIII', self.buf[:16])
+            if len(self.buf) < 16 + length:
+                break
+            name = self.buf[16:16 + length].rstrip('\0')
+            self.buf = self.buf[16 + length:]
+            what = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            if mask & IN_Q_OVERFLOW or (what is None and name):
+                # We missed events, or something changed in the collector
+                # dir itself, like a new interval directory.
+                self.rescan = True
+            elif what == 'etc':
+                etc = True
+            elif what is not None and name and not mask & IN_ISDIR:
+                collectors.add((what, name))
+        if self.rescan:
+            self.rescan = False
+            self.watch_all()
+            return None, True
+        return collectors, etc
+
+
+class CollectorScheduler(object):
+    """Keeps the interval collectors in a heap ordered by when they're due
+       next, so that we can sleep until exactly then.
+
+       Each collector can have its runs delayed by a random offset of up to
+       `jitter' seconds (and at most its interval), fixed for the life of
+       the collector, so that the collectors that have the same interval
+       don't all start at once.  They can also be aligned on wall-clock
+       multiples of their interval, e.g. at the top of each minute for the
+       collectors in collectors/60, plus their offset."""
+
+    def __init__(self, jitter=0, align=False, overrides=None):
+        """Constructor.
+
+        Args:
+          jitter: Maximum offset of the collectors, in seconds.
+          align: Whether to align the collectors on their interval.
+          overrides: A dict of collector name -> (jitter, align) for the
+            collectors that don't use the defaults above.
+        """
+        self.jitter = jitter
+        self.align = align
+        self.overrides = overrides or {}
+        self.heap = []  # (when, name) tuples.
+        self.next_runs = {}  # Maps a collector's name to when it's due.
+        self.offsets = {}  # Maps a collector's name to its offset.
+        self.lag = 0  # How late we started the last collector, in seconds.
+        self.max_lag = 0  # The worst lag since the last pop_max_lag().
+
+    def add(self, col, now, due=None):
+        """Schedules the next run of the given collector.
+
+        Args:
+          col: The Collector.
+          now: The current time.
+          due: When its previous run was due, if it had one.
+        """
+        jitter, align = self.overrides.get(col.name, (self.jitter, self.align))
+        interval = col.interval
+        if col.name not in self.offsets:
+            self.offsets[col.name] = random.uniform(0, min(jitter, interval))
+        offset = self.offsets[col.name]
+        if due is not None:
+            when = due + interval
+            if when < now:
+                # We're late by more than an interval, skip the runs we
+                # missed rather than running it several times in a row.
+                when += math.ceil(float(now - when) / interval) * interval
+        elif align:
+            when = (math.ceil(float(now - offset) / interval) * interval
+                    + offset)
+        else:
+            when = now + offset
+        self.schedule(col.name, when)
+
+    def schedule(self, name, when):
+        """Makes the given collector due at `when' instead of whenever it
+           was due before."""
+        self.next_runs[name] = when
+        heapq.heappush(self.heap, (when, name))
+
+    def due(self, now):
+        """Returns a list of (name, when it was due) for the collectors due
+           at `now', which are no longer scheduled."""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            when, name = heapq.heappop(self.heap)
+            if self.next_runs.get(name) == when:
+                del self.next_runs[name]
+                due.append((name, when))
+        return due
+
+    def next_wakeup(self):
+        """Returns when the next collector is due, or None."""
+        while self.heap:
+            when, name = self.heap[0]
+            if self.next_runs.get(name) == when:
+                return when
+            heapq.heappop(self.heap)  # It was rescheduled since.
+        return None
+
+    def started(self, due, now):
+        """Records that a collector due at `due' was started at `now'."""
+        self.lag = max(0, now - due)
+        self.max_lag = max(self.max_lag, self.lag)
+
+    def pop_max_lag(self):
+        """Returns the worst lag since the last call."""
+        lag = self.max_lag
+        self.max_lag = 0
+        return lag
+
+
+class Zygote(object):
+    """A Python process that imported what our collectors commonly need and
+       forks the Python collectors on request.  This is a lot cheaper than
+       starting an interpreter for them and closing all our file
+       descriptors before, which is what subprocess.Popen does.
+
+       We send the zygote the name of the collector to run and the write
+       ends of its stdout and stderr pipes over a socket that is the
+       zygote's stdin.  It answers with the pid of the collector, and later
+       with its exit status, since only the zygote can wait for it."""
+
+    def __init__(self):
+        self.proc = None
+        self.control = None
+        self.processes = {}  # Maps a pid to its running ZygoteProcess.
+        self.spawned = []  # The pids the zygote told us about.
+        # Maps a pid to the exit status the zygote sent before we got to
+        # register the ZygoteProcess, for the collectors that die at once.
+        self.exited = {}
+        self.buf = ''
+
+    def start(self):
+        self.control, child = socket.socketpair()
+        try:
+            self.proc = subprocess.Popen([sys.executable, TCOLLECTOR_PATH,
+                                          '--zygote-helper'],
+                                         stdin=child.fileno(),
+                                         close_fds=True,
+                                         preexec_fn=os.setsid)
+        finally:
+            child.close()
+        LOG.info('started the zygote (pid=%d)', self.proc.pid)
+
+    def spawn(self, filename):
+        """Has the zygote fork the given Python collector.
+
+        Returns: the ZygoteProcess of the collector.
+        Raises: OSError if the zygote failed to do it.
+        """
+        if self.proc is None or self.proc.poll() is not None:
+            self.start()
+        out_read, out_write = os.pipe()
+        err_read, err_write = os.pipe()
+        try:
+            try:
+                _multiprocessing.sendfd(self.control.fileno(), out_write)
+                _multiprocessing.sendfd(self.control.fileno(), err_write)
+                self.control.sendall(filename + '\n')
+                deadline = time.time() + 15
+                while not self.spawned:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        raise OSError(errno.ETIMEDOUT, 'no answer')
+                    if not self.read_messages(timeout):
+                        raise OSError(errno.ECHILD, 'the zygote died')
+            finally:
+                os.close(out_write)
+                os.close(err_write)
+        except (OSError, socket.error), e:
+            os.close(out_read)
+            os.close(err_read)
+            self.kill()
+            raise OSError(e.errno, 'the zygote failed to spawn %s: %s'
+                          % (filename, e))
+        proc = ZygoteProcess(self, self.spawned.pop(0), out_read, err_read)
+        proc.returncode = self.exited.pop(proc.pid, None)
+        if proc.returncode is None:
+            self.processes[proc.pid] = proc
+        return proc
+
+    def read_messages(self, timeout):
+        """Reads what the zygote told us, waiting at most `timeout' seconds.
+
+        Returns: False if the zygote is gone.
+        """
+        self.control.settimeout(timeout)
+        while True:
+            try:
+                data = self.control.recv(4096)
+                break
+            except socket.timeout:
+                return True
+            except socket.error, (err, msg):
+                if err == errno.EINTR:
+                    continue  # A signal, e.g. SIGUSR1.
+                if err == errno.EAGAIN:
+                    return True
+                data = ''
+                break
+        if not data:
+            self.kill()
+            return False
+        lines = (self.buf + data).split('\n')
+        self.buf = lines.pop()
+        for line in lines:
+            fields = line.split()
+            if fields[0] == 'spawned':
+                self.spawned.append(int(fields[1]))
+            elif fields[0] == 'exited':
+                pid, status = int(fields[1]), int(fields[2])
+                proc = self.processes.pop(pid, None)
+                if proc is not None:
+                    proc.returncode = status
+                else:  # spawn() didn't register it yet.
+                    self.exited[pid] = status
+        return True
+
+    def kill(self):
+        """Gets rid of the zygote and of the collectors it forked, since
+           we can't know anymore when they exit."""
+        if self.proc is None:
+            return
+        LOG.error('lost the zygote, killing the collectors it forked')
+        self.control.close()
+        try:
+            os.kill(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.proc.wait()
+        self.proc = None
+        self.spawned = []
+        self.exited.clear()
+        self.buf = ''
+        for proc in self.processes.itervalues():
+            try:
+                kill(proc, signal.SIGKILL)
+            except OSError:
+                pass
+            proc.returncode = -signal.SIGKILL
+        self.processes.clear()
+
+
+class ZygoteProcess(object):
+    """Stands in for the Popen object of a collector forked by the Zygote."""
+
+    def __init__(self, zygote, pid, stdout, stderr):
+        self.zygote = zygote
+        self.pid = pid
+        self.stdout = os.fdopen(stdout, 'rb')
+        self.stderr = os.fdopen(stderr, 'rb')
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            self.zygote.read_messages(0)
+        return self.returncode
+
+    def wait(self):
+        while self.returncode is None:
+            self.zygote.read_messages(None)
+        return self.returncode
+
+
+def zygote():
+    """What the Zygote runs: imports what collectors commonly need, then
+       forks the collectors tcollector asks for on stdin, and tells it when
+       they exit."""
+    control = socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM)
+    for name in ZYGOTE_PRELOAD:
+        try:
+            __import__(name)
+        except ImportError:
+            pass
+    # Interrupt select() when a collector exits.
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    while True:
+        try:
+            readable = select.select([control], [], [], 1)[0]
+        except select.error, (err, msg):
+            if err != errno.EINTR:
+                raise
+            readable = []
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break  # No children.
+            if pid == 0:
+                break
+            if os.WIFSIGNALED(status):
+                status = -os.WTERMSIG(status)
+            else:
+                status = os.WEXITSTATUS(status)
+            control.sendall('exited %d %d\n' % (pid, status))
+        if not readable:
+            continue
+        if not control.recv(1, socket.MSG_PEEK):
+            return 0  # tcollector is gone.
+        stdout = _multiprocessing.recvfd(control.fileno())
+        stderr = _multiprocessing.recvfd(control.fileno())
+        filename = ''
+        while not filename.endswith('\n'):
+            data = control.recv(4096)
+            if not data:
+                return 0  # tcollector went away in the middle of a request.
+            filename += data
+        pid = os.fork()
+        if pid == 0:
+            control.close()
+            zygote_child(filename[:-1], stdout, stderr)
+        os.close(stdout)
+        os.close(stderr)
+        control.sendall('spawned %d\n' % pid)
+
+
+def zygote_child(filename, stdout, stderr):
+    """Runs the given collector in a process forked by the zygote."""
+    os.setsid()
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.dup2(stdout, 1)
+    os.dup2(stderr, 2)
+    for fd in (devnull, stdout, stderr):
+        os.close(fd)
+    sys.argv = [filename]
+    sys.path[0] = os.path.dirname(filename)
+    status = 0
+    try:
+        runpy.run_path(filename, run_name='__main__')
+    except SystemExit, e:
+        status = e.code or 0
+        if not isinstance(status, int):
+            print >>sys.stderr, status
+            status = 1
+    except:
+        traceback.print_exc()
+        status = 1
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(status)
+
+
+class CollectorPoller(object):
+    """Watches the stdout/stderr pipes of our collectors with epoll, so that
+       the ReaderThread only wakes up when one of them has data for us.
+
+       Pipes are added by spawn_collector() and removed by reap_children()
+       (from the main thread) or when the collector closes them on its end,
+       which epoll reports as a hangup.
+
+       The EventLoop also uses it to watch its connections to the TSDs."""
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.fds = {}      # Maps a file descriptor to its Collector.
+        self.watched = {}  # Maps a Collector to the fds we registered for it.
+        self.callbacks = {}  # Maps other file descriptors to a function.
+
+    def add(self, col):
+        """Starts watching the pipes of the given collector's process."""
+        fds = (col.proc.stdout.fileno(), col.proc.stderr.fileno())
+        for fd in fds:
+            self.fds[fd] = col
+            try:
+                self.epoll.register(fd, select.EPOLLIN | select.EPOLLPRI)
+            except IOError, (err, msg):
+                # A previous owner of this fd number was closed without us
+                # noticing, so just take over its registration.
+                if err != errno.EEXIST:
+                    raise
+                self.epoll.modify(fd, select.EPOLLIN | select.EPOLLPRI)
+        self.watched[col] = fds
+
+    def remove(self, col):
+        """Stops watching the pipes of the given collector."""
+        for fd in self.watched.pop(col, ()):
+            self._unregister(fd, col)
+
+    def pause(self, col):
+        """Stops reporting input from the given collector, until resume().
+           A collector that hangs up is still reported."""
+        self._modify(col, 0)
+
+    def resume(self, col):
+        self._modify(col, select.EPOLLIN | select.EPOLLPRI)
+
+    def _modify(self, col, events):
+        for fd in self.watched.get(col, ()):
+            if self.fds.get(fd) is col:
+                try:
+                    self.epoll.modify(fd, events)
+                except IOError:
+                    pass  # The fd was already closed, epoll forgot about it.
+
+    def watch(self, fd, callback):
+        """Calls `callback' from poll() whenever `fd' can be read."""
+        self.callbacks[fd] = callback
+        self.epoll.register(fd, select.EPOLLIN | select.EPOLLPRI)
+
+    def unwatch(self, fd):
+        """Stops watching a file descriptor given to watch()."""
+        if self.callbacks.pop(fd, None) is not None:
+            try:
+                self.epoll.unregister(fd)
+            except (IOError, ValueError):
+                pass
+
+    def _unregister(self, fd, col):
+        if self.fds.get(fd) is not col:
+            return  # Already gone, or the fd now belongs to someone else.
+        del self.fds[fd]
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, ValueError):
+            pass  # The fd was already closed, epoll forgot about it.
+
+    def poll(self, timeout):
+        """Waits up to `timeout' seconds for input from our collectors.
+
+        Returns: the list of collectors that have something to be read.
+        Collectors that hung up are returned one last time so that the
+        caller can drain what they left in the pipe.
+        """
+        try:
+            events = self.epoll.poll(timeout)
+        except IOError, (err, msg):
+            if err != errno.EINTR:
+                raise
+            return []
+        ready = []
+        for fd, event in events:
+            col = self.fds.get(fd)
+            if col is None:
+                callback = self.callbacks.get(fd)
+                if callback is not None:
+                    callback()
+                continue
+            if event & (select.EPOLLHUP | select.EPOLLERR):
+                self._unregister(fd, col)
+                fds = self.watched.get(col, ())
+                if not [f for f in fds if self.fds.get(f) is col]:
+                    self.watched.pop(col, None)
+            if col not in ready:
+                ready.append(col)
+        return ready
+
+
 class ReaderThread(threading.Thread):
     """The main ReaderThread is responsible for reading from the collectors
        and assuring that we always read from the input no matter what.
        All data read is put into the self.readerq Queue, which is
        consumed by the SenderThread."""
 
-    def __init__(self, dedupinterval, evictinterval):
+    def __init__(self, dedupinterval, evictinterval, poller=None, tags=None,
+                 high_water=0, lanes=None, max_series=0, series_limits=None):
         """Constructor.
             Args:
               dedupinterval: If a metric sends the same value over successive
@@ -273,16 +1613,60 @@ class ReaderThread(threading.Thread):
                 combination of (metric, tags).  Values older than
                 evictinterval will be removed from the cache to save RAM.
                 Invariant: evictinterval > dedupinterval
+              poller: An optional CollectorPoller.  If given, we wait for
+                input from the collectors it watches instead of reading
+                from all of them once a second.
+              tags: An optional dictionary of tags to add to every
+                datapoint that doesn't have them already.
+              high_water: If not 0, when this many lines are waiting in
+                the queue, we stop reading from the noisiest collectors,
+                so that they block writing to their full pipe instead of
+                us dropping what they send.  We read from them again once
+                the queue is down to half of that.
+              lanes: If given, a dict of collector name -> index of its
+                lane in LANES, and the datapoints of each priority lane
+                get their own part of the queue.  The collectors not in it
+                get the lane default_lane() gives them.
+              max_series: If not 0, how many distinct series (metric and
+                tags) a collector can send.  The datapoints of the series
+                it sends beyond that are rejected, those of the series it
+                sent before keep flowing.
+              series_limits: A dict of collector name -> limit for the
+                collectors that don't use max_series.  0 means no limit.
         """
         assert evictinterval > dedupinterval, "%r <= %r" % (evictinterval,
                                                             dedupinterval)
         super(ReaderThread, self).__init__()
 
-        self.readerq = ReaderQueue(MAX_READQ_SIZE)
+        self.lanes = lanes
+        self.max_series = max_series
+        self.series_limits = series_limits or {}
+        if lanes is None:
+            self.readerq = ReaderQueue(MAX_READQ_SIZE)
+        else:
+            self.readerq = LaneQueue(MAX_READQ_SIZE)
         self.lines_collected = 0
         self.lines_dropped = 0
         self.dedupinterval = dedupinterval
         self.evictinterval = evictinterval
+        self.poller = poller
+        self.tagger = None
+        if tags:
+            self.tagger = TagInjector(tags)
+        self.parse_time = METRICS.histogram('reader.parse_time_us',
+                                            PARSE_TIME_BUCKETS_US)
+        METRICS.gauge('reader.queue_depth', lambda: self.readerq.qsize())
+        # Name of the collector that last sent each metric, so errors the
+        # TSD reports about a datapoint can be traced back to a collector.
+        # Only kept when a sender needs it, see track_metric_owners().
+        self.metric_owners = None
+        self.high_water = high_water
+        self.next_pause = 0  # When we can pause more collectors.
+        self.window_start = 0  # When we started counting lines per second.
+        self.marks = {}  # Collector -> its lines_received at window_start.
+        self.rates = {}  # Collector -> lines it sent in the last window.
+        self.drops = {}  # Collector name -> lines dropped since we logged.
+        self.next_drop_log = 0
 
     def run(self):
         """Main loop for this thread.  Just reads from collectors,
@@ -292,48 +1676,81 @@ class ReaderThread(threading.Thread):
         LOG.debug("ReaderThread up and running")
 
         lastevict_time = 0
-        # we loop every second for now.  ideally we'll setup some
-        # select or other thing to wait for input on our children,
-        # while breaking out every once in a while to setup selects
-        # on new children.
+        # Without a poller we loop every second and try to read from every
+        # collector.  With one, we only wake up when a collector has some
+        # input for us, breaking out every second to evict old values.
+        # Old values are evicted a few at a time, at most once a second,
+        # so that we never stop reading for long.
         while ALIVE:
-            for col in all_living_collectors():
+            if self.poller is not None:
+                collectors = self.poller.poll(1)
+            else:
+                collectors = all_living_collectors()
+            for col in collectors:
+                if col.paused and self.poller is None:
+                    continue
                 for line in col.collect():
                     self.process_line(col, line)
+            if self.high_water:
+                self.check_backpressure()
 
             if self.dedupinterval != 0:  # if 0 we do not use dedup
                 now = int(time.time())
-                if now - lastevict_time > self.evictinterval:
+                if now != lastevict_time:
                     lastevict_time = now
-                    now -= self.evictinterval
-                    for col in all_collectors():
-                        col.evict_old_keys(now)
+                    self.evict_old_keys(now - self.evictinterval)
 
-            # and here is the loop that we really should get rid of, this
-            # just prevents us from spinning right now
-            time.sleep(1)
+            # when we're not waiting on the poller, this just prevents us
+            # from spinning
+            if self.poller is None:
+                time.sleep(1)
+
+    def evict_old_keys(self, cut_off):
+        """Evicts up to MAX_EVICTIONS_PER_SECOND values older than `cut_off'
+           from the dedup caches of our collectors."""
+        budget = MAX_EVICTIONS_PER_SECOND
+        for col in all_collectors():
+            budget -= col.evict_old_keys(cut_off, budget)
+            if budget <= 0:
+                break
 
     def process_line(self, col, line):
         """Parses the given line and appends the result to the reader queue."""
+        if self.lines_collected % PARSE_TIME_SAMPLING:
+            return self._process_line(col, line)
+        start = time.time()
+        self._process_line(col, line)
+        self.parse_time.observe((time.time() - start) * 1000000)
 
+    def _process_line(self, col, line):
         self.lines_collected += 1
+        if not col.adopted:
+            self.adopt(col)
+        lane = col.lane
 
         col.lines_received += 1
         if len(line) >= 1024:  # Limit in net.opentsdb.tsd.PipelineFactory
             LOG.warning('%s line too long: %s', col.name, line)
             col.lines_invalid += 1
             return
-        parsed = re.match('^([-_./a-zA-Z0-9]+)\s+' # Metric name.
-                          '(\d+)\s+'               # Timestamp.
-                          '(\S+?)'                 # Value (int or float).
-                          '((?:\s+[-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*)$', # Tags
-                          line)
+        parsed = parse_line(line)
         if parsed is None:
             LOG.warning('%s sent invalid data: %s', col.name, line)
             col.lines_invalid += 1
             return
-        metric, timestamp, value, tags = parsed.groups()
-        timestamp = int(timestamp)
+        metric, timestamp, value, tags = parsed
+        if self.tagger is not None:
+            extra = self.tagger.missing(tags)
+            if extra:
+                line += extra
+                tags += extra
+        key = (metric, tags)
+        if col.series is not None and key not in col.series:
+            if len(col.series) >= col.series_limit:
+                self.reject(col, key)
+                return
+            col.series.add(key)
+            col.cardinality.add(metric + tags)
 
         # De-dupe detection...  To reduce the number of points we send to the
         # TSD, we suppress sending values of metrics that don't change to
@@ -345,66 +1762,462 @@ class ReaderThread(threading.Thread):
         # slopes of graphs correct).
         #
         if self.dedupinterval != 0:  # if 0 we do not use dedup
-            key = (metric, tags)
-            if key in col.values:
+            entry = col.values.get(key)
+            if entry is None:
+                if col.series is None:  # Or it's in there already.
+                    col.cardinality.add(metric + tags)
+                if self.metric_owners is not None:
+                    self.remember_owner(metric, col)
+                col.values.add(metric, tags, value, timestamp)
+            else:
                 # if the timestamp isn't > than the previous one, ignore this value
-                if timestamp <= col.values[key][3]:
+                if timestamp <= entry.timestamp:
                     LOG.error("Timestamp out of order: metric=%s%s,"
                               " old_ts=%d >= new_ts=%d - ignoring data point"
                               " (value=%r, collector=%s)", metric, tags,
-                              col.values[key][3], timestamp, value, col.name)
+                              entry.timestamp, timestamp, value, col.name)
                     col.lines_invalid += 1
                     return
                 elif timestamp >= MAX_REASONABLE_TIMESTAMP:
                     LOG.error("Timestamp is too far out in the future: metric=%s%s"
                               " old_ts=%d, new_ts=%d - ignoring data point"
                               " (value=%r, collector=%s)", metric, tags,
-                              col.values[key][3], timestamp, value, col.name)
+                              entry.timestamp, timestamp, value, col.name)
                     return
 
                 # if this data point is repeated, store it but don't send.
-                # store the previous timestamp, so when/if this value changes
+                # keep the previous timestamp, so when/if this value changes
                 # we send the timestamp when this metric first became the current
                 # value instead of the last.  Fall through if we reach
                 # the dedup interval so we can print the value.
-                if (col.values[key][0] == value and
-                    (timestamp - col.values[key][3] < self.dedupinterval)):
-                    col.values[key] = (value, True, line, col.values[key][3])
+                if (entry.value == value and
+                    (timestamp - entry.timestamp < self.dedupinterval)):
+                    entry.repeated = True
+                    entry.last_timestamp = timestamp
                     return
 
                 # we might have to append two lines if the value has been the same
                 # for a while and we've skipped one or more values.  we need to
                 # replay the last value we skipped (if changed) so the jumps in
                 # our graph are accurate,
-                if ((col.values[key][1] or
-                    (timestamp - col.values[key][3] >= self.dedupinterval))
-                    and col.values[key][0] != value):
+                if ((entry.repeated or
+                    (timestamp - entry.timestamp >= self.dedupinterval))
+                    and entry.value != value):
                     col.lines_sent += 1
-                    if not self.readerq.nput(col.values[key][2]):
-                        self.lines_dropped += 1
-
-            # now we can reset for the next pass and send the line we actually
-            # want to send
-            # col.values is a dict of tuples, with the key being the metric and
-            # tags (essentially the same as wthat TSD uses for the row key).
-            # The array consists of:
-            # [ the metric's value, if this value was repeated, the line of data,
-            #   the value's timestamp that it last changed ]
-            col.values[key] = (value, False, line, timestamp)
+                    if not self.readerq.nput(col.values.line(key), lane):
+                        self.dropped(col)
+
+                # now we can reset for the next pass and send the line we
+                # actually want to send
+                col.values.update(key, entry, value, timestamp)
+        else:
+            if self.metric_owners is not None:
+                self.remember_owner(metric, col)
 
         col.lines_sent += 1
-        if not self.readerq.nput(line):
-            self.lines_dropped += 1
+        if not self.readerq.nput(line, lane):
+            self.dropped(col)
+
+    def adopt(self, col):
+        """Sets the priority lane and the series limit of a collector we
+           got a line from for the first time."""
+        col.adopted = True
+        col.series_limit = self.series_limits.get(col.name, self.max_series)
+        if col.series_limit:
+            col.series = set()
+            col.rejected = set()
+        # We only estimate the number of series of a collector when we have
+        # a set or a dedup cache to tell us which ones are new.
+        if col.series_limit or self.dedupinterval != 0:
+            col.cardinality = HyperLogLog()
+        if self.lanes is not None:
+            col.lane = self.lanes.get(col.name)
+            if col.lane is None:
+                col.lane = default_lane(col.name)
+
+    def reject(self, col, key):
+        """Counts a line of a series beyond the limit of its collector."""
+        col.series_rejected += 1
+        if col.series_rejected == 1:
+            LOG.error('%s sent more than %d series, rejecting the datapoints'
+                      ' of the new ones, e.g. %s%s', col.name,
+                      col.series_limit, key[0], key[1])
+        marker = hash(key)
+        if marker in col.rejected:
+            return
+        if len(col.rejected) >= MAX_REJECTED_SERIES:
+            col.rejected.clear()
+        col.rejected.add(marker)
+        col.cardinality.add(key[0] + key[1])
+
+    def dropped(self, col):
+        """Counts a line of the given collector that didn't fit in the
+           queue, and logs how many we dropped now and then."""
+        self.lines_dropped += 1
+        col.lines_dropped += 1
+        self.drops[col.name] = self.drops.get(col.name, 0) + 1
+        now = time.time()
+        if now < self.next_drop_log:
+            return
+        LOG.error('The reader queue is full, dropped %d lines in the last'
+                  ' %ds: %s', sum(self.drops.itervalues()), DROP_LOG_INTERVAL,
+                  ', '.join('%s=%d' % drop
+                            for drop in sorted(self.drops.iteritems())))
+        self.drops.clear()
+        self.next_drop_log = now + DROP_LOG_INTERVAL
+
+    def check_backpressure(self):
+        """Stops reading from the collectors that sent more than the average
+           in the last second when the queue is above its high-water mark,
+           and reads from them again once it's below the low-water mark.
+
+           With priority lanes, each lane has its own marks, in proportion
+           to its share of the queue, and only the collectors of the lanes
+           above their high-water mark are paused."""
+        now = time.time()
+        if now >= self.window_start + 1:
+            self.window_start = now
+            marks = {}
+            rates = {}
+            for col in all_living_collectors():
+                marks[col] = col.lines_received
+                rates[col] = col.lines_received - self.marks.get(col, 0)
+            self.marks = marks
+            self.rates = rates
+        full = set()  # The lanes above their high-water mark.
+        low = True  # Whether all the lanes are below their low-water mark.
+        for lane, depth, capacity in self.readerq.fills():
+            if depth * MAX_READQ_SIZE >= self.high_water * capacity:
+                full.add(lane)
+            if depth * MAX_READQ_SIZE * 2 > self.high_water * capacity:
+                low = False
+        depth = self.readerq.qsize()
+        if low:
+            resumed = [col for col in all_collectors() if col.paused]
+            for col in resumed:
+                self.resume(col)
+            if resumed:
+                LOG.warning('The reader queue is down to %d lines, reading'
+                            ' from %s again', depth,
+                            ', '.join(sorted(col.name for col in resumed)))
+            return
+        if not full or now < self.next_pause:
+            return
+        rates = [(rate, col) for col, rate in self.rates.iteritems()
+                 if rate > 0 and not col.paused and col.proc is not None
+                 and (col.lane or 0) in full]
+        if not rates:
+            return
+        average = sum(rate for rate, col in rates) / float(len(rates))
+        paused = [col for rate, col in rates if rate >= average]
+        for col in paused:
+            col.paused = True
+            if self.poller is not None:
+                self.poller.pause(col)
+        LOG.warning('The reader queue has %d lines, not reading from %s'
+                    ' for now', depth,
+                    ', '.join(sorted(col.name for col in paused)))
+        self.next_pause = now + 1  # Give it time to work.
+
+    def resume(self, col):
+        col.paused = False
+        col.last_datapoint = int(time.time())  # It wasn't its fault.
+        if self.poller is not None:
+            self.poller.resume(col)
+
+    def track_metric_owners(self):
+        """Starts remembering which collector sent each metric."""
+        if self.metric_owners is None:
+            self.metric_owners = {}
+
+    def remember_owner(self, metric, col):
+        if (metric not in self.metric_owners
+            and len(self.metric_owners) >= MAX_METRIC_OWNERS):
+            self.metric_owners.clear()  # Forget the metrics that are gone.
+        self.metric_owners[metric] = col.name
+
+    def metric_owner(self, metric):
+        """Returns the name of the collector that sent the given metric."""
+        if metric.startswith('tcollector.'):
+            return 'tcollector'
+        if self.metric_owners is None:
+            return 'unknown'
+        return self.metric_owners.get(metric, 'unknown')
+
+
+class ShardedQueue(object):
+    """Spreads the datapoints put in it over several ReaderQueues, one per
+       SenderThread, so that each time series always goes to the same one.
+
+       Series are assigned to queues with consistent hashing: every queue
+       owns many points on a ring of 32 bit hashes, and a series goes to
+       the queue owning the first point after the hash of its metric name
+       and tags."""
+
+    POINTS_PER_QUEUE = 64
+
+    def __init__(self, queues):
+        self.queues = queues
+        ring = []
+        for i in xrange(len(queues)):
+            for point in xrange(self.POINTS_PER_QUEUE):
+                ring.append((zlib.crc32('%d-%d' % (i, point)) & 0xffffffff, i))
+        ring.sort()
+        self.points = [point for point, i in ring]
+        self.owners = [i for point, i in ring]
+
+    def queue_index(self, line):
+        """Returns the index of the queue the given datapoint goes to."""
+        # The series is the metric name and the tags: all but the timestamp
+        # and the value.
+        parts = line.split(None, 3)
+        series = parts[0]
+        if len(parts) == 4:
+            series += parts[3]
+        i = bisect.bisect(self.points, zlib.crc32(series) & 0xffffffff)
+        return self.owners[i % len(self.owners)]
+
+    def nput(self, value, lane=0):
+        return self.queues[self.queue_index(value)].nput(value, lane)
+
+    def qsize(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    def fills(self):
+        fills = []
+        for queue in self.queues:
+            fills.extend(queue.fills())
+        return fills
+
+
+class DiskSpool(object):
+    """An append-only spool of datapoints on disk, for when the TSDs can't
+       be reached.
+
+       Lines are appended to segment files named spool.<number> in the
+       spool directory.  Segments are never modified once they're full,
+       and are read back through mmap, oldest first, then deleted.  When
+       the spool grows larger than its maximum size, its oldest segments
+       are dropped.  Segments left over by a previous run are replayed."""
+
+    def __init__(self, directory, max_bytes=DEFAULT_SPOOL_MAX_BYTES):
+        """Constructor.
+
+        Args:
+          directory: Where to store the segment files.  Created if needed.
+          max_bytes: The maximum size of all the segments together.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = max(1, min(64 * 1024 * 1024, max_bytes // 8))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segments = sorted(int(name[6:]) for name in os.listdir(directory)
+                               if name.startswith('spool.')
+                               and name[6:].isdigit())
+        self.size = sum(os.path.getsize(self._path(segment))
+                        for segment in self.segments)
+        self.writer = None   # The file of the segment we're appending to.
+        self.written = 0     # How many bytes are in that segment.
+        self.map = None      # The mmap of the segment we're replaying.
+        self.offset = 0      # Where we are in that segment.
+        self.lines_spooled = 0
+        self.lines_replayed = 0
+        self.bytes_dropped = 0  # Dropped because the spool was full.
+        if self.segments:
+            LOG.info('Found %d bytes of spooled data in %s',
+                     self.size, directory)
+
+    def _path(self, segment):
+        return os.path.join(self.directory, 'spool.%d' % segment)
+
+    def pending(self):
+        """Returns how many bytes are waiting to be replayed."""
+        return self.size - self.offset
+
+    def append(self, lines):
+        """Appends the given lines to the spool."""
+        if not lines:
+            return
+        data = ''.join(line + '\n' for line in lines)
+        if self.writer is None or self.written + len(data) > self.segment_bytes:
+            self._close_writer()
+            segment = self.segments and self.segments[-1] + 1 or 0
+            self.writer = open(self._path(segment), 'ab')
+            self.segments.append(segment)
+        self.writer.write(data)
+        self.writer.flush()
+        self.written += len(data)
+        self.size += len(data)
+        self.lines_spooled += len(lines)
+        while self.size > self.max_bytes and len(self.segments) > 1:
+            dropped = self._remove_oldest()
+            LOG.error('Spool is full, dropped %d bytes of datapoints', dropped)
+            self.bytes_dropped += dropped
+
+    def read(self, max_lines):
+        """Removes up to `max_lines' lines from the spool and returns them."""
+        lines = []
+        while len(lines) < max_lines and self.segments:
+            if self.map is None and not self._map_oldest():
+                continue
+            end = self.map.find('\n', self.offset)
+            while end != -1:
+                lines.append(self.map[self.offset:end])
+                self.offset = end + 1
+                if len(lines) >= max_lines:
+                    break
+                end = self.map.find('\n', self.offset)
+            if end == -1:
+                # Done with this segment, ignore any partial line at the end
+                # (which only a crash in the middle of a write can leave).
+                self._remove_oldest()
+        self.lines_replayed += len(lines)
+        return lines
+
+    def _map_oldest(self):
+        """Maps the oldest segment in memory.  Returns False if it's empty."""
+        if self.writer is not None and len(self.segments) == 1:
+            # The segment we're appending to can't change anymore once mapped.
+            self._close_writer()
+        f = open(self._path(self.segments[0]), 'rb')
+        try:
+            if not os.fstat(f.fileno()).st_size:
+                self._remove_oldest()
+                return False
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        self.offset = 0
+        return True
+
+    def _close_writer(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.written = 0
+
+    def _remove_oldest(self):
+        """Deletes the oldest segment and returns how many bytes it had
+           that were not replayed."""
+        if self.writer is not None and len(self.segments) == 1:
+            self._close_writer()
+        path = self._path(self.segments.pop(0))
+        size = os.path.getsize(path)
+        os.unlink(path)
+        self.size -= size
+        unread = size
+        if self.map is not None:
+            unread -= self.offset
+            self.map.close()
+            self.map = None
+            self.offset = 0
+        return unread
+
+
+class ResponseDrainer(threading.Thread):
+    """Reads everything the TSD sends back on the connection we send `put'
+       commands on, so that it doesn't pile up in our receive buffer.  The
+       TSD only answers a `put' when it fails, so each error is counted
+       against the metric it names, if any.  The SenderThread checks that
+       the TSD is alive with the `version' command, whose answer we look
+       for.  Anything else, like the rest of that answer, is ignored."""
+
+    def __init__(self, sock, count_error):
+        """Constructor.
+
+        Args:
+          sock: The socket connected to the TSD.
+          count_error: Called with the metric of each datapoint the TSD
+            refused, or None if we can't tell which metric it was.
+        """
+        super(ResponseDrainer, self).__init__()
+        self.daemon = True
+        self.sock = sock
+        self.count_error = count_error
+        self.answered = threading.Event()  # Set on answers to `version'.
+        self.answered_at = None  # When we last got an answer.
+        self.closed = False  # Whether the connection is gone.
+        self.stopping = False
+        self.buf = ''  # What we got of an incomplete line.
+
+    def run(self):
+        try:
+            while ALIVE and not self.stopping:
+                try:
+                    data = self.sock.recv(4096)
+                except socket.timeout:
+                    continue
+                except socket.error, msg:
+                    break
+                if not self.feed(data):
+                    break
+        finally:
+            self.close()
+
+    def feed(self, data):
+        """Processes data read from the TSD.  Without a thread of its own,
+           the drainer gets its data through this method.
+
+        Returns: False if the TSD closed the connection (no data).
+        """
+        if not data:
+            self.close()
+            return False
+        lines = (self.buf + data).split('\n')
+        self.buf = lines.pop()
+        for line in lines:
+            self.process_line(line)
+        return True
+
+    def close(self):
+        self.closed = True
+        self.answered.set()
+
+    def read(self):
+        """Reads what the TSD sent us, for when an EventLoop tells us the
+           socket is readable.
+
+        Returns: False if the TSD closed the connection.
+        """
+        try:
+            data = self.sock.recv(4096)
+        except socket.error, msg:
+            data = ''
+        return self.feed(data)
+
+    def process_line(self, line):
+        if not line.startswith('put:'):
+            if VERSION_REPLY_RE.match(line):
+                self.answered_at = time.time()
+                self.answered.set()
+            return
+        LOG.debug('TSD error: %s', line)
+        match = UNKNOWN_METRIC_RE.search(line)
+        self.count_error(match and match.group(1) or None)
+
+    def stop(self):
+        """Makes the thread exit without waiting for the socket to time out."""
+        self.stopping = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
 
 
 class SenderThread(threading.Thread):
     """The SenderThread is responsible for maintaining a connection
        to the TSD and sending the data we're getting over to it.  This
        thread is also responsible for doing any sort of emergency
-       buffering we might need to do if we can't establish a connection
-       and we need to spool to disk.  That isn't implemented yet."""
-
-    def __init__(self, reader, dryrun, hosts, self_report_stats, tags, reconnectinterval):
+       buffering we might need to do if we can't establish a connection,
+       in which case datapoints can be spooled to disk."""
+
+    def __init__(self, reader, dryrun, hosts, self_report_stats, tags,
+                 reconnectinterval, batch_lines=DEFAULT_BATCH_LINES,
+                 batch_bytes=DEFAULT_BATCH_BYTES,
+                 batch_linger_ms=DEFAULT_BATCH_LINGER_MS, spool=None,
+                 spool_replay_rate=DEFAULT_SPOOL_REPLAY_RATE, readerq=None,
+                 shard=None, stats_interval=DEFAULT_STATS_INTERVAL):
         """Constructor.
 
         Args:
@@ -416,25 +2229,85 @@ class SenderThread(threading.Thread):
             stats into the metrics reported to TSD, as if those metrics had
             been read from a collector.
           tags: A dictionary of tags to append for every data point.
+          batch_lines: Send a batch as soon as it has this many datapoints.
+          batch_bytes: Send a batch as soon as it has this many bytes.
+          batch_linger_ms: Send a batch at the latest this many milliseconds
+            after its first datapoint came in.
+          spool: An optional DiskSpool where datapoints go while we can't
+            connect to any TSD.
+          spool_replay_rate: How many spooled lines per second to send once
+            we're connected again.
+          readerq: The queue to get datapoints from, if not the reader's.
+          shard: When there are several SenderThreads, the index of this
+            one.  It then prefers the host at that index in `hosts'.
+          stats_interval: How often to report our own stats, in seconds.
         """
         super(SenderThread, self).__init__()
 
         self.dryrun = dryrun
         self.reader = reader
+        if readerq is None and reader is not None:
+            readerq = reader.readerq
+        self.readerq = readerq
+        self.shard = shard
         self.tags = sorted(tags.items())
-        self.hosts = hosts  # A list of (host, port) pairs.
-        # Randomize hosts to help even out the load.
-        random.shuffle(self.hosts)
+        self.tagger = TagInjector(tags)
+        # Whether the reader already added our tags to the datapoints.
+        self.tagged = getattr(reader, 'tagger', None) is not None
+        if shard is None:
+            self.hosts = hosts  # A list of (host, port) pairs.
+            # Randomize hosts to help even out the load.
+            random.shuffle(self.hosts)
+        else:
+            # Spread the shards evenly over the hosts.
+            shard %= len(hosts)
+            self.hosts = hosts[shard:] + hosts[:shard]
         self.blacklisted_hosts = set()  # The 'bad' (host, port) pairs.
+        # Held while changing blacklisted_hosts, which the StatusServer reads.
+        self.lock = threading.Lock()
         self.current_tsd = -1  # Index in self.hosts where we're at.
         self.host = None  # The current TSD host we've selected.
         self.port = None  # The port of the current TSD.
         self.tsd = None   # The socket connected to the aforementioned TSD.
+        self.drainer = None  # The ResponseDrainer reading from self.tsd.
         self.last_verify = 0
         self.reconnectinterval = reconnectinterval    # reconnectinterval in seconds.
         self.time_reconnect = 0                 # if reconnectinterval > 0, used to track the time.
         self.sendq = []
         self.self_report_stats = self_report_stats
+        self.batch_lines = batch_lines
+        self.batch_bytes = batch_bytes
+        self.batch_linger = batch_linger_ms / 1000.0
+        # How many batches were sent because of each of the limits above.
+        self.flushes = {'lines': 0, 'bytes': 0, 'linger': 0}
+        self.spool = spool
+        self.spool_replay_rate = spool_replay_rate
+        self.last_replay = 0  # When we last sent lines from the spool.
+        self.replay_rate = 0  # How many lines/s were replayed last time.
+        # How many datapoints the TSD refused, for each collector and for
+        # each metric.
+        self.put_errors = {}
+        self.metric_errors = {}
+        # State used when an EventLoop calls loop_step() instead of run().
+        self.loop = None
+        self.try_delay = 1
+        self.next_attempt = 0  # When to try connecting to a TSD again.
+        self.batch_start = None  # When the first line of the batch came.
+        self.batch_size = 0  # How many bytes are in the batch.
+        self.stats_interval = stats_interval
+        self.next_stats = time.time() + stats_interval
+        self.version_sent = None  # When we last asked the TSD its version.
+        tags = ''
+        if shard is not None:
+            tags = 'shard=%d' % shard
+        self.bytes_sent = METRICS.counter('sender.bytes_sent', tags)
+        self.send_latency = METRICS.histogram('sender.send_latency_ms',
+                                              LATENCY_BUCKETS_MS, tags)
+        self.batch_lines_sent = METRICS.histogram('sender.batch_lines',
+                                                  BATCH_BUCKETS_LINES, tags)
+        self.tsd_rtt = METRICS.histogram('sender.tsd_rtt_ms',
+                                         LATENCY_BUCKETS_MS, tags)
+        METRICS.gauge('sender.sendq_size', lambda: len(self.sendq), tags)
 
     def pick_connection(self):
         """Picks up a random host/port connection."""
@@ -449,7 +2322,8 @@ class SenderThread(threading.Thread):
         else:
             LOG.info('No more healthy hosts, retry with previously blacklisted')
             random.shuffle(self.hosts)
-            self.blacklisted_hosts.clear()
+            with self.lock:
+                self.blacklisted_hosts.clear()
             self.current_tsd = 0
             hostport = self.hosts[self.current_tsd]
 
@@ -463,36 +2337,34 @@ class SenderThread(threading.Thread):
            will be no more healthy hosts."""
         # FIXME: Enhance this naive strategy.
         LOG.info('Blacklisting %s:%s for a while', self.host, self.port)
-        self.blacklisted_hosts.add((self.host, self.port))
+        with self.lock:
+            self.blacklisted_hosts.add((self.host, self.port))
 
     def run(self):
         """Main loop.  A simple scheduler.  Loop waiting for 5
            seconds for data on the queue.  If there's no data, just
            loop and make sure our connection is still open.  If there
-           is data, wait 5 more seconds and grab all of the pending data and
-           send it.  A little better than sending every line as its
-           own packet."""
+           is data, keep adding to the batch until it's full or its first
+           datapoint has waited long enough, and send it.  A little better
+           than sending every line as its own packet."""
 
         errors = 0  # How many uncaught exceptions in a row we got.
         while ALIVE:
             try:
                 self.maintain_conn()
+                self.report_stats(time.time())
+                timeout = 5
+                if ALIVE and self.spool is not None and self.spool.pending():
+                    self.replay_spool()
+                    timeout = 1  # Come back soon to replay some more.
                 try:
-                    line = self.reader.readerq.get(True, 5)
+                    line = self.readerq.get(True, timeout)
                 except Empty:
+                    if self.sendq:  # Our own stats.
+                        self.send_data()
                     continue
                 self.sendq.append(line)
-                time.sleep(5)  # Wait for more data
-                while True:
-                    # prevents self.sendq fast growing in case of sending fails
-                    # in send_data()
-                    if len(self.sendq) > MAX_SENDQ_SIZE:
-                        break
-                    try:
-                        line = self.reader.readerq.get(False)
-                    except Empty:
-                        break
-                    self.sendq.append(line)
+                self.flushes[self.fill_batch()] += 1
 
                 if ALIVE:
                     self.send_data()
@@ -511,6 +2383,141 @@ class SenderThread(threading.Thread):
                 shutdown()
                 raise
 
+    def loop_step(self):
+        """Does what an iteration of run() does, but without ever waiting,
+           for when an EventLoop drives this sender instead of a thread.
+
+        Returns: The time by which this should be called again.
+        """
+        now = time.time()
+        if self.drainer is not None and self.drainer.closed:
+            LOG.warning('The TSD closed our connection')
+            self.close_conn()
+            self.blacklist_connection()
+        if not self.dryrun and not self.verify_conn():
+            if now >= self.next_attempt:
+                # Same backoff as maintain_conn(), minus the waiting.
+                self.try_delay *= 1 + random.random()
+                if self.try_delay > 600:
+                    self.try_delay *= 0.5
+                self.next_attempt = now + self.try_delay
+                self.try_connect()
+            if not self.verify_conn():
+                if self.spool is not None:
+                    lines = self.sendq
+                    self.sendq = []
+                    while True:
+                        try:
+                            lines.append(self.readerq.get(False))
+                        except Empty:
+                            break
+                    self.spool.append(lines)
+                    self.batch_start = None
+                    self.batch_size = 0
+                return self.next_attempt
+            self.try_delay = 1
+
+        self.report_stats(now)
+        wakeup = min(now + 5, self.next_stats)
+        if self.spool is not None and self.spool.pending():
+            self.replay_spool()
+            wakeup = now + 1  # Come back soon to replay some more.
+
+        # Add what's waiting to the batch, without waiting for more.
+        while (len(self.sendq) < self.batch_lines
+               and self.batch_size < self.batch_bytes):
+            try:
+                line = self.readerq.get(False)
+            except Empty:
+                break
+            self.sendq.append(line)
+            self.batch_size += len(line)
+        if not self.sendq:
+            self.batch_start = None
+            self.batch_size = 0
+            return wakeup
+        if self.batch_start is None:
+            self.batch_start = now
+        if len(self.sendq) >= self.batch_lines:
+            reason = 'lines'
+        elif self.batch_size >= self.batch_bytes:
+            reason = 'bytes'
+        elif now >= self.batch_start + self.batch_linger:
+            reason = 'linger'
+        else:
+            return min(wakeup, self.batch_start + self.batch_linger)
+        self.flushes[reason] += 1
+        self.send_data()
+        # Whatever we couldn't send starts the next batch.
+        self.batch_size = sum(len(line) for line in self.sendq)
+        self.batch_start = self.sendq and now or None
+        return now
+
+    def fill_batch(self):
+        """Moves datapoints from the reader queue to self.sendq until one of
+           the limits of the batch is reached.
+
+        Returns: Which limit was reached: 'lines', 'bytes' or 'linger'.
+        """
+        # self.sendq might still contain what we failed to send last time.
+        size = sum(len(line) for line in self.sendq)
+        deadline = time.time() + self.batch_linger
+        while True:
+            if len(self.sendq) >= self.batch_lines:
+                return 'lines'
+            if size >= self.batch_bytes:
+                return 'bytes'
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return 'linger'
+            try:
+                line = self.readerq.get(True, timeout)
+            except Empty:
+                return 'linger'
+            self.sendq.append(line)
+            size += len(line)
+
+    def replay_spool(self):
+        """Sends as many lines from the spool as the replay rate allows since
+           the last time we did it, and at most one batch of them."""
+        now = time.time()
+        elapsed = min(now - self.last_replay, 1)
+        count = min(int(self.spool_replay_rate * elapsed), self.batch_lines)
+        if count <= 0:
+            return
+        self.last_replay = now
+        lines = self.spool.read(count)
+        self.replay_rate = len(lines) / elapsed
+        LOG.debug('Replaying %d lines from the spool', len(lines))
+        self.sendq.extend(lines)
+        self.send_data()
+
+    def wait_and_spool(self, delay):
+        """Waits for the given number of seconds.  If we have a spool, moves
+           what we were about to send to it and keeps spooling what comes in
+           in the meantime, so the reader queue doesn't fill up."""
+        if self.spool is None:
+            time.sleep(delay)
+            return
+        self.spool.append(self.sendq)
+        self.sendq = []
+        deadline = time.time() + delay
+        while ALIVE:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                self.sendq.append(self.readerq.get(True, timeout))
+            except Empty:
+                pass
+            while len(self.sendq) < self.batch_lines:
+                try:
+                    self.sendq.append(self.readerq.get(False))
+                except Empty:
+                    break
+            self.spool.append(self.sendq)
+            self.sendq = []
+
     def verify_conn(self):
         """Periodically verify that our connection to the TSD is OK
            and that the TSD is alive/working."""
@@ -524,76 +2531,156 @@ class SenderThread(threading.Thread):
         # in case reconnect is activated, check if it's time to reconnect
         if self.reconnectinterval > 0 and self.time_reconnect < time.time() - self.reconnectinterval:
             # closing the connection and indicating that we need to reconnect.
-            try:
-                self.tsd.close()
-            except socket.error, msg:
-                pass    # not handling that
+            self.close_conn()
             self.time_reconnect = time.time()
             return False
             
-        # we use the version command as it is very low effort for the TSD
-        # to respond
-        LOG.debug('verifying our TSD connection is alive')
-        try:
-            self.tsd.sendall('version\n')
-        except socket.error, msg:
-            self.tsd = None
+        if not self.check_tsd():
+            self.close_conn()
             self.blacklist_connection()
             return False
 
-        bufsize = 4096
-        while ALIVE:
-            # try to read as much data as we can.  at some point this is going
-            # to block, but we have set the timeout low when we made the
-            # connection
+        # if we get here, we assume the connection is good
+        self.last_verify = time.time()
+        return True
+
+    def report_stats(self, now):
+        """Adds our own stats to the batch, every self.stats_interval
+           seconds.  This helps to see what is going on with the
+           tcollector."""
+        if now < self.next_stats:
+            return
+        self.next_stats = now + self.stats_interval
+        if not self.self_report_stats:
+            return
+        ts = int(now)
+        for name, tags, value in self.self_stats():
+            self.sendq.append('tcollector.%s %d %d %s%s'
+                              % (name, ts, value, tags,
+                                 self.tagger.missing(tags)))
+        if SCHEDULER is not None and not self.shard:
+            SCHEDULER.pop_max_lag()  # We reported it.
+
+    def check_tsd(self):
+        """Asks the TSD for its version to make sure it's alive.
+
+        Returns: False if the TSD didn't answer.
+        """
+        # we use the version command as it is very low effort for the TSD
+        # to respond.  The ResponseDrainer tells us when the answer arrived.
+        LOG.debug('verifying our TSD connection is alive')
+        if self.loop is not None:
+            # The EventLoop can't wait for the answer, so we check that the
+            # TSD answered the previous `version' instead.
+            alive = self.drainer.answered.isSet() and not self.drainer.closed
+            if alive:
+                self.tsd_answered()
+            self.drainer.answered.clear()
+            self.version_sent = time.time()
             try:
-                buf = self.tsd.recv(bufsize)
+                self.tsd.sendall('version\n')
             except socket.error, msg:
-                self.tsd = None
-                self.blacklist_connection()
                 return False
+            return alive
 
-            # If we don't get a response to the `version' request, the TSD
-            # must be dead or overloaded.
-            if not buf:
-                self.tsd = None
-                self.blacklist_connection()
-                return False
+        self.drainer.answered.clear()
+        self.version_sent = time.time()
+        try:
+            self.tsd.sendall('version\n')
+        except socket.error, msg:
+            return False
 
-            # Woah, the TSD has a lot of things to tell us...  Let's make
-            # sure we read everything it sent us by looping once more.
-            if len(buf) == bufsize:
+        # If we don't get a response to the `version' request, the TSD
+        # must be dead or overloaded.
+        if self.drainer.answered.wait(15) and not self.drainer.closed:
+            self.tsd_answered()
+            return True
+        return False
+
+    def tsd_answered(self):
+        """Records how long the TSD took to answer our last `version'."""
+        answered_at = self.drainer.answered_at
+        if answered_at is not None and self.version_sent is not None:
+            self.tsd_rtt.observe((answered_at - self.version_sent) * 1000)
+
+    def self_stats(self):
+        """Returns our own stats as a list of (metric, tags, value).
+
+           When there are several SenderThreads, the stats of the reader
+           and the collectors are only reported by the first one."""
+        shard = ''
+        if self.shard is not None:
+            shard = ' shard=%d' % self.shard
+        strs = []
+        for reason, count in self.flushes.iteritems():
+            strs.append(('sender.flushes', 'reason=' + reason + shard, count))
+        if self.spool is not None:
+            strs.append(('spool.bytes', shard, self.spool.pending()))
+            strs.append(('spool.segments', shard, len(self.spool.segments)))
+            strs.append(('spool.lines_spooled', shard,
+                         self.spool.lines_spooled))
+            strs.append(('spool.lines_replayed', shard,
+                         self.spool.lines_replayed))
+            strs.append(('spool.replay_rate', shard, self.replay_rate))
+            strs.append(('spool.bytes_dropped', shard,
+                         self.spool.bytes_dropped))
+        # The drainer thread may add to these while we iterate.
+        for name, count in self.put_errors.items():
+            strs.append(('sender.put_errors', 'collector=' + name + shard,
+                         count))
+        for metric, count in self.metric_errors.items():
+            strs.append(('sender.put_errors_by_metric', 'metric=' + metric
+                         + shard, count))
+        if isinstance(self.readerq, LaneQueue):
+            for name, depth in self.readerq.depths():
+                strs.append(('reader.lane_depth', 'lane=' + name + shard,
+                             depth))
+        if self.shard:
+            return strs
+
+        if SCHEDULER is not None:
+            strs.append(('scheduler.lag_ms', '', int(SCHEDULER.lag * 1000)))
+            strs.append(('scheduler.max_lag_ms', '',
+                         int(SCHEDULER.max_lag * 1000)))
+        strs.append(('reader.lines_collected', '', self.reader.lines_collected))
+        strs.append(('reader.lines_dropped', '', self.reader.lines_dropped))
+        # The reader and the main thread change the collectors while we
+        # look at them, so only go through a copy of the list and only read
+        # once what they may replace.
+        for col in COLLECTORS.values():
+            if col.proc is None:
                 continue
-
-            # If everything is good, send out our meta stats.  This
-            # helps to see what is going on with the tcollector.
-            if self.self_report_stats:
-                strs = [
-                        ('reader.lines_collected',
-                         '', self.reader.lines_collected),
-                        ('reader.lines_dropped',
-                         '', self.reader.lines_dropped)
-                       ]
-
-                for col in all_living_collectors():
-                    strs.append(('collector.lines_sent', 'collector='
-                                 + col.name, col.lines_sent))
-                    strs.append(('collector.lines_received', 'collector='
-                                 + col.name, col.lines_received))
-                    strs.append(('collector.lines_invalid', 'collector='
-                                 + col.name, col.lines_invalid))
-
-                ts = int(time.time())
-                strout = ["tcollector.%s %d %d %s"
-                          % (x[0], ts, x[2], x[1]) for x in strs]
-                for string in strout:
-                    self.sendq.append(string)
-
-            break  # TSD is alive.
-
-        # if we get here, we assume the connection is good
-        self.last_verify = time.time()
-        return True
+            strs.append(('collector.lines_sent', 'collector='
+                         + col.name, col.lines_sent))
+            strs.append(('collector.lines_received', 'collector='
+                         + col.name, col.lines_received))
+            strs.append(('collector.lines_invalid', 'collector='
+                         + col.name, col.lines_invalid))
+            strs.append(('collector.lines_dropped', 'collector='
+                         + col.name, col.lines_dropped))
+            strs.append(('collector.paused', 'collector='
+                         + col.name, int(col.paused)))
+            if col.lane is not None:
+                strs.append(('collector.lane', 'collector=' + col.name,
+                             col.lane))
+            cardinality = col.cardinality
+            if cardinality is not None:
+                strs.append(('collector.series', 'collector=' + col.name,
+                             cardinality.estimate()))
+            strs.append(('collector.series_rejected', 'collector='
+                         + col.name, col.series_rejected))
+            strs.append(('collector.dedup_entries', 'collector='
+                         + col.name, len(col.values)))
+            strs.append(('collector.dedup_bytes', 'collector='
+                         + col.name, col.values.memory_footprint()))
+            strs.append(('collector.dedup_evictions', 'collector='
+                         + col.name, col.values.evictions))
+            strs.append(('collector.bytes_read', 'collector='
+                         + col.name, col.bytes_read))
+            strs.append(('collector.reads', 'collector='
+                         + col.name, col.reads))
+        strs.extend(METRICS.datapoints())
+        return strs
 
     def maintain_conn(self):
         """Safely connect to the TSD and ensure that it's up and
@@ -618,82 +2705,434 @@ class SenderThread(threading.Thread):
             if try_delay > 600:
                 try_delay *= 0.5
             LOG.debug('SenderThread blocking %0.2f seconds', try_delay)
-            time.sleep(try_delay)
+            self.wait_and_spool(try_delay)
 
             # Now actually try the connection.
-            self.pick_connection()
+            self.try_connect()
+
+    def try_connect(self):
+        """Picks the next TSD and tries to connect to it."""
+        self.pick_connection()
+        try:
+            addresses = socket.getaddrinfo(self.host, self.port,
+                                           socket.AF_UNSPEC,
+                                           socket.SOCK_STREAM, 0)
+        except socket.gaierror, e:
+            # Don't croak on transient DNS resolution issues.
+            if e[0] in (socket.EAI_AGAIN, socket.EAI_NONAME,
+                        socket.EAI_NODATA):
+                LOG.debug('DNS resolution failure: %s: %s', self.host, e)
+                return
+            raise
+        self.connect(addresses)
+        if not self.tsd:
+            LOG.error('Failed to connect to %s:%d', self.host, self.port)
+            self.blacklist_connection()
+
+    def connect(self, addresses):
+        """Connects to the first of the given addresses (as returned by
+           getaddrinfo) that accepts our connection, and sets self.tsd."""
+        for family, socktype, proto, canonname, sockaddr in addresses:
+            try:
+                self.tsd = socket.socket(family, socktype, proto)
+                self.tsd.settimeout(15)
+                self.tsd.connect(sockaddr)
+                # if we get here it connected
+                LOG.debug('Connection to %s was successful'%(str(sockaddr)))
+                self.drainer = ResponseDrainer(self.tsd, self.count_put_error)
+                if self.loop is None:
+                    self.drainer.start()
+                else:
+                    self.loop.watch(self.tsd, self.drainer.read)
+                    # So that the first check_tsd() passes.
+                    self.drainer.answered.set()
+                break
+            except socket.error, msg:
+                LOG.warning('Connection attempt failed to %s:%d: %s',
+                            self.host, self.port, msg)
+            self.tsd.close()
+            self.tsd = None
+
+    def close_conn(self):
+        """Closes our connection to the TSD, if any."""
+        if self.drainer is not None:
+            if self.loop is not None:
+                self.loop.unwatch(self.drainer.sock)
+            self.drainer.stop()
+            self.drainer = None
+        if self.tsd is not None:
             try:
-                addresses = socket.getaddrinfo(self.host, self.port,
-                                               socket.AF_UNSPEC,
-                                               socket.SOCK_STREAM, 0)
-            except socket.gaierror, e:
-                # Don't croak on transient DNS resolution issues.
-                if e[0] in (socket.EAI_AGAIN, socket.EAI_NONAME,
-                            socket.EAI_NODATA):
-                    LOG.debug('DNS resolution failure: %s: %s', self.host, e)
-                    continue
-                raise
-            for family, socktype, proto, canonname, sockaddr in addresses:
-                try:
-                    self.tsd = socket.socket(family, socktype, proto)
-                    self.tsd.settimeout(15)
-                    self.tsd.connect(sockaddr)
-                    # if we get here it connected
-                    LOG.debug('Connection to %s was successful'%(str(sockaddr)))
-                    break
-                except socket.error, msg:
-                    LOG.warning('Connection attempt failed to %s:%d: %s',
-                                self.host, self.port, msg)
                 self.tsd.close()
-                self.tsd = None
-            if not self.tsd:
-                LOG.error('Failed to connect to %s:%d', self.host, self.port)
-                self.blacklist_connection()
+            except socket.error:
+                pass    # not handling that
+        self.tsd = None
+
+    def count_put_error(self, metric):
+        """Counts a datapoint of the given metric that the TSD refused."""
+        name = 'unknown'
+        if metric is None:
+            metric = 'unknown'
+        elif self.reader is not None:
+            name = self.reader.metric_owner(metric)
+        self.put_errors[name] = self.put_errors.get(name, 0) + 1
+        if (metric not in self.metric_errors
+            and len(self.metric_errors) >= MAX_ERROR_METRICS):
+            metric = 'other'
+        self.metric_errors[metric] = self.metric_errors.get(metric, 0) + 1
 
     def add_tags_to_line(self, line):
-        for tag, value in self.tags:
-            if ' %s=' % tag not in line:
-                line += ' %s=%s' % (tag, value)
-        return line
+        if self.tagged:
+            return line
+        return self.tagger.add(line)
 
     def send_data(self):
-        """Sends outstanding data in self.sendq to the TSD in one operation."""
-
-        # construct the output string
-        out = ''
+        """Sends outstanding data in self.sendq to the TSD."""
 
-        # in case of logging we use less efficient variant
-        if LOG.level == logging.DEBUG:
-            for line in self.sendq:
-                line = "put %s" % self.add_tags_to_line(line)
-                out += line + "\n"
-                LOG.debug('SENDING: %s', line)
-        else:
-            out = "".join("put %s\n" % self.add_tags_to_line(line) for line in self.sendq)
-
-        if not out:
+        if not self.sendq:
             LOG.debug('send_data no data?')
             return
+        self.batch_lines_sent.observe(len(self.sendq))
+        start = time.time()
 
         # try sending our data.  if an exception occurs, just error and
         # try sending again next time.
         try:
-            if self.dryrun:
-                print out
+            if LOG.level == logging.DEBUG:
+                # in case of logging we use less efficient variant
+                out = ''
+                for line in self.sendq:
+                    line = "put %s" % self.add_tags_to_line(line)
+                    out += line + "\n"
+                    LOG.debug('SENDING: %s', line)
+                if self.dryrun:
+                    print out
+                else:
+                    self.tsd.sendall(out)
+                    self.bytes_sent.inc(len(out))
+                self.sendq = []
             else:
-                self.tsd.sendall(out)
-            self.sendq = []
+                self.send_chunks()
         except socket.error, msg:
             LOG.error('failed to send data: %s', msg)
-            try:
-                self.tsd.close()
-            except socket.error:
-                pass
-            self.tsd = None
+            self.close_conn()
             self.blacklist_connection()
+            return
+        self.send_latency.observe((time.time() - start) * 1000)
+
+    def send_chunks(self):
+        """Sends self.sendq to the TSD SEND_CHUNK_LINES datapoints at a time,
+           resuming after partial writes without copying what's left.  The
+           datapoints are removed from self.sendq as soon as they're sent,
+           so if the connection breaks we only send the rest again.
+
+        Raises: socket.error if the TSD is gone.
+        """
+        sendq = self.sendq
+        add = not self.tagged and self.tagger.add
+        sent = 0  # How many datapoints were completely sent.
+        try:
+            while sent < len(sendq):
+                lines = sendq[sent:sent + SEND_CHUNK_LINES]
+                if add:
+                    lines = [add(line) for line in lines]
+                chunk = 'put %s\n' % '\nput '.join(lines)
+                if self.dryrun:
+                    sys.stdout.write(chunk)
+                else:
+                    offset = 0
+                    try:
+                        while offset < len(chunk):
+                            offset += self.tsd.send(buffer(chunk, offset))
+                    except socket.error:
+                        # The TSD has the lines we got out completely, don't
+                        # send them again after reconnecting.
+                        sent += chunk.count('\n', 0, offset)
+                        self.bytes_sent.inc(offset)
+                        raise
+                    self.bytes_sent.inc(len(chunk))
+                sent += len(lines)
+        finally:
+            del sendq[:sent]
+
+
+class HttpSenderThread(SenderThread):
+    """A SenderThread that sends datapoints as JSON to the /api/put endpoint
+       of the TSDs, over persistent HTTP connections, instead of using the
+       telnet-style `put' command."""
+
+    def __init__(self, reader, dryrun, hosts, self_report_stats, tags,
+                 reconnectinterval, http_batch_size=DEFAULT_HTTP_BATCH_SIZE,
+                 http_gzip=False, http_chunked=False, **kwargs):
+        """Constructor.
+
+        Args:
+          http_batch_size: How many datapoints to send in each request.
+          http_gzip: If true, gzip the body of the requests.
+          http_chunked: If true, send the body of the requests with the
+            chunked transfer encoding, as we encode it, instead of first
+            making all of it.
+          The other arguments are the same as SenderThread's.
+        """
+        super(HttpSenderThread, self).__init__(reader, dryrun, hosts,
+                                               self_report_stats, tags,
+                                               reconnectinterval, **kwargs)
+        self.http_batch_size = http_batch_size
+        self.http_gzip = http_gzip
+        self.http_chunked = http_chunked
+        if reader is not None:
+            reader.track_metric_owners()
+
+    def connect(self, addresses):
+        """Opens an HTTP connection to the current TSD.  The connection is
+           kept alive between requests as long as the TSD lets us."""
+        self.tsd = httplib.HTTPConnection(self.host, self.port, timeout=15)
+        try:
+            self.tsd.connect()
+            LOG.debug('Connection to %s:%d was successful',
+                      self.host, self.port)
+        except socket.error, msg:
+            LOG.warning('Connection attempt failed to %s:%d: %s',
+                        self.host, self.port, msg)
+            self.tsd.close()
+            self.tsd = None
+
+    def check_tsd(self):
+        """Asks the TSD for its version over HTTP to make sure it's alive."""
+        LOG.debug('verifying our TSD connection is alive')
+        start = time.time()
+        try:
+            self.tsd.request('GET', '/api/version')
+            response = self.tsd.getresponse()
+            response.read()
+        except (socket.error, httplib.HTTPException), e:
+            LOG.warning('Failed to get the version of %s:%d: %s',
+                        self.host, self.port, e)
+            return False
+        self.tsd_rtt.observe((time.time() - start) * 1000)
+        return response.status == 200
 
-        # FIXME: we should be reading the result at some point to drain
-        # the packets out of the kernel's queue
+    def to_datapoint(self, line):
+        """Turns a datapoint line into the dict /api/put expects, with our
+           tags added.
+
+        Raises: ValueError if the line isn't a valid datapoint.  JSON has no
+          NaN nor infinity, the TSD would refuse the whole request.
+        """
+        fields = line.split()
+        tags = dict(tag.split('=', 1) for tag in fields[3:])
+        if not self.tagged:
+            for tag, value in self.tags:
+                tags.setdefault(tag, value)
+        value = fields[2]
+        try:
+            value = int(value)
+        except ValueError:
+            value = float(value)
+            if math.isnan(value) or math.isinf(value):
+                raise ValueError('%r is not a finite number' % fields[2])
+        return {'metric': fields[0], 'timestamp': int(fields[1]),
+                'value': value, 'tags': tags}
+
+    def send_data(self):
+        """Sends outstanding data in self.sendq to the TSD, in as many
+           requests of at most self.http_batch_size datapoints as needed."""
+        if self.sendq:
+            self.batch_lines_sent.observe(len(self.sendq))
+        while self.sendq:
+            count = min(len(self.sendq), self.http_batch_size)
+            datapoints = []
+            for line in self.sendq[:count]:
+                try:
+                    datapoints.append(self.to_datapoint(line))
+                except ValueError:
+                    LOG.error('Not sending invalid datapoint: %s', line)
+            if self.dryrun:
+                print ''.join(self.encode(datapoints))
+            elif datapoints:
+                try:
+                    self.post(self.encode(datapoints))
+                except (socket.error, httplib.HTTPException), e:
+                    LOG.error('failed to send data: %s', e)
+                    self.close_conn()
+                    self.blacklist_connection()
+                    return
+            del self.sendq[:count]
+
+    def encode(self, datapoints):
+        """Yields the JSON array of the given datapoints, in pieces of at
+           most SEND_CHUNK_LINES datapoints."""
+        for i in xrange(0, len(datapoints), SEND_CHUNK_LINES):
+            yield ((i and ',' or '[')
+                   + ','.join(json.dumps(datapoint) for datapoint
+                              in datapoints[i:i + SEND_CHUNK_LINES]))
+        yield ']'
+
+    def post(self, pieces):
+        """POSTs the given pieces of JSON to /api/put and counts the
+           datapoints the TSD refused.
+
+        Raises: httplib.HTTPException if the TSD failed to handle the request
+          as a whole, so that it should be sent again.
+        """
+        headers = {'Content-Type': 'application/json'}
+        compressor = None
+        if self.http_gzip:
+            # A window of 16+15 bits has zlib write a gzip header.
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            headers['Content-Encoding'] = 'gzip'
+        start = time.time()
+        if self.http_chunked:
+            headers['Transfer-Encoding'] = 'chunked'
+            self.tsd.putrequest('POST', '/api/put?details')
+            for header, value in headers.iteritems():
+                self.tsd.putheader(header, value)
+            self.tsd.endheaders()
+            size = 0
+            for piece in pieces:
+                if compressor is not None:
+                    piece = compressor.compress(piece)
+                size += self.send_chunk(piece)
+            if compressor is not None:
+                size += self.send_chunk(compressor.flush())
+            self.tsd.send('0\r\n\r\n')
+        else:
+            body = ''.join(pieces)
+            if compressor is not None:
+                body = compressor.compress(body) + compressor.flush()
+            self.tsd.request('POST', '/api/put?details', body, headers)
+            size = len(body)
+        LOG.debug('SENT: %s bytes', size)
+        response = self.tsd.getresponse()
+        result = response.read()
+        self.send_latency.observe((time.time() - start) * 1000)
+        self.bytes_sent.inc(size)
+        if response.status in (200, 204):
+            return
+        if response.status != 400:
+            raise httplib.HTTPException('HTTP error %d from the TSD: %s'
+                                        % (response.status, result[:1024]))
+        # Some datapoints were refused.  Sending them again won't help.
+        try:
+            errors = json.loads(result)['errors']
+        except (ValueError, KeyError, TypeError):
+            LOG.error('TSD refused datapoints: %s', result[:1024])
+            errors = [{}]
+        for error in errors:
+            LOG.debug('TSD refused datapoint: %s', error)
+            self.count_put_error((error.get('datapoint') or {}).get('metric'))
+
+    def send_chunk(self, data):
+        """Sends a chunk of a request with the chunked transfer encoding.
+
+        Returns: The size of the data.
+        """
+        if data:  # An empty chunk would end the request.
+            self.tsd.send('%x\r\n%s\r\n' % (len(data), data))
+        return len(data)
+
+
+class EventLoop(object):
+    """Runs the reader, the senders and the housekeeping of main_loop() in
+       a single thread, which only wakes up when a collector or a TSD sent
+       us something, or when a timer or a batch is due.  This is what
+       --runtime=loop uses instead of a ReaderThread, SenderThreads and
+       main_loop() sleeping between their iterations."""
+
+    def __init__(self, poller, reader, senders):
+        self.poller = poller
+        self.reader = reader
+        self.senders = senders
+        self.timers = []  # A heap of (when, sequence number, callback).
+        self.sequence = 0  # Keeps timers due at the same time in order.
+        for sender in senders:
+            sender.loop = self
+
+    def call_at(self, when, callback):
+        """Calls `callback' once it's time `when'."""
+        self.sequence += 1
+        heapq.heappush(self.timers, (when, self.sequence, callback))
+
+    def call_every(self, interval, callback):
+        """Calls `callback' now and then every `interval' seconds."""
+        def repeat():
+            self.call_at(time.time() + interval, repeat)
+            callback()
+        self.call_at(time.time(), repeat)
+
+    def watch(self, sock, callback):
+        """Calls `callback' whenever `sock' can be read, until it returns
+           False."""
+        fd = sock.fileno()
+        def ready():
+            if not callback():
+                self.poller.unwatch(fd)
+        self.poller.watch(fd, ready)
+
+    def unwatch(self, sock):
+        """Stops watching a socket given to watch()."""
+        try:
+            self.poller.unwatch(sock.fileno())
+        except socket.error:
+            pass  # Already closed, so epoll forgot about it.
+
+    def room(self):
+        """Returns how many more lines the reader queue can take before
+           one of its lanes reaches the high-water mark, or fills up without
+           backpressure."""
+        high_water = self.reader.high_water or MAX_READQ_SIZE
+        return min(high_water * capacity // MAX_READQ_SIZE - depth
+                   for lane, depth, capacity in self.reader.readerq.fills())
+
+    def drain(self):
+        """Lets the senders take what they can from the reader queue, for
+           when the collectors send more in one pass than it can hold."""
+        for sender in self.senders:
+            while True:
+                depth = sender.readerq.qsize()
+                sender.loop_step()
+                if not depth or sender.readerq.qsize() >= depth:
+                    break
+
+    def run(self):
+        errors = 0  # How many uncaught exceptions in a row we got.
+        wakeup = time.time()
+        while ALIVE:
+            try:
+                if self.timers:
+                    wakeup = min(wakeup, self.timers[0][0])
+                # Unlike the ReaderThread, nobody empties the reader queue
+                # while we read, so drain it whenever it gets full.  If that
+                # didn't make room, room goes negative and we don't try again
+                # until the next pass.
+                room = self.room()
+                for col in self.poller.poll(max(0, wakeup - time.time())):
+                    for line in col.collect():
+                        self.reader.process_line(col, line)
+                        room -= 1
+                        if not room:
+                            self.drain()
+                            if self.reader.high_water:
+                                self.reader.check_backpressure()
+                            room = self.room()
+                if self.reader.high_water:
+                    self.reader.check_backpressure()
+                now = time.time()
+                while self.timers and self.timers[0][0] <= now:
+                    heapq.heappop(self.timers)[2]()
+                handle_signals()
+                wakeup = now + 1
+                for sender in self.senders:
+                    wakeup = min(wakeup, sender.loop_step())
+                errors = 0
+            except (ArithmeticError, EOFError, EnvironmentError, LookupError,
+                    ValueError), e:
+                errors += 1
+                if errors > MAX_UNCAUGHT_EXCEPTIONS:
+                    shutdown()
+                    raise
+                LOG.exception('Uncaught exception in EventLoop, ignoring')
+                time.sleep(1)
+                wakeup = time.time()
 
 
 def setup_logging(logfile=DEFAULT_LOG, max_bytes=None, backup_count=None):
@@ -738,6 +3177,24 @@ def parse_cmdline(argv):
     parser.add_option('--no-tcollector-stats', dest='no_tcollector_stats',
                       default=False, action='store_true',
                       help='Prevent tcollector from reporting its own stats to TSD')
+    parser.add_option('--status-port', dest='status_port', type='int',
+                      default=0, metavar='PORT',
+                      help='Serve the state of tcollector and its own stats '
+                           'over HTTP, on this port of 127.0.0.1: /status as '
+                           'JSON, /metrics in the Prometheus text format.  '
+                           'Disabled by default.')
+    parser.add_option('--profile-dir', dest='profile_dir', default='/tmp',
+                      metavar='DIR',
+                      help='Where to write the profiles.  Sending SIGUSR1 '
+                           'to tcollector starts profiling it, sending it '
+                           'again writes where the time went in a file of '
+                           'this directory.  SIGUSR2 logs the stacks of all '
+                           'the threads and the state of tcollector. '
+                           'default=%default')
+    parser.add_option('--stats-interval', dest='stats_interval', type='int',
+                      default=DEFAULT_STATS_INTERVAL, metavar='SECONDS',
+                      help='How often tcollector reports its own stats. '
+                           'default=%default')
     parser.add_option('-s', '--stdin', dest='stdin', action='store_true',
                       default=False,
                       help='Run once, read and dedup data points from stdin.')
@@ -754,6 +3211,36 @@ def parse_cmdline(argv):
     parser.add_option('-P', '--pidfile', dest='pidfile',
                       default='/var/run/tcollector.pid',
                       metavar='FILE', help='Write our pidfile')
+    parser.add_option('--backpressure', dest='backpressure',
+                      action='store_true', default=False,
+                      help='When the reader queue fills up, stop reading '
+                           'from the noisiest collectors until it drains, '
+                           'so that they wait instead of us dropping their '
+                           'datapoints.')
+    parser.add_option('--queue-high-water', dest='high_water', type='int',
+                      default=DEFAULT_QUEUE_HIGH_WATER, metavar='LINES',
+                      help='With --backpressure, how many lines can be '
+                           'waiting in the reader queue before we stop '
+                           'reading from the noisiest collectors.  With '
+                           '--priority-lanes, each lane gets the same '
+                           'proportion of its share of the queue. '
+                           'default=%default')
+    parser.add_option('--priority-lanes', dest='priority_lanes',
+                      action='store_true', default=False,
+                      help='Give each class of collectors its own part of '
+                           'the reader queue, and send the datapoints of '
+                           'the most important ones first when the TSDs '
+                           'can\'t keep up: %s.  The collectors that report '
+                           'on the host itself are in the system lane, '
+                           'those whose name ends in _bridge in the bridge '
+                           'lane, and the others in the application lane.'
+                           % ', '.join('%s (weight %d, %d%% of the queue)'
+                                       % (name, weight, share * 100)
+                                       for name, weight, share in LANES))
+    parser.add_option('--collector-lane', dest='collector_lanes',
+                      action='append', default=[], metavar='NAME:LANE',
+                      help='With --priority-lanes, put the collector of the '
+                           'given name in the given lane.  Can be repeated.')
     parser.add_option('--dedup-interval', dest='dedupinterval', type='int',
                       default=300, metavar='DEDUPINTERVAL',
                       help='Number of seconds in which successive duplicate '
@@ -765,6 +3252,80 @@ def parse_cmdline(argv):
                       help='Number of seconds after which to remove cached '
                            'values of old data points to save memory. '
                            'default=%default')
+    parser.add_option('--batch-lines', dest='batch_lines', type='int',
+                      default=DEFAULT_BATCH_LINES, metavar='LINES',
+                      help='Maximum number of datapoints sent to the TSD in '
+                           'one batch. default=%default')
+    parser.add_option('--batch-bytes', dest='batch_bytes', type='int',
+                      default=DEFAULT_BATCH_BYTES, metavar='BYTES',
+                      help='Maximum number of bytes of datapoints sent to '
+                           'the TSD in one batch. default=%default')
+    parser.add_option('--batch-linger-ms', dest='batch_linger_ms',
+                      type='int', default=DEFAULT_BATCH_LINGER_MS,
+                      metavar='MS',
+                      help='How long a datapoint can wait for the batch it '
+                           'is in to fill up before it gets sent anyway, in '
+                           'milliseconds. default=%default')
+    parser.add_option('--protocol', dest='protocol', default='telnet',
+                      choices=('telnet', 'http'),
+                      help='How to send datapoints to the TSDs: with telnet '
+                           'style put commands, or as JSON to the /api/put '
+                           'HTTP endpoint. default=%default')
+    parser.add_option('--http-batch-size', dest='http_batch_size',
+                      type='int', default=DEFAULT_HTTP_BATCH_SIZE, metavar='N',
+                      help='With --protocol=http, maximum number of '
+                           'datapoints per request. default=%default')
+    parser.add_option('--http-gzip', dest='http_gzip', action='store_true',
+                      default=False,
+                      help='With --protocol=http, gzip the requests.  Needs '
+                           'OpenTSDB 2.2 or later.')
+    parser.add_option('--http-chunked', dest='http_chunked',
+                      action='store_true', default=False,
+                      help='With --protocol=http, send the requests with the '
+                           'chunked transfer encoding, as they are encoded.  '
+                           'Needs tsd.http.request.enable_chunked on the '
+                           'TSDs, which then accept larger requests.')
+    parser.add_option('--tsd-connections', dest='tsd_connections',
+                      type='int', default=1, metavar='N',
+                      help='Number of connections to open to the TSDs, '
+                           'each connection being preferably to a different '
+                           'TSD.  Each time series always goes through the '
+                           'same connection. default=%default')
+    parser.add_option('--spool-dir', dest='spool_dir', metavar='DIR',
+                      help='Directory where datapoints are spooled while no '
+                           'TSD can be reached.  Spooling is disabled by '
+                           'default.')
+    parser.add_option('--spool-max-bytes', dest='spool_max_bytes', type='int',
+                      default=DEFAULT_SPOOL_MAX_BYTES, metavar='BYTES',
+                      help='Maximum size of the spool, the oldest datapoints '
+                           'are dropped beyond that. default=%default')
+    parser.add_option('--spool-replay-rate', dest='spool_replay_rate',
+                      type='int', default=DEFAULT_SPOOL_REPLAY_RATE,
+                      metavar='LINES',
+                      help='How many spooled datapoints per second to send '
+                           'once a TSD is reachable again. default=%default')
+    parser.add_option('--dedup-max-entries', dest='dedup_max_entries',
+                      type='int', default=MAX_DEDUP_ENTRIES,
+                      metavar='ENTRIES',
+                      help='Maximum number of (metric, tags) combinations '
+                           'remembered per collector to suppress duplicate '
+                           'datapoints, the least recently used ones are '
+                           'forgotten first.  Use zero for no limit. '
+                           'default=%default')
+    parser.add_option('--max-series', dest='max_series', type='int',
+                      default=0, metavar='SERIES',
+                      help='Maximum number of distinct series (metric and '
+                           'tags) each collector can send.  The datapoints '
+                           'of the new series a collector sends beyond that '
+                           'are rejected, while those of its known series '
+                           'keep flowing.  The limit holds across the runs '
+                           'of a collector.  Use zero for no limit. '
+                           'default=%default')
+    parser.add_option('--collector-max-series', dest='collector_max_series',
+                      action='append', default=[], metavar='NAME:SERIES',
+                      help='Use the given limit instead of --max-series for '
+                           'the collector of the given name.  Can be '
+                           'repeated.')
     parser.add_option('--max-bytes', dest='max_bytes', type='int',
                       default=64 * 1024 * 1024,
                       help='Maximum bytes per a logfile.')
@@ -779,6 +3340,59 @@ def parse_cmdline(argv):
                            'the TSD hostname reconnects itself. This is useful'
                            'when the hostname is a multiple A record (RRDNS).'
                            )
+    parser.add_option('--reader-mode', dest='reader_mode', type='choice',
+                      choices=('epoll', 'sleep'),
+                      default=hasattr(select, 'epoll') and 'epoll' or 'sleep',
+                      help='How the reader waits for input from collectors: '
+                           '"epoll" wakes up as soon as a collector writes '
+                           'something, "sleep" reads from all collectors '
+                           'once a second. default=%default')
+    parser.add_option('--python-collectors', dest='python_collectors',
+                      type='choice', choices=('exec', 'worker'),
+                      default='exec',
+                      help='How to run the interval collectors written in '
+                           'Python that have a collect() function: "exec" '
+                           'starts them anew each time, "worker" keeps a '
+                           'process per collector that calls collect() each '
+                           'time. default=%default')
+    parser.add_option('--collector-jitter', dest='collector_jitter',
+                      type='float', default=0, metavar='SECONDS',
+                      help='Delay each interval collector by a random '
+                           'offset of up to this many seconds, so that the '
+                           'collectors with the same interval don\'t all run '
+                           'at once. default=%default')
+    parser.add_option('--align-collectors', dest='align_collectors',
+                      action='store_true', default=False,
+                      help='Run interval collectors on wall-clock multiples '
+                           'of their interval (plus their jitter).')
+    parser.add_option('--collector-schedule', dest='collector_schedules',
+                      action='append', default=[],
+                      metavar='NAME:JITTER[:align]',
+                      help='Use the given jitter, and alignment if "align" '
+                           'is given, for the collector of the given name '
+                           'instead of --collector-jitter and '
+                           '--align-collectors.  Can be repeated.')
+    parser.add_option('--discovery', dest='discovery', type='choice',
+                      choices=('inotify', 'poll'), default='inotify',
+                      help='How to notice new, changed and removed '
+                           'collectors and config modules: "inotify" looks '
+                           'at what changed as soon as it does, "poll" '
+                           'looks at everything every 15 seconds.  Falls '
+                           'back to "poll" when inotify is not available. '
+                           'default=%default')
+    parser.add_option('--zygote', dest='zygote', action='store_true',
+                      default=False,
+                      help='Fork Python collectors from a process that '
+                           'already imported what they commonly need, '
+                           'instead of starting each of them from scratch.')
+    parser.add_option('--runtime', dest='runtime', type='choice',
+                      choices=('threads', 'loop'), default='threads',
+                      help='"threads" reads from the collectors, sends to '
+                           'each TSD connection and restarts collectors in '
+                           'separate threads; "loop" does all of this in a '
+                           'single event loop, which needs --reader-mode='
+                           'epoll and doesn\'t work with --stdin. '
+                           'default=%default')
     (options, args) = parser.parse_args(args=argv[1:])
     if options.dedupinterval < 0:
         parser.error('--dedup-interval must be at least 0 seconds')
@@ -787,6 +3401,69 @@ def parse_cmdline(argv):
                      '--dedup-interval')
     if options.reconnectinterval < 0:
         parser.error('--reconnect-interval must be at least 0 seconds')
+    if not 0 < options.batch_lines <= MAX_SENDQ_SIZE:
+        parser.error('--batch-lines must be between 1 and %d' % MAX_SENDQ_SIZE)
+    if options.batch_bytes <= 0:
+        parser.error('--batch-bytes must be greater than 0')
+    if options.batch_linger_ms < 0:
+        parser.error('--batch-linger-ms must be at least 0')
+    if not 0 < options.high_water <= MAX_READQ_SIZE:
+        parser.error('--queue-high-water must be between 1 and %d'
+                     % MAX_READQ_SIZE)
+    if options.stats_interval <= 0:
+        parser.error('--stats-interval must be greater than 0')
+    if not 0 <= options.status_port <= 65535:
+        parser.error('--status-port must be between 0 (disabled) and 65535')
+    if options.http_batch_size < 1:
+        parser.error('--http-batch-size must be at least 1')
+    if options.tsd_connections < 1:
+        parser.error('--tsd-connections must be at least 1')
+    if options.spool_max_bytes <= 0:
+        parser.error('--spool-max-bytes must be greater than 0')
+    if options.spool_replay_rate <= 0:
+        parser.error('--spool-replay-rate must be greater than 0')
+    if options.dedup_max_entries < 0:
+        parser.error('--dedup-max-entries must be at least 0')
+    if options.max_series < 0:
+        parser.error('--max-series must be at least 0')
+    options.series_limits = {}
+    for collector_max in options.collector_max_series:
+        name, _, limit = collector_max.rpartition(':')
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = -1
+        if not name or limit < 0:
+            parser.error('invalid --collector-max-series: %r' % collector_max)
+        options.series_limits[name] = limit
+    if options.collector_jitter < 0:
+        parser.error('--collector-jitter must be at least 0')
+    options.schedules = {}
+    for schedule in options.collector_schedules:
+        fields = schedule.split(':')
+        try:
+            jitter = float(fields[1])
+        except (IndexError, ValueError):
+            jitter = -1
+        if jitter < 0 or len(fields) > 3 or fields[2:] not in ([], ['align']):
+            parser.error('invalid --collector-schedule: %r' % schedule)
+        options.schedules[fields[0]] = (jitter, fields[2:] == ['align'])
+    options.lanes = None
+    if options.priority_lanes:
+        options.lanes = {}
+    for collector_lane in options.collector_lanes:
+        name, _, lane = collector_lane.rpartition(':')
+        if not name or lane not in LANE_NAMES:
+            parser.error('invalid --collector-lane: %r' % collector_lane)
+        if options.lanes is None:
+            parser.error('--collector-lane needs --priority-lanes')
+        options.lanes[name] = LANE_NAMES.index(lane)
+    if options.zygote and _multiprocessing is None:
+        parser.error('--zygote is not supported on this platform')
+    if options.runtime == 'loop' and (options.stdin
+                                      or options.reader_mode != 'epoll'):
+        parser.error('--runtime=loop needs --reader-mode=epoll and doesn\'t'
+                     ' work with --stdin')
     # We cannot write to stdout when we're a daemon.
     if (options.daemonize or options.max_bytes) and not options.backup_count:
         options.backup_count = 1
@@ -832,9 +3509,277 @@ def setup_python_path(collector_dir):
     LOG.debug('Set PYTHONPATH to %r', pythonpath)
 
 
+class StatusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves /status, the state of tcollector as JSON, and /metrics, our
+       own stats in the Prometheus text format."""
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path in ('/', '/status'):
+            body = json.dumps(self.server.status.status(), indent=2,
+                              sort_keys=True)
+            content_type = 'application/json'
+        elif path == '/metrics':
+            body = self.server.status.exposition()
+            content_type = 'text/plain; version=0.0.4'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOG.debug('%s - ' + format, self.client_address[0], *args)
+
+
+class StatusServer(threading.Thread):
+    """Serves what's going on inside of tcollector over HTTP, on the
+       loopback interface, so that we can look at it even when no TSD can
+       be reached."""
+
+    def __init__(self, port, reader, senders, address='127.0.0.1'):
+        """Constructor.
+
+        Args:
+          port: The port to listen on, 0 to pick one.
+          reader: The ReaderThread.
+          senders: The list of SenderThreads.
+          address: The address to listen on.
+        Raises: socket.error if we can't listen on the port.
+        """
+        super(StatusServer, self).__init__()
+        self.daemon = True
+        self.reader = reader
+        self.senders = senders
+        self.server = BaseHTTPServer.HTTPServer((address, port),
+                                                StatusHandler)
+        self.server.status = self
+        self.port = self.server.server_address[1]
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def status(self):
+        return daemon_status(self.reader, self.senders)
+
+    def exposition(self):
+        """Returns our own stats, the ones we send to the TSD, in the
+           Prometheus text format."""
+        lines = []
+        for sender in self.senders:
+            for name, tags, value in sender.self_stats():
+                name = 'tcollector_' + name.replace('.', '_')
+                labels = []
+                for tag in tags.split():
+                    key, val = tag.split('=', 1)
+                    if key == 'le' and val == 'inf':
+                        val = '+Inf'
+                    labels.append('%s="%s"' % (key, prometheus_escape(val)))
+                if labels:
+                    name += '{%s}' % ','.join(labels)
+                lines.append('%s %s\n' % (name, value))
+        return ''.join(lines)
+
+
+def prometheus_escape(value):
+    """Escapes a label value for the Prometheus text format."""
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class StackSampler(threading.Thread):
+    """A sampling profiler: looks at the stack of all the other threads
+       every `interval' seconds, and counts how many times each stack was
+       seen.  Unlike a profiler using sys.setprofile(), this costs nothing
+       to the threads it looks at, and nothing at all when it's not
+       running."""
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        super(StackSampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.stacks = {}  # Maps a collapsed stack to how many times we saw it.
+        self.samples = 0
+        self.stopping = False
+
+    def run(self):
+        while not self.stopping:
+            self.sample()
+            time.sleep(self.interval)
+
+    def sample(self):
+        names = thread_names()
+        me = threading.current_thread().ident
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name,
+                                             os.path.basename(code.co_filename),
+                                             code.co_firstlineno))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stack.reverse()
+            stack = ';'.join(stack)
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def stop(self):
+        self.stopping = True
+        self.join()
+
+    def write(self, path):
+        """Writes the stacks we saw in the `collapsed' format that flame
+           graph tools read: one stack per line, from the thread to the
+           innermost frame, separated by semicolons, then the count.
+           Refuses to overwrite anything, since the directory is usually
+           /tmp and we are usually root."""
+        f = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                              0600), 'w')
+        try:
+            for stack, count in sorted(self.stacks.iteritems()):
+                f.write('%s %d\n' % (stack, count))
+        finally:
+            f.close()
+
+
+def thread_names():
+    """Returns a dict of thread ident -> name, with the name of the class of
+       our own threads, like ReaderThread."""
+    names = {}
+    for thread in threading.enumerate():
+        name = type(thread).__name__
+        if name.startswith('_') or name == 'Thread':
+            name = thread.name
+        names[thread.ident] = name
+    return names
+
+
+def toggle_profiler(profile_dir):
+    """Starts profiling, or stops and writes where the time went in a file
+       of the given directory.  Called when we get SIGUSR1."""
+    global PROFILER
+    if PROFILER is None:
+        PROFILER = StackSampler()
+        PROFILER.start()
+        LOG.warning('Profiling started, send SIGUSR1 again to stop')
+        return
+    profiler = PROFILER
+    PROFILER = None
+    profiler.stop()
+    path = os.path.join(profile_dir, 'tcollector-%d-%d.stacks'
+                        % (os.getpid(), time.time()))
+    try:
+        profiler.write(path)
+    except EnvironmentError, e:
+        LOG.error('Failed to write the profile: %s', e)
+        return
+    LOG.warning('Profiling stopped, wrote %d samples to %s',
+                profiler.samples, path)
+
+
+def defer_signal(signum, frame):
+    """Signal handler that leaves the work to handle_signals(), which the
+       main loop calls, since it may be too much for a signal handler,
+       like joining a thread."""
+    PENDING_SIGNALS.append(signum)
+
+
+def handle_signals():
+    """Does what the signals defer_signal() got call for."""
+    while PENDING_SIGNALS:
+        SIGNAL_HANDLERS[PENDING_SIGNALS.pop(0)]()
+
+
+def dump_state(reader, senders):
+    """Logs the stack of every thread and the state of the collectors, the
+       reader and the senders.  Called when we get SIGUSR2."""
+    names = thread_names()
+    for ident, frame in sys._current_frames().items():
+        LOG.warning('Stack of thread %s:\n%s', names.get(ident, ident),
+                    ''.join(traceback.format_stack(frame)).rstrip())
+    LOG.warning('State:\n%s', json.dumps(daemon_status(reader, senders),
+                                         indent=2, sort_keys=True))
+
+
+def daemon_status(reader, senders):
+    """Returns the state of the collectors, the reader and the senders."""
+    collectors = {}
+    # Like in SenderThread.self_stats(), other threads change these.
+    for col in COLLECTORS.values():
+        proc = col.proc
+        cardinality = col.cardinality
+        collectors[col.name] = {
+            'pid': proc is not None and proc.pid or None,
+            'interval': col.interval,
+            'filename': col.filename,
+            'dead': col.dead,
+            'lastspawn': col.lastspawn,
+            'last_datapoint': col.last_datapoint,
+            'lines_received': col.lines_received,
+            'lines_sent': col.lines_sent,
+            'lines_invalid': col.lines_invalid,
+            'lines_dropped': col.lines_dropped,
+            'paused': col.paused,
+            'lane': col.lane is not None and LANE_NAMES[col.lane] or None,
+            'bytes_read': col.bytes_read,
+            'reads': col.reads,
+            'dedup_entries': len(col.values),
+            'series': (cardinality.estimate()
+                       if cardinality is not None else None),
+            'series_limit': col.series_limit,
+            'series_rejected': col.series_rejected,
+        }
+    sender_states = []
+    for sender in senders:
+        with sender.lock:
+            blacklisted = sorted(sender.blacklisted_hosts)
+        lanes = None
+        if isinstance(sender.readerq, LaneQueue):
+            lanes = dict(sender.readerq.depths())
+        sender_states.append({
+            'shard': sender.shard,
+            'host': sender.host,
+            'port': sender.port,
+            'connected': sender.tsd is not None,
+            'blacklisted': ['%s:%d' % hostport for hostport in blacklisted],
+            'queue_depth': sender.readerq.qsize(),
+            'lane_depths': lanes,
+            'sendq_size': len(sender.sendq),
+            'spool_bytes': (sender.spool is not None
+                            and sender.spool.pending() or 0),
+            'put_errors': sum(sender.put_errors.values()),
+        })
+    return {
+        'time': time.time(),
+        'collectors': collectors,
+        'reader': {
+            'queue_depth': reader.readerq.qsize(),
+            'lines_collected': reader.lines_collected,
+            'lines_dropped': reader.lines_dropped,
+        },
+        'senders': sender_states,
+    }
+
+
 def main(argv):
     """The main tcollector entry point and loop."""
 
+    # This is how CollectorWorkers and the Zygote run us.
+    if argv[1:2] == ['--collector-worker']:
+        return collector_worker(argv[2])
+    if argv[1:2] == ['--zygote-helper']:
+        return zygote()
+
     options, args = parse_cmdline(argv)
     if options.daemonize:
         daemonize()
@@ -869,15 +3814,46 @@ def main(argv):
 
     setup_python_path(options.cdir)
 
+    global MAX_DEDUP_ENTRIES, DEDUP_BUCKET_WIDTH
+    MAX_DEDUP_ENTRIES = options.dedup_max_entries
+    DEDUP_BUCKET_WIDTH = min(DEDUP_BUCKET_WIDTH,
+                             max(1, options.evictinterval // 100))
+
     # gracefully handle death for normal termination paths and abnormal
     atexit.register(shutdown)
     for sig in (signal.SIGTERM, signal.SIGINT):
         signal.signal(sig, shutdown_signal)
 
     # at this point we're ready to start processing, so start the ReaderThread
-    # so we can have it running and pulling in data for us
-    reader = ReaderThread(options.dedupinterval, options.evictinterval)
-    reader.start()
+    # so we can have it running and pulling in data for us.  The stdin
+    # collector doesn't have any pipe we could wait on.
+    global POLLER, SCHEDULER, WATCHER, WORKERS, ZYGOTE
+    SCHEDULER = CollectorScheduler(options.collector_jitter,
+                                   options.align_collectors, options.schedules)
+    if options.reader_mode == 'epoll' and not options.stdin:
+        POLLER = CollectorPoller()
+    if options.python_collectors == 'worker':
+        WORKERS = CollectorWorkerPool()
+    if options.zygote:
+        ZYGOTE = Zygote()
+    reader = ReaderThread(options.dedupinterval, options.evictinterval, POLLER,
+                          tags, options.backpressure and options.high_water,
+                          options.lanes, options.max_series,
+                          options.series_limits)
+    # With more than one connection to the TSDs, each SenderThread gets its
+    # own queue.
+    nsenders = options.tsd_connections
+    queues = [reader.readerq]
+    if nsenders > 1:
+        queue_class = ReaderQueue
+        if options.lanes is not None:
+            queue_class = LaneQueue
+        queues = [queue_class(max(1, MAX_READQ_SIZE // nsenders))
+                  for i in xrange(nsenders)]
+        reader.readerq = ShardedQueue(queues)
+    threads = options.runtime == 'threads'
+    if threads:
+        reader.start()
 
     # prepare list of (host, port) of TSDs given on CLI
     if not options.hosts:
@@ -897,28 +3873,79 @@ def main(argv):
         if options.host != "localhost" or options.port != DEFAULT_PORT:
             options.hosts.append((options.host, options.port))
 
-    # and setup the sender to start writing out to the tsd
-    sender = SenderThread(reader, options.dryrun, options.hosts,
-                          not options.no_tcollector_stats, tags, options.reconnectinterval)
-    sender.start()
+    # and setup the senders to start writing out to the tsds
+    senders = []
+    for i, queue in enumerate(queues):
+        spool = None
+        if options.spool_dir:
+            spooldir = options.spool_dir
+            if nsenders > 1:
+                spooldir = os.path.join(spooldir, 'shard%d' % i)
+            spool = DiskSpool(spooldir, options.spool_max_bytes // nsenders)
+        kwargs = dict(batch_lines=options.batch_lines,
+                      batch_bytes=options.batch_bytes,
+                      batch_linger_ms=options.batch_linger_ms, spool=spool,
+                      spool_replay_rate=options.spool_replay_rate,
+                      readerq=queue, shard=i if nsenders > 1 else None,
+                      stats_interval=options.stats_interval)
+        if options.protocol == 'http':
+            sender_class = HttpSenderThread
+            kwargs['http_batch_size'] = options.http_batch_size
+            kwargs['http_gzip'] = options.http_gzip
+            kwargs['http_chunked'] = options.http_chunked
+        else:
+            sender_class = SenderThread
+        sender = sender_class(reader, options.dryrun, list(options.hosts),
+                              not options.no_tcollector_stats, tags,
+                              options.reconnectinterval, **kwargs)
+        if threads:
+            sender.start()
+        senders.append(sender)
     LOG.info('SenderThread startup complete')
 
+    SIGNAL_HANDLERS[signal.SIGUSR1] = lambda: toggle_profiler(
+        options.profile_dir)
+    SIGNAL_HANDLERS[signal.SIGUSR2] = lambda: dump_state(reader, senders)
+    for sig in SIGNAL_HANDLERS:
+        signal.signal(sig, defer_signal)
+        signal.siginterrupt(sig, False)
+
+    if options.status_port:
+        try:
+            StatusServer(options.status_port, reader, senders).start()
+        except socket.error, e:
+            LOG.error('Failed to serve the status on port %d: %s',
+                      options.status_port, e)
+
     # if we're in stdin mode, build a stdin collector and just join on the
     # reader thread since there's nothing else for us to do here
     if options.stdin:
         register_collector(StdinCollector())
-        stdin_loop(options, modules, sender, tags)
+        stdin_loop(options, modules, senders[0], tags)
     else:
         sys.stdin.close()
-        main_loop(options, modules, sender, tags)
+        if options.discovery == 'inotify':
+            try:
+                WATCHER = CollectorDirWatcher(options.cdir)
+            except OSError, e:
+                LOG.warning('Falling back to polling for changes in %s: %s',
+                            options.cdir, e)
+        if threads:
+            main_loop(options, modules, senders[0], tags)
+        else:
+            loop_main(options, modules, EventLoop(POLLER, reader, senders),
+                      tags)
 
     # We're exiting, make sure we don't leave any collector behind.
     for col in all_living_collectors():
       col.shutdown()
+    if not threads:
+        return
     LOG.debug('Shutting down -- joining the reader thread.')
     reader.join()
-    LOG.debug('Shutting down -- joining the sender thread.')
-    sender.join()
+    LOG.debug('Shutting down -- joining the sender threads.')
+    for sender in senders:
+        sender.join()
 
 def stdin_loop(options, modules, sender, tags):
     """The main loop of the program that runs when we are in stdin mode."""
@@ -927,29 +3954,119 @@ def stdin_loop(options, modules, sender, tags):
     next_heartbeat = int(time.time() + 600)
     while ALIVE:
         time.sleep(15)
+        handle_signals()
         reload_changed_config_modules(modules, options, sender, tags)
         now = int(time.time())
         if now >= next_heartbeat:
-            LOG.info('Heartbeat (%d collectors running)'
-                     % sum(1 for col in all_living_collectors()))
+            log_heartbeat()
             next_heartbeat = now + 600
 
 def main_loop(options, modules, sender, tags):
     """The main loop of the program that runs when we're not in stdin mode."""
 
     next_heartbeat = int(time.time() + 600)
+    next_check = 0
     while ALIVE:
+        handle_signals()
+        now = time.time()
+        if now >= next_check:
+            check_collectors(options, modules, sender, tags)
+            next_check = now + 15
+        else:
+            # Only the scheduler woke us up.
+            reap_children()
+            spawn_children()
+        wakeup = min(next_check, SCHEDULER.next_wakeup() or next_check)
+        timeout = max(0, wakeup - time.time())
+        if WATCHER is None:
+            time.sleep(timeout)
+        else:
+            try:
+                if select.select([WATCHER], [], [], timeout)[0]:
+                    next_check = 0  # Something changed on disk.
+            except select.error, (err, msg):
+                if err != errno.EINTR:
+                    raise
+        now = int(time.time())
+        if now >= next_heartbeat:
+            log_heartbeat()
+            next_heartbeat = now + 600
+
+
+def check_collectors(options, modules, sender, tags):
+    """Picks up new collectors and config changes, and restarts the
+       collectors that need it."""
+    changes, etc = collector_changes(options.cdir)
+    if changes is None:
         populate_collectors(options.cdir)
+    else:
+        update_collectors(options.cdir, changes)
+    if etc:
         reload_changed_config_modules(modules, options, sender, tags)
+    reap_children()
+    check_children()
+    spawn_children()
+
+
+def collector_changes(coldir):
+    """Returns what changed in the collector directory, like
+       CollectorDirWatcher.read(), or that everything has to be looked at
+       when we don't use inotify.  Falls back to that for good if inotify
+       fails us."""
+    global WATCHER
+    if WATCHER is not None:
+        try:
+            return WATCHER.read()
+        except OSError, e:
+            LOG.error('Falling back to polling for changes in %s: %s',
+                      coldir, e)
+            WATCHER.close()
+            WATCHER = None
+    return None, True
+
+
+def log_heartbeat():
+    LOG.info('Heartbeat (%d collectors running)'
+             % sum(1 for col in all_living_collectors()))
+
+
+def loop_main(options, modules, loop, tags):
+    """The main loop of the program with --runtime=loop."""
+
+    def evict():
+        loop.reader.evict_old_keys(int(time.time())
+                                   - loop.reader.evictinterval)
+
+    armed = []  # When we'll call run_collectors() next.
+
+    def arm():
+        wakeup = SCHEDULER.next_wakeup()
+        if wakeup is not None and (not armed or wakeup < armed[0]):
+            armed[:] = [wakeup]
+            loop.call_at(wakeup, run_collectors)
+
+    def run_collectors():
+        if armed and armed[0] <= time.time():
+            del armed[:]
         reap_children()
-        check_children()
         spawn_children()
-        time.sleep(15)
-        now = int(time.time())
-        if now >= next_heartbeat:
-            LOG.info('Heartbeat (%d collectors running)'
-                     % sum(1 for col in all_living_collectors()))
-            next_heartbeat = now + 600
+        arm()
+
+    def check():
+        watcher = WATCHER
+        check_collectors(options, modules, loop.senders[0], tags)
+        if watcher is not None and WATCHER is None:  # Fell back to polling.
+            loop.unwatch(watcher)
+        arm()
+
+    loop.call_every(15, check)
+    if WATCHER is not None:
+        loop.watch(WATCHER, lambda: check() or True)
+    loop.call_at(time.time() + 600,
+                 lambda: loop.call_every(600, log_heartbeat))
+    if loop.reader.dedupinterval != 0:  # if 0 we do not use dedup
+        loop.call_every(1, evict)
+    loop.run()
 
 
 def list_config_modules(etcdir):
@@ -1129,6 +4246,8 @@ def reap_children():
         if status is None:
             continue
         col.proc = None
+        if POLLER is not None:
+            POLLER.remove(col)
 
         # behavior based on status.  a code 0 is normal termination, code 13
         # is used to indicate that we don't want to restart this collector.
@@ -1143,8 +4262,7 @@ def reap_children():
                         col.name, now - col.lastspawn, status)
             col.dead = True
         else:
-            register_collector(Collector(col.name, col.interval, col.filename,
-                                         col.mtime, col.lastspawn))
+            register_collector(col.successor())
 
 def check_children():
     """When a child process hasn't received a datapoint in a while,
@@ -1153,13 +4271,14 @@ def check_children():
     for col in all_living_collectors():
         now = int(time.time())
 
+        if col.paused:
+            continue  # It's only inactive because we don't read from it.
         if col.last_datapoint < (now - ALLOWED_INACTIVITY_TIME):
             # It's too old, kill it
             LOG.warning('Terminating collector %s after %d seconds of inactivity',
                         col.name, now - col.last_datapoint)
             col.shutdown()
-            register_collector(Collector(col.name, col.interval, col.filename,
-                                         col.mtime, col.lastspawn))
+            register_collector(col.successor())
 
 
 def set_nonblocking(fd):
@@ -1173,14 +4292,16 @@ def spawn_collector(col):
 
     LOG.info('%s (interval=%d) needs to be spawned', col.name, col.interval)
 
-    # FIXME: do custom integration of Python scripts into memory/threads
-    # if re.search('\.py$', col.name) is not None:
-    #     ... load the py module directly instead of using a subprocess ...
     try:
-        col.proc = subprocess.Popen(col.filename, stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    close_fds=True,
-                                    preexec_fn=os.setsid)
+        if WORKERS is not None and WORKERS.handles(col):
+            col.proc = WORKERS.run(col)
+        elif ZYGOTE is not None and col.filename.endswith('.py'):
+            col.proc = ZYGOTE.spawn(col.filename)
+        else:
+            col.proc = subprocess.Popen(col.filename, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        close_fds=True,
+                                        preexec_fn=os.setsid)
     except OSError, e:
         LOG.error('Failed to spawn collector %s: %s' % (col.filename, e))
         return
@@ -1190,6 +4311,8 @@ def spawn_collector(col):
     col.lastspawn = int(time.time())
     set_nonblocking(col.proc.stdout.fileno())
     set_nonblocking(col.proc.stderr.fileno())
+    if POLLER is not None:
+        POLLER.add(col)
     if col.proc.pid > 0:
         col.dead = False
         LOG.info('spawned %s (pid=%d)', col.name, col.proc.pid)
@@ -1201,46 +4324,56 @@ def spawn_collector(col):
 def spawn_children():
     """Iterates over our defined collectors and performs the logic to
        determine if we need to spawn, kill, or otherwise take some
-       action on them."""
+       action on them.  Interval collectors are only looked at when the
+       SCHEDULER says they're due."""
 
     if not ALIVE:
         return
 
+    now = time.time()
+    valid = {}
     for col in all_valid_collectors():
-        now = int(time.time())
+        valid[col.name] = col
         if col.interval == 0:
             if col.proc is None:
                 spawn_collector(col)
-        elif col.interval <= now - col.lastspawn:
-            if col.proc is None:
-                spawn_collector(col)
-                continue
+        elif col.name not in SCHEDULER.next_runs:
+            SCHEDULER.add(col, now)
+
+    for name, due in SCHEDULER.due(now):
+        col = valid.get(name)
+        if col is None or col.interval == 0:
+            continue  # It's gone, dead, or not an interval collector anymore.
+        if col.proc is None:
+            SCHEDULER.started(due, now)
+            spawn_collector(col)
+            SCHEDULER.add(col, now, due)
+            continue
 
-            # I'm not very satisfied with this path.  It seems fragile and
-            # overly complex, maybe we should just reply on the asyncproc
-            # terminate method, but that would make the main tcollector
-            # block until it dies... :|
-            if col.nextkill > now:
-                continue
-            if col.killstate == 0:
-                LOG.warning('warning: %s (interval=%d, pid=%d) overstayed '
-                            'its welcome, SIGTERM sent',
-                            col.name, col.interval, col.proc.pid)
-                kill(col.proc)
-                col.nextkill = now + 5
-                col.killstate = 1
-            elif col.killstate == 1:
-                LOG.error('error: %s (interval=%d, pid=%d) still not dead, '
-                           'SIGKILL sent',
-                           col.name, col.interval, col.proc.pid)
-                kill(col.proc, signal.SIGKILL)
-                col.nextkill = now + 5
-                col.killstate = 2
-            else:
-                LOG.error('error: %s (interval=%d, pid=%d) needs manual '
-                           'intervention to kill it',
-                           col.name, col.interval, col.proc.pid)
-                col.nextkill = now + 300
+        # I'm not very satisfied with this path.  It seems fragile and
+        # overly complex, maybe we should just reply on the asyncproc
+        # terminate method, but that would make the main tcollector
+        # block until it dies... :|
+        if col.killstate == 0:
+            LOG.warning('warning: %s (interval=%d, pid=%d) overstayed '
+                        'its welcome, SIGTERM sent',
+                        col.name, col.interval, col.proc.pid)
+            kill(col.proc)
+            col.nextkill = now + 5
+            col.killstate = 1
+        elif col.killstate == 1:
+            LOG.error('error: %s (interval=%d, pid=%d) still not dead, '
+                       'SIGKILL sent',
+                       col.name, col.interval, col.proc.pid)
+            kill(col.proc, signal.SIGKILL)
+            col.nextkill = now + 5
+            col.killstate = 2
+        else:
+            LOG.error('error: %s (interval=%d, pid=%d) needs manual '
+                       'intervention to kill it',
+                       col.name, col.interval, col.proc.pid)
+            col.nextkill = now + 300
+        SCHEDULER.schedule(name, col.nextkill)
 
 
 def populate_collectors(coldir):
@@ -1261,54 +4394,80 @@ def populate_collectors(coldir):
         interval = int(interval)
 
         for colname in os.listdir('%s/%d' % (coldir, interval)):
-            if colname.startswith('.'):
-                continue
-
-            filename = '%s/%d/%s' % (coldir, interval, colname)
-            if os.path.isfile(filename) and os.access(filename, os.X_OK):
-                mtime = os.path.getmtime(filename)
-
-                # if this collector is already 'known', then check if it's
-                # been updated (new mtime) so we can kill off the old one
-                # (but only if it's interval 0, else we'll just get
-                # it next time it runs)
-                if colname in COLLECTORS:
-                    col = COLLECTORS[colname]
-
-                    # if we get a dupe, then ignore the one we're trying to
-                    # add now.  there is probably a more robust way of doing
-                    # this...
-                    if col.interval != interval:
-                        LOG.error('two collectors with the same name %s and '
-                                   'different intervals %d and %d',
-                                   colname, interval, col.interval)
-                        continue
-
-                    # we have to increase the generation or we will kill
-                    # this script again
-                    col.generation = GENERATION
-                    if col.mtime < mtime:
-                        LOG.info('%s has been updated on disk', col.name)
-                        col.mtime = mtime
-                        if not col.interval:
-                            col.shutdown()
-                            LOG.info('Respawning %s', col.name)
-                            register_collector(Collector(colname, interval,
-                                                         filename, mtime))
-                else:
-                    register_collector(Collector(colname, interval, filename,
-                                                 mtime))
+            update_collector(coldir, interval, colname)
 
     # now iterate over everybody and look for old generations
-    to_delete = []
-    for col in all_collectors():
+    for col in list(all_collectors()):
         if col.generation < GENERATION:
-            LOG.info('collector %s removed from the filesystem, forgetting',
-                      col.name)
-            col.shutdown()
-            to_delete.append(col.name)
-    for name in to_delete:
-        del COLLECTORS[name]
+            forget_collector(col)
+
+
+def update_collectors(coldir, changes):
+    """Like populate_collectors(), but only for the given (interval, name)
+       of collectors that may have changed."""
+    for interval, colname in changes:
+        if update_collector(coldir, interval, colname):
+            continue
+        col = COLLECTORS.get(colname)
+        if col is not None and col.interval == interval:
+            forget_collector(col)
+
+
+def update_collector(coldir, interval, colname):
+    """Registers the collector of the given name in the directory of the
+       given interval, or takes note of its changes if we already know it.
+
+    Returns: whether this is a valid collector.
+    """
+    if colname.startswith('.'):
+        return False
+
+    filename = '%s/%d/%s' % (coldir, interval, colname)
+    if not (os.path.isfile(filename) and os.access(filename, os.X_OK)):
+        return False
+    mtime = os.path.getmtime(filename)
+
+    # if this collector is already 'known', then check if it's
+    # been updated (new mtime) so we can kill off the old one
+    # (but only if it's interval 0, else we'll just get
+    # it next time it runs)
+    if colname in COLLECTORS:
+        col = COLLECTORS[colname]
+
+        # if we get a dupe, then ignore the one we're trying to
+        # add now.  there is probably a more robust way of doing
+        # this...
+        if col.interval != interval:
+            LOG.error('two collectors with the same name %s and '
+                       'different intervals %d and %d',
+                       colname, interval, col.interval)
+            return True
+
+        # we have to increase the generation or we will kill
+        # this script again
+        col.generation = GENERATION
+        if col.mtime < mtime:
+            LOG.info('%s has been updated on disk', col.name)
+            col.mtime = mtime
+            if not col.interval:
+                col.shutdown()
+                LOG.info('Respawning %s', col.name)
+                register_collector(Collector(colname, interval,
+                                             filename, mtime))
+    else:
+        register_collector(Collector(colname, interval, filename,
+                                     mtime))
+    return True
+
+
+def forget_collector(col):
+    """Stops and forgets a collector that was removed from the filesystem."""
+    LOG.info('collector %s removed from the filesystem, forgetting',
+              col.name)
+    col.shutdown()
+    del COLLECTORS[col.name]
+    if WORKERS is not None:
+        WORKERS.remove(col.name)
 
 
 if __name__ == '__main__':
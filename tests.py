@@ -13,7 +13,11 @@
 # see <http://www.gnu.org/licenses/>.
 
 import os
+import shutil
+import subprocess
 import sys
+import tempfile
+import time
 from stat import S_ISDIR, S_ISREG, ST_MODE
 import unittest
 
@@ -104,6 +108,1264 @@ class TSDBlacklistingTests(unittest.TestCase):
         sender.pick_connection()
         self.assertEqual(tsd1, (sender.host, sender.port))
 
+class LineFramerTests(unittest.TestCase):
+
+    def test_completeLines(self):
+        framer = tcollector.LineFramer()
+        self.assertEqual(['foo 1 1', 'bar 2 2'], framer.feed('foo 1 1\nbar 2 2\n'))
+        self.assertEqual([], framer.pending)
+
+    def test_partialLines(self):
+        framer = tcollector.LineFramer()
+        self.assertEqual([], framer.feed(''))
+        self.assertEqual(['foo 1 1'], framer.feed('foo 1 1\nba'))
+        self.assertEqual([], framer.feed('r 2'))
+        self.assertEqual([], framer.feed(' 2'))
+        self.assertEqual(['bar 2 2', ''], framer.feed('\n\nbaz'))
+        self.assertEqual(['baz 3 3'], framer.feed(' 3 3\n'))
+        self.assertEqual([], framer.pending)
+
+class ParseLineTests(unittest.TestCase):
+
+    def test_valid(self):
+        self.assertEqual(('foo.bar', 1400000000, '42', ''),
+                         tcollector.parse_line('foo.bar 1400000000 42'))
+        self.assertEqual(('foo.bar', 1400000000, '-4.2e3', ' a=b c-d=e/f'),
+                         tcollector.parse_line('foo.bar 1400000000 -4.2e3 a=b c-d=e/f'))
+        self.assertEqual(('foo', 1, 'a=b', ''),
+                         tcollector.parse_line('foo 1 a=b'))
+
+    def test_invalid(self):
+        for line in ('', 'foo', 'foo 1', 'foo bar 1', 'f!oo 1 1',
+                     'foo 1 1 a', 'foo 1 1 a=', 'foo 1 1 =b', 'foo 1 1 a=b=c',
+                     'foo 1 1 a=b!', ' foo 1 1', 'foo -1 1', 'foo 1.5 1',
+                     'foo 1 1 a=b '):
+            self.assertEqual(None, tcollector.parse_line(line), line)
+
+class BackpressureTests(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = tcollector.ReaderThread(300, 600, high_water=4)
+        self.cols = []
+        for name, lines in (('noisy', 100), ('busy', 80), ('quiet', 10)):
+            col = tcollector.Collector(name, 0, '<test>')
+            col.proc = True  # So that it's alive.
+            col.lines_received = lines
+            tcollector.register_collector(col)
+            self.cols.append(col)
+
+    def tearDown(self):
+        for col in self.cols:
+            del tcollector.COLLECTORS[col.name]
+
+    def test_countsDropsPerCollector(self):
+        self.reader.readerq = tcollector.ReaderQueue(2)
+        noisy, busy, quiet = self.cols
+        for i in xrange(5):
+            self.reader.process_line(noisy, 'foo %d %d' % (i, i))
+        self.reader.process_line(quiet, 'bar 1 1')
+        self.assertEqual(4, self.reader.lines_dropped)
+        self.assertEqual(3, noisy.lines_dropped)
+        self.assertEqual(1, quiet.lines_dropped)
+        # The first drop was logged, the others will be later.
+        self.assertEqual({'noisy': 2, 'quiet': 1}, self.reader.drops)
+
+    def test_pausesNoisiestCollectors(self):
+        noisy, busy, quiet = self.cols
+        for i in xrange(4):
+            self.reader.readerq.put('foo %d 1' % i)
+        self.reader.check_backpressure()
+        self.assertEqual([True, True, False],
+                         [col.paused for col in self.cols])
+        self.reader.readerq.get()
+        self.reader.check_backpressure()
+        self.assertEqual([True, True, False],
+                         [col.paused for col in self.cols])
+        self.reader.readerq.get()
+        self.reader.check_backpressure()
+        self.assertEqual([False, False, False],
+                         [col.paused for col in self.cols])
+
+    def test_pausesNoisiestCollectorsOfFullLanes(self):
+        self.reader.high_water = tcollector.DEFAULT_QUEUE_HIGH_WATER
+        self.reader.readerq = tcollector.LaneQueue(10)  # 2, 4 and 4 lines.
+        noisy, busy, quiet = self.cols
+        noisy.lane, busy.lane, quiet.lane = 0, 2, 2
+        for i in xrange(4):
+            self.reader.readerq.nput('foo %d 1' % i, 2)
+        self.reader.check_backpressure()
+        # The noisy collector isn't the reason the bridge lane is full.
+        self.assertEqual([False, True, False],
+                         [col.paused for col in self.cols])
+        for i in xrange(3):
+            self.reader.readerq.get()
+        self.reader.check_backpressure()
+        self.assertEqual([False, False, False],
+                         [col.paused for col in self.cols])
+
+class TagInjectorTests(unittest.TestCase):
+
+    def test_addsMissingTags(self):
+        tagger = tcollector.TagInjector({'host': 'x', 'dc': 'y'})
+        self.assertEqual(' dc=y host=x', tagger.missing(''))
+        self.assertEqual(' dc=y', tagger.missing(' host=z a=b'))
+        self.assertEqual('', tagger.missing(' host=z dc=w'))
+        self.assertEqual('foo 1 1 dc=y host=x', tagger.add('foo 1 1'))
+        self.assertEqual('foo 1 1 hostname=z dc=y host=x',
+                         tagger.add('foo 1 1 hostname=z'))
+
+    def test_readerAddsTagsOnce(self):
+        reader = tcollector.ReaderThread(300, 600, tags={'host': 'x'})
+        col = tcollector.Collector('test', 0, '<test>')
+        for line in ('foo 100 1', 'foo 115 1', 'foo 130 2 host=y'):
+            reader.process_line(col, line)
+        self.assertEqual('foo 100 1 host=x', reader.readerq.get())
+        self.assertEqual('foo 130 2 host=y', reader.readerq.get())
+        sender = tcollector.SenderThread(reader, True, [], False,
+                                         {'host': 'x'}, 0)
+        self.assertEqual('foo 100 1 host=x',
+                         sender.add_tags_to_line('foo 100 1 host=x'))
+
+class SeriesLimitTests(unittest.TestCase):
+
+    def test_estimatesCardinality(self):
+        hll = tcollector.HyperLogLog()
+        self.assertEqual(0, hll.estimate())
+        for i in xrange(100):
+            hll.add('foo request=%d' % i)
+            hll.add('foo request=%d' % i)
+        self.assertTrue(98 <= hll.estimate() <= 102, hll.estimate())
+        for i in xrange(100, 50000):
+            hll.add('foo request=%d' % i)
+        self.assertTrue(47500 <= hll.estimate() <= 52500, hll.estimate())
+
+    def test_rejectsNewSeriesBeyondLimit(self):
+        reader = tcollector.ReaderThread(300, 600, max_series=2,
+                                         series_limits={'free': 0})
+        bridge = tcollector.Collector('bridge', 0, '<test>')
+        free = tcollector.Collector('free', 0, '<test>')
+        for ts in xrange(1, 4):
+            for request in xrange(3):
+                for col in (bridge, free):
+                    reader.process_line(col, 'foo %d %d request=%d'
+                                        % (ts, ts, request))
+        self.assertEqual(6, bridge.lines_sent)
+        self.assertEqual(3, bridge.series_rejected)
+        self.assertEqual(3, bridge.cardinality.estimate())
+        self.assertEqual(9, free.lines_sent)
+        self.assertEqual(0, free.series_rejected)
+        self.assertEqual(None, free.series)
+        sent = set()
+        while not reader.readerq.empty():
+            sent.add(reader.readerq.get().split(None, 3)[3])
+        self.assertEqual(set(['request=0', 'request=1', 'request=2']), sent)
+
+    def test_hashesSeriesOnlyTheFirstTime(self):
+        reader = tcollector.ReaderThread(300, 600, max_series=1)
+        col = tcollector.Collector('bridge', 0, '<test>')
+        reader.adopt(col)
+        added = []
+        add = col.cardinality.add
+        col.cardinality.add = lambda value: added.append(value) or add(value)
+        for ts in xrange(1, 4):
+            for request in xrange(3):
+                reader.process_line(col, 'foo %d %d request=%d'
+                                    % (ts, ts, request))
+        self.assertEqual(['foo request=0', 'foo request=1', 'foo request=2'],
+                         added)
+        self.assertEqual(6, col.series_rejected)
+        # Without dedup nor limit, nothing tells us which series are new.
+        reader = tcollector.ReaderThread(0, 600)
+        col = tcollector.Collector('free', 0, '<test>')
+        reader.process_line(col, 'foo 1 1')
+        self.assertEqual(None, col.cardinality)
+
+    def test_limitHoldsAcrossRuns(self):
+        reader = tcollector.ReaderThread(300, 600, max_series=2)
+        col = tcollector.Collector('interval.sh', 15, '/bin/true')
+        tcollector.register_collector(col)
+        try:
+            for run in xrange(2):
+                col.proc = subprocess.Popen(['true'])
+                for request in xrange(2):
+                    reader.process_line(col, 'foo %d %d request=%d'
+                                        % (run + 1, run, request + run))
+                col.proc.wait()
+                tcollector.reap_children()
+                self.assertFalse(col is tcollector.COLLECTORS[col.name])
+                col = tcollector.COLLECTORS[col.name]
+        finally:
+            del tcollector.COLLECTORS[col.name]
+        # request=2 is the third series, even if it came in another run.
+        self.assertEqual(1, col.series_rejected)
+        self.assertEqual(set([('foo', ' request=0'), ('foo', ' request=1')]),
+                         col.series)
+        self.assertEqual(3, col.cardinality.estimate())  # With the rejected.
+
+class MetricsRegistryTests(unittest.TestCase):
+
+    def test_metrics(self):
+        registry = tcollector.MetricsRegistry()
+        registry.counter('foo', 'a=b').inc()
+        registry.counter('foo', 'a=b').inc(2)
+        registry.gauge('bar', lambda: 42)
+        histogram = registry.histogram('baz', (1, 10))
+        for value in (0.5, 1, 2, 20):
+            histogram.observe(value)
+        self.assertEqual([('bar', '', 42),
+                          ('baz.count', '', 4),
+                          ('baz.sum', '', 23.5),
+                          ('baz.bucket', 'le=1', 2),
+                          ('baz.bucket', 'le=10', 3),
+                          ('baz.bucket', 'le=inf', 4),
+                          ('foo', 'a=b', 3)], registry.datapoints())
+
+    def test_statsHaveTheirOwnTimer(self):
+        reader = tcollector.ReaderThread(300, 600)
+        sender = tcollector.SenderThread(reader, True, [], True, {'host': 'x'},
+                                         0, stats_interval=10)
+        now = tcollector.time.time()
+        sender.report_stats(now)
+        self.assertEqual([], sender.sendq)
+        sender.report_stats(now + 10)
+        self.assertTrue('tcollector.reader.queue_depth %d 0  host=x'
+                        % (now + 10) in sender.sendq)
+        del sender.sendq[:]
+        sender.report_stats(now + 15)
+        self.assertEqual([], sender.sendq)
+
+class DedupTests(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = tcollector.ReaderThread(300, 600)
+        self.col = tcollector.Collector('test', 0, '<test>')
+
+    def sent(self, *lines):
+        for line in lines:
+            self.reader.process_line(self.col, line)
+        sent = []
+        while not self.reader.readerq.empty():
+            sent.append(self.reader.readerq.get())
+        return sent
+
+    def test_suppressesRepeatedValues(self):
+        self.assertEqual(['foo 100 1 a=b'], self.sent('foo 100 1 a=b',
+                                                      'foo 115 1 a=b',
+                                                      'foo 130 1 a=b'))
+        # The last repeated value is replayed before the new one.
+        self.assertEqual(['foo 130 1 a=b', 'foo 145 2 a=b'],
+                         self.sent('foo 145 2 a=b'))
+        self.assertEqual(['foo 160 3 a=b'], self.sent('foo 160 3 a=b'))
+        self.assertEqual(1, len(self.col.values))
+
+    def test_resendsAfterDedupInterval(self):
+        self.assertEqual(['foo 100 1', 'foo 400 1'],
+                         self.sent('foo 100 1', 'foo 200 1', 'foo 400 1'))
+
+    def test_sendsCurrentTimestamps(self):
+        # Only the datapoints after the first of a series are checked
+        # against MAX_REASONABLE_TIMESTAMP, which once ran out in 2020.
+        now = int(time.time())
+        self.assertEqual(['foo %d 1' % now, 'foo %d 2' % (now + 15)],
+                         self.sent('foo %d 1' % now, 'foo %d 2' % (now + 15)))
+        self.assertEqual(0, self.col.lines_invalid)
+
+    def test_outOfOrder(self):
+        self.assertEqual(['foo 100 1'], self.sent('foo 100 1', 'foo 90 2'))
+        self.assertEqual(1, self.col.lines_invalid)
+
+    def test_evictsLeastRecentlyUsed(self):
+        cache = tcollector.DedupCache(max_entries=3)
+        for metric in ('a', 'b', 'c'):
+            cache.add(metric, '', '1', 100)
+        cache.get(('a', ''))
+        cache.get(('c', ''))
+        cache.add('d', '', '1', 100)
+        self.assertEqual(3, len(cache))
+        self.assertEqual(None, cache.get(('b', '')))
+        self.assertEqual(1, cache.evictions)
+        cache.add('e', '', '1', 100)
+        self.assertEqual(None, cache.get(('a', '')))
+        self.assertEqual(['c', 'd', 'e'],
+                         sorted(metric for metric, tags in cache.entries))
+        self.assertTrue(cache.memory_footprint() > 0)
+
+    def test_memoryFootprintFromAnotherThread(self):
+        cache = tcollector.DedupCache(max_entries=500, bucket_width=1)
+        errors = []
+        done = []
+        def measure():
+            try:
+                while not done:
+                    cache.memory_footprint()
+            except Exception, e:
+                errors.append(e)
+        thread = tcollector.threading.Thread(target=measure)
+        thread.start()
+        try:
+            for i in xrange(20000):
+                entry = cache.add('foo%d' % i, '', '1', i // 10)
+                if i % 3 == 0:
+                    cache.update(('foo%d' % i, ''), entry, '1.5', i // 10 + 1)
+                if i % 100 == 0:
+                    cache.evict_older_than(i // 10 - 5)
+        finally:
+            done.append(True)
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(sum(cache._entry_size(key, entry)
+                             for key, entry in cache.entries.iteritems())
+                         + sum(sys.getsizeof(keys)
+                               for keys in cache.wheel.itervalues()),
+                         cache.size)
+        cache.evict_older_than(10 ** 6)
+        self.assertEqual(0, cache.size)
+
+    def test_keyHasOneSlotInTheClock(self):
+        cache = tcollector.DedupCache(max_entries=3)
+        cache.add('a', '', '1', 100)
+        cache.add('b', '', '1', 200)
+        cache.add('c', '', '1', 200)
+        self.assertEqual(1, cache.evict_older_than(150))
+        # a comes back after it expired.  Its old slot mustn't get it
+        # evicted as soon as the hand goes by, b's turn comes first.
+        cache.add('a', '', '2', 300)
+        cache.add('d', '', '1', 300)
+        self.assertEqual(['a', 'c', 'd'],
+                         sorted(metric for metric, tags in cache.entries))
+        self.assertEqual(sorted(cache.entries),
+                         sorted(key for key in cache.clock if key is not None))
+        for slot, key in enumerate(cache.clock):
+            if key is not None:
+                self.assertEqual(slot, cache.entries[key].slot)
+
+    def test_evictOldKeys(self):
+        self.sent('foo 100 1', 'bar 200 1', 'baz 10 1', 'qux 1000 1')
+        self.assertEqual(2, self.col.evict_old_keys(150))
+        self.assertEqual(['bar', 'qux'],
+                         sorted(metric for metric, tags in self.col.values.entries))
+        self.assertEqual([3, 16], sorted(self.col.values.wheel))
+
+    def test_evictOldKeysIncrementally(self):
+        self.sent(*['foo%d 100 1' % i for i in xrange(5)])
+        self.assertEqual(3, self.col.evict_old_keys(1000, 3))
+        self.assertEqual(2, len(self.col.values))
+        self.assertEqual(2, self.col.evict_old_keys(1000, 3))
+        self.assertEqual({}, self.col.values.wheel)
+        self.assertEqual(None, self.col.values.oldest())
+
+    def test_changedValueMovesBucket(self):
+        self.sent('foo 100 1', 'foo 200 2')
+        self.assertEqual(0, self.col.evict_old_keys(150))
+        self.assertEqual({3: set([('foo', '')])}, self.col.values.wheel)
+
+    def test_oldestBucketSkipsEmptiedOnes(self):
+        cache = tcollector.DedupCache(bucket_width=10)
+        for i in xrange(5):
+            cache.add('foo%d' % i, '', '1', 100 - 10 * i)
+        self.assertEqual(6, cache.oldest())
+        # foo4 moves from the oldest bucket to a new one, foo1 to foo2's.
+        cache.update(('foo4', ''), cache.get(('foo4', '')), '2', 200)
+        cache.update(('foo1', ''), cache.get(('foo1', '')), '2', 80)
+        self.assertEqual(7, cache.oldest())
+        self.assertEqual(1, cache.evict_older_than(80))
+        self.assertEqual(8, cache.oldest())
+        self.assertEqual(['foo0', 'foo1', 'foo2', 'foo4'],
+                         sorted(metric for metric, tags in cache.entries))
+
+class CollectorPollerTests(unittest.TestCase):
+
+    def setUp(self):
+        if not hasattr(tcollector.select, 'epoll'):
+            self.skipTest('epoll is not available on this platform')
+        self.poller = tcollector.CollectorPoller()
+
+    def spawn(self, script):
+        col = tcollector.Collector('test', 0, '<test>')
+        col.proc = subprocess.Popen([sys.executable, '-c', script],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+        tcollector.set_nonblocking(col.proc.stdout.fileno())
+        tcollector.set_nonblocking(col.proc.stderr.fileno())
+        self.poller.add(col)
+        return col
+
+    def test_readyWhenCollectorWrites(self):
+        col = self.spawn('print "foo.bar 1 1"')
+        col.proc.wait()
+        self.assertEqual([col], self.poller.poll(5))
+        self.assertEqual(['foo.bar 1 1'], list(col.collect()))
+
+    def test_forgetsCollectorOnHangup(self):
+        col = self.spawn('pass')
+        col.proc.wait()
+        self.assertEqual([col], self.poller.poll(5))
+        self.assertEqual({}, self.poller.fds)
+        self.assertEqual({}, self.poller.watched)
+        self.assertEqual([], self.poller.poll(0))
+
+    def test_remove(self):
+        col = self.spawn('import time; time.sleep(5)')
+        self.poller.remove(col)
+        self.assertEqual({}, self.poller.fds)
+        self.assertEqual([], self.poller.poll(0))
+        col.proc.kill()
+        col.proc.wait()
+
+    def test_pause(self):
+        col = self.spawn('import time; print "foo.bar 1 1"; time.sleep(5)')
+        self.poller.pause(col)
+        self.assertEqual([], self.poller.poll(0.2))
+        self.poller.resume(col)
+        self.assertEqual([col], self.poller.poll(5))
+        col.proc.kill()
+        col.proc.wait()
+
+class CollectorWorkerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.pool = tcollector.CollectorWorkerPool()
+
+    def tearDown(self):
+        for name in self.pool.workers.keys():
+            self.pool.remove(name)
+        shutil.rmtree(self.dir)
+
+    def collector(self, source, interval=15):
+        filename = os.path.join(self.dir, 'test.py')
+        f = open(filename, 'w')
+        f.write(source)
+        f.close()
+        return tcollector.Collector('test.py', interval, filename,
+                                    os.path.getmtime(filename))
+
+    def run_collector(self, col):
+        proc = self.pool.run(col)
+        self.wait_for(proc)
+        return proc
+
+    def test_handlesPythonIntervalCollectorsWithCollect(self):
+        self.assertTrue(self.pool.handles(self.collector(
+            'def collect():\n  pass\n')))
+        self.assertFalse(self.pool.handles(self.collector(
+            'def collect():\n  pass\n', interval=0)))
+        self.assertFalse(self.pool.handles(self.collector(
+            'def collect(db):\n  pass\n')))
+
+    def test_loadsTheCollectorOnce(self):
+        col = self.collector('import os\n'
+                             'runs = []\n'
+                             'def collect():\n'
+                             '  runs.append(1)\n'
+                             '  print "test.runs 1 %d pid=%d" % (len(runs),'
+                             ' os.getpid())\n')
+        first = self.run_collector(col)
+        self.assertEqual(0, first.returncode)
+        self.assertEqual('test.runs 1 1 pid=%d\n' % first.pid,
+                         first.stdout.readline())
+        second = self.run_collector(col)
+        self.assertTrue(first is second)
+        self.assertEqual(0, second.returncode)
+        self.assertEqual('test.runs 1 2 pid=%d\n' % first.pid,
+                         second.stdout.readline())
+
+    def wait_for(self, proc):
+        deadline = time.time() + 10
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.01)
+        return proc.returncode
+
+    def test_killedWorkerGetsReplaced(self):
+        col = self.collector('import time\n'
+                             'def collect():\n'
+                             '  time.sleep(60)\n')
+        proc = self.pool.run(col)
+        time.sleep(0.2)
+        self.assertEqual(None, proc.poll())
+        tcollector.kill(proc)
+        self.assertEqual(-tcollector.signal.SIGTERM, self.wait_for(proc))
+        self.assertFalse(proc is self.pool.run(col))
+
+    def test_exitStatus(self):
+        col = self.collector('import sys\n'
+                             'def collect():\n'
+                             '  sys.exit(13)\n')
+        self.assertEqual(13, self.wait_for(self.pool.run(col)))
+        col = self.collector('def collect():\n'
+                             '  raise ValueError("oops")\n')
+        proc = self.pool.run(col)
+        self.assertEqual(1, self.wait_for(proc))
+        self.assertTrue('ValueError: oops' in proc.stderr.read())
+
+class CollectorDirWatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dir, '15'))
+        os.mkdir(os.path.join(self.dir, 'etc'))
+        self.watcher = tcollector.CollectorDirWatcher(self.dir)
+        self.assertEqual((None, True), self.watcher.read())
+
+    def tearDown(self):
+        tcollector.WATCHER = None
+        self.watcher.close()
+        for name in tcollector.COLLECTORS.keys():
+            del tcollector.COLLECTORS[name]
+        shutil.rmtree(self.dir)
+
+    def collector(self, name, mode=0755):
+        filename = os.path.join(self.dir, '15', name)
+        open(filename, 'w').close()
+        os.chmod(filename, mode)
+        return filename
+
+    def test_reportsChangedCollectors(self):
+        self.assertEqual((set(), False), self.watcher.read())
+        filename = self.collector('foo')
+        self.assertEqual((set([(15, 'foo')]), False), self.watcher.read())
+        os.chmod(filename, 0644)
+        self.assertEqual((set([(15, 'foo')]), False), self.watcher.read())
+        os.remove(filename)
+        self.assertEqual((set([(15, 'foo')]), False), self.watcher.read())
+        open(os.path.join(self.dir, 'etc', 'config.py'), 'w').close()
+        self.assertEqual((set(), True), self.watcher.read())
+
+    def test_newIntervalDirectoryTriggersARescan(self):
+        os.mkdir(os.path.join(self.dir, '30'))
+        self.assertEqual((None, True), self.watcher.read())
+        open(os.path.join(self.dir, '30', 'bar'), 'w').close()
+        self.assertEqual((set([(30, 'bar')]), False), self.watcher.read())
+
+    def test_updateCollectors(self):
+        filename = self.collector('foo')
+        self.collector('notexecutable', 0644)
+        tcollector.update_collectors(self.dir, self.watcher.read()[0])
+        self.assertEqual(['foo'], tcollector.COLLECTORS.keys())
+        self.assertEqual(filename, tcollector.COLLECTORS['foo'].filename)
+        os.chmod(filename, 0644)
+        tcollector.update_collectors(self.dir, self.watcher.read()[0])
+        self.assertEqual({}, tcollector.COLLECTORS)
+
+    def test_fallsBackToPollingWhenInotifyFails(self):
+        def watch(path, what):
+            raise OSError(tcollector.errno.ENOSPC, 'No space left on device')
+        self.watcher.watch = watch
+        tcollector.WATCHER = self.watcher
+        self.assertEqual((set(), False), tcollector.collector_changes(self.dir))
+        os.mkdir(os.path.join(self.dir, '30'))  # Needs a new watch.
+        self.assertEqual((None, True), tcollector.collector_changes(self.dir))
+        self.assertEqual(None, tcollector.WATCHER)
+        self.assertTrue(self.watcher.closed)
+        self.assertEqual((None, True), tcollector.collector_changes(self.dir))
+
+class CollectorSchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.random = tcollector.random.uniform
+        tcollector.random.uniform = lambda a, b: b
+        self.scheduler = tcollector.CollectorScheduler()
+
+    def tearDown(self):
+        tcollector.random.uniform = self.random
+        tcollector.SCHEDULER = None
+
+    def test_dueInOrderOfNextRun(self):
+        self.scheduler.add(tcollector.Collector('a', 10, 'a'), 100)
+        self.scheduler.add(tcollector.Collector('b', 5, 'b'), 99)
+        self.scheduler.schedule('c', 101)
+        self.scheduler.schedule('c', 150)  # Rescheduled, 101 is stale.
+        self.assertEqual(99, self.scheduler.next_wakeup())
+        self.assertEqual([('b', 99), ('a', 100)], self.scheduler.due(120))
+        self.assertEqual(150, self.scheduler.next_wakeup())
+        self.assertEqual([], self.scheduler.due(149))
+
+    def test_nextRunAfterTheDueTime(self):
+        col = tcollector.Collector('a', 10, 'a')
+        self.scheduler.add(col, 101, due=100)
+        self.assertEqual(110, self.scheduler.next_runs['a'])
+        # Runs we were too late for are skipped.
+        self.scheduler.add(col, 135, due=100)
+        self.assertEqual(140, self.scheduler.next_runs['a'])
+
+    def test_jitterAndAlignment(self):
+        scheduler = tcollector.CollectorScheduler(
+            jitter=5, overrides={'b': (50, True), 'c': (0, True)})
+        scheduler.add(tcollector.Collector('a', 60, 'a'), 1000.5)
+        scheduler.add(tcollector.Collector('b', 20, 'b'), 1000.5)
+        scheduler.add(tcollector.Collector('c', 60, 'c'), 1000.5)
+        # The jitter is at most the interval.
+        self.assertEqual({'a': 1005.5, 'b': 1020, 'c': 1020},
+                         scheduler.next_runs)
+        self.assertEqual({'a': 5, 'b': 20, 'c': 0}, scheduler.offsets)
+
+    def test_lag(self):
+        self.scheduler.started(100, 100.25)
+        self.scheduler.started(110, 110.5)
+        self.scheduler.started(120, 120.125)
+        self.assertEqual(0.125, self.scheduler.lag)
+        self.assertEqual(0.5, self.scheduler.pop_max_lag())
+        self.assertEqual(0, self.scheduler.pop_max_lag())
+
+    def test_spawnChildrenRunsDueCollectors(self):
+        tcollector.SCHEDULER = self.scheduler
+        col = tcollector.Collector('true.sh', 5, '/bin/true')
+        tcollector.register_collector(col)
+        try:
+            start = time.time()
+            tcollector.spawn_children()
+            self.assertTrue(col.proc is not None)
+            col.proc.wait()
+            when = self.scheduler.next_runs['true.sh']
+            self.assertTrue(start + 5 <= when <= time.time() + 5)
+            self.assertEqual([], self.scheduler.due(when - 0.001))
+        finally:
+            del tcollector.COLLECTORS['true.sh']
+
+class ZygoteTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.zygote = tcollector.Zygote()
+
+    def tearDown(self):
+        tcollector.ZYGOTE = None
+        if self.zygote.proc is not None:
+            self.zygote.control.close()
+            self.zygote.proc.wait()
+        shutil.rmtree(self.dir)
+
+    def collector(self, name, source):
+        filename = os.path.join(self.dir, name)
+        f = open(filename, 'w')
+        f.write(source)
+        f.close()
+        os.chmod(filename, 0755)
+        return tcollector.Collector(name, 15, filename)
+
+    def test_forksPythonCollectors(self):
+        col = self.collector('test.py', 'import os, sys\n'
+                                        'print "test.pid 1 %d" % os.getpid()\n'
+                                        'print >>sys.stderr, sys.argv\n'
+                                        'sys.exit(13)\n')
+        proc = self.zygote.spawn(col.filename)
+        self.assertEqual(13, proc.wait())
+        self.assertEqual('test.pid 1 %d\n' % proc.pid, proc.stdout.read())
+        self.assertEqual("['%s']\n" % col.filename, proc.stderr.read())
+        self.assertEqual({}, self.zygote.processes)
+
+    def test_killAndPoll(self):
+        col = self.collector('test.py', 'import time\ntime.sleep(60)\n')
+        proc = self.zygote.spawn(col.filename)
+        self.assertEqual(None, proc.poll())
+        time.sleep(0.1)  # Let it call setsid().
+        tcollector.kill(proc)
+        self.assertEqual(-tcollector.signal.SIGTERM, proc.wait())
+
+    def test_otherCollectorsUsePopen(self):
+        tcollector.ZYGOTE = self.zygote
+        col = self.collector('test.sh', '#!/bin/sh\necho test.sh 1 1\n')
+        tcollector.spawn_collector(col)
+        self.assertTrue(isinstance(col.proc, subprocess.Popen))
+        col.proc.wait()
+        col = self.collector('test.py', '')
+        tcollector.spawn_collector(col)
+        self.assertTrue(isinstance(col.proc, tcollector.ZygoteProcess))
+        self.assertEqual(0, col.proc.wait())
+
+    def test_lostZygoteKillsItsCollectors(self):
+        col = self.collector('test.py', 'import time\ntime.sleep(60)\n')
+        proc = self.zygote.spawn(col.filename)
+        time.sleep(0.1)
+        os.kill(self.zygote.proc.pid, tcollector.signal.SIGKILL)
+        self.assertEqual(-tcollector.signal.SIGKILL, proc.wait())
+        self.assertEqual(None, self.zygote.proc)
+        # It comes back on the next spawn.
+        proc = self.zygote.spawn(self.collector('ok.py', '').filename)
+        self.assertEqual(0, proc.wait())
+
+    def test_exitedInTheSameReadAsSpawned(self):
+        # A collector that dies at once: the zygote can tell us it exited
+        # before spawn() registered it.
+        self.zygote.control, zygote_end = tcollector.socket.socketpair()
+        self.zygote.proc = subprocess.Popen(['sleep', '60'])
+        try:
+            zygote_end.sendall('spawned 4242\nexited 4242 1\n')
+            proc = self.zygote.spawn('test.py')
+            self.assertEqual(1, proc.poll())
+            self.assertEqual({}, self.zygote.processes)
+            self.assertEqual({}, self.zygote.exited)
+            proc.stdout.close()
+            proc.stderr.close()
+        finally:
+            self.zygote.proc.kill()
+            zygote_end.close()
+
+class ShardedQueueTests(unittest.TestCase):
+
+    def test_seriesAlwaysGoToTheSameQueue(self):
+        queues = [tcollector.ReaderQueue(100) for i in xrange(4)]
+        sharded = tcollector.ShardedQueue(queues)
+        for ts in xrange(10):
+            for host in xrange(10):
+                sharded.nput('foo %d 1 host=%d' % (ts, host))
+        self.assertEqual(100, sharded.qsize())
+        nonempty = 0
+        for queue in queues:
+            counts = {}
+            while not queue.empty():
+                tags = queue.get().split()[3]
+                counts[tags] = counts.get(tags, 0) + 1
+            # All the datapoints of a series are in the same queue.
+            self.assertEqual([10] * len(counts), counts.values())
+            nonempty += bool(counts)
+        self.assertTrue(nonempty > 1)
+
+    def test_shardsPreferDifferentHosts(self):
+        tsds = [('tsd%d' % i, 4242) for i in xrange(3)]
+        for shard in xrange(4):
+            sender = tcollector.SenderThread(None, True, list(tsds), False, {},
+                                             0, shard=shard)
+            sender.pick_connection()
+            self.assertEqual(tsds[shard % 3], (sender.host, sender.port))
+
+class LaneQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = tcollector.LaneQueue(8, (('high', 2, 0.5),
+                                              ('low', 1, 0.5)))
+
+    def test_lanesTakeTurnsByWeight(self):
+        for i in xrange(4):
+            self.queue.nput('high %d' % i, 0)
+            self.queue.nput('low %d' % i, 1)
+        self.assertEqual(8, self.queue.qsize())
+        self.assertEqual(['high 0', 'high 1', 'low 0', 'high 2', 'high 3',
+                          'low 1', 'low 2', 'low 3'],
+                         [self.queue.get(False) for i in xrange(8)])
+        self.assertRaises(tcollector.Empty, self.queue.get, False)
+        self.assertRaises(tcollector.Empty, self.queue.get, True, 0.01)
+
+    def test_fullLaneDoesNotBlockOthers(self):
+        for i in xrange(4):
+            self.assertTrue(self.queue.nput('low %d' % i, 1))
+        self.assertFalse(self.queue.nput('low 4', 1))
+        self.assertTrue(self.queue.nput('high 0', 0))
+        self.assertEqual([('high', 1), ('low', 4)], self.queue.depths())
+
+    def test_readerSendsSystemCollectorsFirst(self):
+        reader = tcollector.ReaderThread(300, 600,
+                                         lanes={'flood': 2, 'mine.py': 0})
+        cols = dict((name, tcollector.Collector(name, 0, '<test>'))
+                    for name in ('flood', 'procstats.py', 'mine.py',
+                                 'graphite_bridge.py', 'app.py'))
+        for name, col in sorted(cols.items()):
+            for i in xrange(20):
+                reader.process_line(col, '%s %d %d' % (name, i, i))
+        self.assertEqual([('system', 40), ('application', 20),
+                          ('bridge', 40)], reader.readerq.depths())
+        first = [reader.readerq.get(False).split()[0] for i in xrange(13)]
+        self.assertEqual(['mine.py'] * 8 + ['app.py'] * 4 + ['flood'], first)
+
+    def test_noLanesWithoutPriorityLanes(self):
+        reader = tcollector.ReaderThread(300, 600)
+        col = tcollector.Collector('procstats.py', 0, '<test>')
+        reader.process_line(col, 'foo 1 1')
+        self.assertTrue(col.adopted)
+        self.assertEqual(None, col.lane)
+
+class SenderBatchingTests(unittest.TestCase):
+
+    def mkSenderThread(self, **kwargs):
+        reader = tcollector.ReaderThread(300, 600)
+        sender = tcollector.SenderThread(reader, True, [("localhost", 4242)],
+                                         False, {}, 0, **kwargs)
+        return reader.readerq, sender
+
+    def test_flushOnLines(self):
+        readerq, sender = self.mkSenderThread(batch_lines=3)
+        for i in xrange(5):
+            readerq.put('foo %d 1' % i)
+        self.assertEqual('lines', sender.fill_batch())
+        self.assertEqual(['foo 0 1', 'foo 1 1', 'foo 2 1'], sender.sendq)
+
+    def test_flushOnBytes(self):
+        readerq, sender = self.mkSenderThread(batch_bytes=10)
+        for i in xrange(5):
+            readerq.put('foo %d 1' % i)
+        self.assertEqual('bytes', sender.fill_batch())
+        self.assertEqual(['foo 0 1', 'foo 1 1'], sender.sendq)
+
+    def test_flushOnLinger(self):
+        readerq, sender = self.mkSenderThread(batch_linger_ms=10)
+        readerq.put('foo 0 1')
+        self.assertEqual('linger', sender.fill_batch())
+        self.assertEqual(['foo 0 1'], sender.sendq)
+
+    def test_sendsChunksAndResumesPartialWrites(self):
+        class ShortWrites(object):
+            """A TSD socket that takes 4 bytes at a time, 10 times."""
+            def __init__(self):
+                self.data = ''
+                self.writes = 10
+            def send(self, data):
+                if not self.writes:
+                    raise tcollector.socket.error(32, 'Broken pipe')
+                self.writes -= 1
+                self.data += str(data[:4])
+                return len(data[:4])
+        readerq, sender = self.mkSenderThread()
+        sender.dryrun = False
+        sender.tsd = tsd = ShortWrites()
+        sender.sendq = ['foo %d 1' % i for i in xrange(5)]
+        chunk_lines = tcollector.SEND_CHUNK_LINES
+        tcollector.SEND_CHUNK_LINES = 2
+        try:
+            self.assertRaises(tcollector.socket.error, sender.send_chunks)
+        finally:
+            tcollector.SEND_CHUNK_LINES = chunk_lines
+        # The first chunk was sent whole, the second one only in part: its
+        # first line made it and must not be sent again, the second didn't.
+        self.assertEqual('put foo 0 1\nput foo 1 1\nput foo 2 1\nput ',
+                         tsd.data)
+        self.assertEqual(['foo 3 1', 'foo 4 1'], sender.sendq)
+
+class DiskSpoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_appendAndRead(self):
+        spool = tcollector.DiskSpool(self.dir)
+        spool.append(['foo 1 1', 'foo 2 2'])
+        spool.append(['foo 3 3'])
+        self.assertEqual(24, spool.pending())
+        self.assertEqual(['foo 1 1', 'foo 2 2'], spool.read(2))
+        spool.append(['foo 4 4'])
+        self.assertEqual(['foo 3 3', 'foo 4 4'], spool.read(10))
+        self.assertEqual([], spool.read(10))
+        self.assertEqual(0, spool.pending())
+        self.assertEqual([], os.listdir(self.dir))
+
+    def test_dropsOldestSegmentsWhenFull(self):
+        spool = tcollector.DiskSpool(self.dir, max_bytes=80)
+        for i in xrange(20):
+            spool.append(['foo %d 1' % i])
+        self.assertTrue(spool.size <= 80)
+        self.assertTrue(spool.bytes_dropped > 0)
+        lines = spool.read(100)
+        self.assertTrue(0 < len(lines) < 20)
+        self.assertEqual(['foo %d 1' % i for i in xrange(20 - len(lines), 20)],
+                         lines)
+
+    def test_replaysLeftOvers(self):
+        spool = tcollector.DiskSpool(self.dir)
+        spool.append(['foo 1 1'])
+        spool = tcollector.DiskSpool(self.dir)
+        spool.append(['foo 2 2'])
+        self.assertEqual(['foo 1 1', 'foo 2 2'], spool.read(10))
+
+class SenderSpoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.random = tcollector.random.random
+        tcollector.random.random = lambda: 0
+        self.tsd = mocks.FakeTSD()
+
+    def tearDown(self):
+        tcollector.random.random = self.random
+        self.tsd.close()
+        shutil.rmtree(self.dir)
+
+    def test_spoolsThenReplays(self):
+        reader = tcollector.ReaderThread(300, 600)
+        sender = tcollector.SenderThread(reader, False,
+                                         [('127.0.0.1', self.tsd.port)],
+                                         False, {}, 0,
+                                         spool=tcollector.DiskSpool(self.dir))
+        sender.sendq = ['foo 1 1']
+        reader.readerq.put('foo 2 2')
+        reader.readerq.put('foo 3 3')
+        sender.wait_and_spool(0.01)
+        self.assertEqual([], sender.sendq)
+        self.assertTrue(reader.readerq.empty())
+        self.assertEqual(24, sender.spool.pending())
+
+        self.tsd.start()
+        sender.maintain_conn()
+        sender.replay_spool()
+        self.assertEqual(['put foo 1 1', 'put foo 2 2', 'put foo 3 3'],
+                         self.tsd.wait_for(3))
+        self.assertEqual(0, sender.spool.pending())
+
+class ResponseDrainerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tsd = mocks.FakeTSD()
+        self.tsd.start()
+        self.reader = tcollector.ReaderThread(300, 600)
+        self.sender = tcollector.SenderThread(self.reader, False,
+                                              [('127.0.0.1', self.tsd.port)],
+                                              True, {}, 0)
+        self.sender.maintain_conn()
+
+    def tearDown(self):
+        self.sender.close_conn()
+        self.tsd.close()
+
+    def test_countsErrorsPerMetricAndCollector(self):
+        self.reader.metric_owners = {'bad.metric': 'foo.py'}
+        self.sender.sendq = ['bad.metric 1 1', 'good.metric 1 1',
+                             'bad.metric 2 1', 'bad.other 1 1']
+        self.sender.send_data()
+        self.tsd.wait_for(4)
+        # The version command goes after the puts, so once it's answered,
+        # the errors have been read.
+        rtts = self.sender.tsd_rtt.count
+        self.assertTrue(self.sender.check_tsd())
+        self.assertEqual({'bad.metric': 2, 'bad.other': 1},
+                         self.sender.metric_errors)
+        self.assertEqual({'foo.py': 2, 'unknown': 1}, self.sender.put_errors)
+        self.assertTrue(('sender.put_errors_by_metric', 'metric=bad.other', 1)
+                        in self.sender.self_stats())
+        self.assertEqual(rtts + 1, self.sender.tsd_rtt.count)
+
+    def test_onlyTheVersionCountsAsAnAnswer(self):
+        errors = []
+        drainer = tcollector.ResponseDrainer(None, errors.append)
+        # What's left of the answer to the previous `version'.
+        drainer.feed('Built on 2013/01/01 00:00:00 +0000 by fake@localhost\n')
+        self.assertFalse(drainer.answered.isSet())
+        drainer.feed("put: unknown metric: No such name for 'metrics': 'bad'\n"
+                     'net.opentsdb.tools BuildData built at revision fake')
+        self.assertFalse(drainer.answered.isSet())
+        drainer.feed(' (MINT)\n')
+        self.assertTrue(drainer.answered.isSet())
+        self.assertEqual(['bad'], errors)
+
+    def test_noticesClosedConnections(self):
+        drainer = self.sender.drainer
+        self.tsd.close()
+        self.sender.close_conn()
+        drainer.join(5)
+        self.assertFalse(drainer.is_alive())
+        self.assertTrue(drainer.closed)
+
+class EventLoopTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tsd = mocks.FakeTSD()
+        self.tsd.start()
+        self.reader = tcollector.ReaderThread(300, 600)
+        self.sender = tcollector.SenderThread(self.reader, False,
+                                              [('127.0.0.1', self.tsd.port)],
+                                              False, {}, 0,
+                                              batch_linger_ms=50)
+        self.loop = tcollector.EventLoop(tcollector.CollectorPoller(),
+                                         self.reader, [self.sender])
+
+    def tearDown(self):
+        tcollector.ALIVE = True
+        self.sender.close_conn()
+        self.tsd.close()
+
+    def test_timersRunInOrder(self):
+        calls = []
+        def stop():
+            tcollector.ALIVE = False
+        now = time.time()
+        self.loop.senders = []
+        self.loop.call_at(now + 0.02, lambda: calls.append(2))
+        self.loop.call_at(now + 0.01, lambda: calls.append(1))
+        self.loop.call_at(now + 0.03, stop)
+        self.loop.run()
+        self.assertEqual([1, 2], calls)
+
+    def test_sendsBatchWhenItLingeredWithoutWaiting(self):
+        self.reader.readerq.put('foo 1 1')
+        start = time.time()
+        wakeup = self.sender.loop_step()
+        self.assertTrue(time.time() - start < 0.05)
+        self.assertTrue(self.sender.tsd is not None)
+        self.assertEqual(['foo 1 1'], self.sender.sendq)
+        self.assertTrue(start < wakeup <= start + 0.06)
+        time.sleep(max(0, wakeup - time.time()))
+        self.sender.loop_step()
+        self.assertEqual(['put foo 1 1'], self.tsd.wait_for(1))
+        self.assertEqual(1, self.sender.flushes['linger'])
+
+    def test_readsTSDErrorsFromTheLoop(self):
+        self.reader.readerq.put('bad.metric 1 1')
+        self.sender.loop_step()
+        self.sender.send_data()
+        self.tsd.wait_for(1)
+        deadline = time.time() + 5
+        while not self.sender.metric_errors and time.time() < deadline:
+            self.loop.poller.poll(0.1)
+        self.assertEqual({'bad.metric': 1}, self.sender.metric_errors)
+        self.assertFalse(self.sender.drainer.isAlive())
+
+    def test_drainsTheQueueBetweenReads(self):
+        col = tcollector.Collector('flood', 0, '<test>')
+        col.collect = lambda: ('foo %d %d' % (1300000000 + i, i)
+                               for i in xrange(25))
+        poller = tcollector.CollectorPoller()
+        ready = [col]  # The collector is ready once.
+        def poll(timeout, poll=poller.poll):
+            return [ready.pop() for col in ready[:]] or poll(0)
+        poller.poll = poll
+        def stop():
+            tcollector.ALIVE = False
+        max_size = tcollector.MAX_READQ_SIZE
+        tcollector.MAX_READQ_SIZE = 10
+        try:
+            self.reader = tcollector.ReaderThread(300, 600)
+            self.sender.close_conn()
+            self.sender = tcollector.SenderThread(
+                self.reader, False, [('127.0.0.1', self.tsd.port)], False,
+                {}, 0, batch_lines=4)
+            loop = tcollector.EventLoop(poller, self.reader,
+                                        [self.sender])
+            loop.call_at(time.time(), stop)
+            loop.run()
+        finally:
+            tcollector.MAX_READQ_SIZE = max_size
+        # The queue only holds 10 lines, but the sender kept emptying it.
+        self.assertEqual(0, self.reader.lines_dropped)
+        loop.drain()
+        self.sender.send_data()  # What's still lingering.
+        self.assertEqual(25, len(self.tsd.wait_for(25)))
+
+class HttpSenderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.random = tcollector.random.random
+        tcollector.random.random = lambda: 0
+        self.tsd = mocks.FakeHttpTSD()
+        self.tsd.start()
+        self.reader = tcollector.ReaderThread(300, 600)
+
+    def tearDown(self):
+        tcollector.random.random = self.random
+        self.tsd.close()
+
+    def sender(self, **kwargs):
+        sender = tcollector.HttpSenderThread(self.reader, False,
+                                             [('127.0.0.1', self.tsd.port)],
+                                             False, {'host': 'x'}, 0, **kwargs)
+        sender.maintain_conn()
+        return sender
+
+    def test_sendsBatchesOnOneConnection(self):
+        sender = self.sender(http_batch_size=2)
+        sender.sendq = ['foo 1 1', 'foo 2 2.5 host=y', 'bar 3 3 a=b',
+                        'bar 4 4 a=b', 'bar 5 5 a=b']
+        sender.send_data()
+        self.assertEqual([], sender.sendq)
+        datapoints = self.tsd.wait_for(5)
+        self.assertEqual({'metric': 'foo', 'timestamp': 1, 'value': 1,
+                          'tags': {'host': 'x'}}, datapoints[0])
+        self.assertEqual({'metric': 'foo', 'timestamp': 2, 'value': 2.5,
+                          'tags': {'host': 'y'}}, datapoints[1])
+        self.assertEqual({'a': 'b', 'host': 'x'}, datapoints[4]['tags'])
+        self.assertEqual([None, None, None], self.tsd.encodings)
+        self.assertEqual(1, self.tsd.connections)
+
+    def test_gzipAndErrorsPerCollector(self):
+        sender = self.sender(http_gzip=True)
+        self.reader.metric_owners['bad.metric'] = 'foo.py'
+        sender.sendq = ['bad.metric 1 1', 'good.metric 1 1', 'bad.metric 2 1',
+                        'bad.other 1 1']
+        sender.send_data()
+        self.assertEqual([], sender.sendq)
+        self.assertEqual(['gzip'], self.tsd.encodings)
+        self.assertEqual(['good.metric'],
+                         [dp['metric'] for dp in self.tsd.wait_for(1)])
+        self.assertEqual({'foo.py': 2, 'unknown': 1}, sender.put_errors)
+
+    def test_chunkedRequests(self):
+        count = tcollector.SEND_CHUNK_LINES * 2 - 1  # Two pieces.
+        sender = self.sender(http_chunked=True, http_gzip=True,
+                             http_batch_size=count)
+        sender.sendq = ['foo %d %d' % (ts, ts) for ts in xrange(count)]
+        sender.send_data()
+        self.assertEqual([], sender.sendq)
+        self.assertEqual(range(count),
+                         [dp['value'] for dp in self.tsd.wait_for(count)])
+        self.assertEqual(['chunked'], self.tsd.transfer_encodings)
+        self.assertEqual(['gzip'], self.tsd.encodings)
+
+    def test_dropsNonFiniteValues(self):
+        sender = self.sender()
+        sender.sendq = ['foo 1 nan', 'foo 2 inf', 'foo 3 -1e999', 'foo 4 4']
+        sender.send_data()
+        self.assertEqual([], sender.sendq)
+        self.assertEqual([4], [dp['value'] for dp in self.tsd.wait_for(1)])
+
+    def test_metricOwnersOnlyForTheHttpSender(self):
+        col = tcollector.Collector('foo.py', 0, '<test>')
+        self.reader.process_line(col, 'foo 1 1')
+        self.assertEqual(None, self.reader.metric_owners)
+        self.sender()
+        self.reader.process_line(col, 'bar 1 1')
+        self.assertEqual({'bar': 'foo.py'}, self.reader.metric_owners)
+
+    def test_keepsDataWhenTheTSDFails(self):
+        sender = self.sender()
+        self.tsd.status = 503
+        sender.sendq = ['foo 1 1']
+        sender.send_data()
+        self.assertEqual(['foo 1 1'], sender.sendq)
+        self.assertEqual(None, sender.tsd)
+
+class StatusServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = tcollector.ReaderThread(300, 600)
+        self.sender = tcollector.SenderThread(self.reader, True, [], True, {},
+                                              0)
+        self.server = tcollector.StatusServer(0, self.reader, [self.sender])
+        self.server.start()
+        self.col = tcollector.Collector('status_test', 15, '/bin/true')
+        tcollector.register_collector(self.col)
+
+    def tearDown(self):
+        del tcollector.COLLECTORS[self.col.name]
+        self.server.stop()
+
+    def get(self, path):
+        conn = tcollector.httplib.HTTPConnection('127.0.0.1',
+                                                 self.server.port, timeout=5)
+        conn.request('GET', path)
+        response = conn.getresponse()
+        return response.status, response.read()
+
+    def test_status(self):
+        self.reader.process_line(self.col, 'foo 1 1')
+        status, body = self.get('/status')
+        self.assertEqual(200, status)
+        status = tcollector.json.loads(body)
+        col = status['collectors']['status_test']
+        self.assertEqual(15, col['interval'])
+        self.assertEqual(None, col['pid'])
+        self.assertEqual(1, col['lines_sent'])
+        self.assertEqual(1, col['dedup_entries'])
+        self.assertEqual(1, status['reader']['queue_depth'])
+        self.assertEqual([False], [s['connected'] for s in status['senders']])
+        self.assertEqual(404, self.get('/nope')[0])
+
+    def test_metrics(self):
+        status, body = self.get('/metrics')
+        self.assertEqual(200, status)
+        lines = body.splitlines()
+        self.assertTrue('tcollector_reader_lines_dropped 0' in lines)
+        self.assertTrue('tcollector_sender_flushes{reason="linger"} 0'
+                        in lines)
+        self.assertTrue([line for line in lines if line.startswith(
+            'tcollector_sender_send_latency_ms_bucket{le="+Inf"} ')])
+
+    def test_readsCollectorsWhileTheyChange(self):
+        class FakeProc(object):
+            pid = 42
+        errors = []
+        done = []
+        def churn():
+            # What the reader and the main thread do to the collectors.
+            try:
+                for i in xrange(10000):
+                    col = tcollector.Collector('churn%d' % i, 0, '<test>')
+                    col.proc = FakeProc()
+                    tcollector.register_collector(col)
+                    self.reader.process_line(col, 'foo %d 1 i=%d' % (i, i))
+                    col.proc = None
+                    del tcollector.COLLECTORS[col.name]
+            except Exception, e:
+                errors.append(e)
+            done.append(True)
+        self.reader.max_series = 10
+        thread = tcollector.threading.Thread(target=churn)
+        thread.start()
+        try:
+            while not done:
+                self.sender.self_stats()
+                tcollector.daemon_status(self.reader, [self.sender])
+        finally:
+            done.append(True)
+            thread.join()
+        self.assertEqual([], errors)
+
+    def test_escapesLabelValues(self):
+        self.assertEqual('a\\\\b\\"c\\nd',
+                         tcollector.prometheus_escape('a\\b"c\nd'))
+
+class StackSamplerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_collapsedStacks(self):
+        started = tcollector.threading.Event()
+        done = tcollector.threading.Event()
+        def wait_here():
+            started.set()
+            done.wait()
+        thread = tcollector.threading.Thread(target=wait_here)
+        thread.start()
+        started.wait()
+        try:
+            sampler = tcollector.StackSampler()
+            sampler.sample()
+            sampler.sample()
+        finally:
+            done.set()
+            thread.join()
+        path = os.path.join(self.dir, 'stacks')
+        sampler.write(path)
+        stacks = [line.rsplit(' ', 1) for line in open(path)
+                  if 'wait_here' in line]
+        self.assertEqual(2, sum(int(count) for stack, count in stacks))
+        for stack, count in stacks:
+            self.assertTrue(stack.startswith(thread.name + ';'))
+
+    def test_toggleProfiler(self):
+        tcollector.toggle_profiler(self.dir)
+        self.assertTrue(tcollector.PROFILER.is_alive())
+        time.sleep(0.05)
+        tcollector.toggle_profiler(self.dir)
+        self.assertEqual(None, tcollector.PROFILER)
+        [name] = os.listdir(self.dir)
+        self.assertTrue(name.startswith('tcollector-%d-' % os.getpid()))
+        self.assertTrue('test_toggleProfiler'
+                        in open(os.path.join(self.dir, name)).read())
+
+    def test_doesNotFollowSymlinks(self):
+        victim = os.path.join(self.dir, 'victim')
+        open(victim, 'w').close()
+        path = os.path.join(self.dir, 'stacks')
+        os.symlink(victim, path)
+        self.assertRaises(OSError, tcollector.StackSampler().write, path)
+        self.assertEqual('', open(victim).read())
+
+    def test_signalsAreHandledByTheMainLoop(self):
+        calls = []
+        tcollector.SIGNAL_HANDLERS[tcollector.signal.SIGUSR2] = (
+            lambda: calls.append(1))
+        try:
+            tcollector.defer_signal(tcollector.signal.SIGUSR2, None)
+            self.assertEqual([], calls)
+            tcollector.handle_signals()
+            self.assertEqual([1], calls)
+            self.assertEqual([], tcollector.PENDING_SIGNALS)
+        finally:
+            tcollector.SIGNAL_HANDLERS.clear()
+
 class UDPCollectorTests(unittest.TestCase):
 
     def setUp(self):